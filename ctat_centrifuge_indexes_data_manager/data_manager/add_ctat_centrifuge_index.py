@@ -10,9 +10,11 @@
 
 import argparse
 import os
-#import tarfile
-#import urllib
+import sys
+import tarfile
 import subprocess
+import Queue
+import inspect
 
 # The following is used to generate a unique_id value
 from datetime import *
@@ -28,8 +30,19 @@ from galaxy.util.json import to_json_string
 # Not sure best way to do it. 
 # This object uses HTMLParser to look through the html 
 # searching for the filenames within anchor tags.
-import urllib2
 from HTMLParser import HTMLParser
+import threading
+
+# The index is downloaded by ctat_transfer, which is shared with the other CTAT Data Managers
+# and is kept next to this file. It resumes a dropped connection with an http Range request
+# or an ftp REST command, rather than starting the download over, and keeps the cache of the index page.
+# Galaxy also runs this file to build the dynamic option list of the form (see the <code> tag in the .xml file),
+# without this directory in the python path and without setting __file__,
+# so the directory is found from the name of the file this code was compiled from.
+_DataManagerDirectory = os.path.dirname(os.path.realpath(inspect.currentframe().f_code.co_filename))
+if _DataManagerDirectory not in sys.path:
+    sys.path.insert(0, _DataManagerDirectory)
+import ctat_transfer
 
 _CTAT_CentrifugeIndexPage_URL = 'https://ccb.jhu.edu/software/centrifuge/'
 _CTAT_CentrifugeDownload_URL = 'ftp://ftp.ccb.jhu.edu/pub/infphilo/centrifuge/data/p_compressed+h+v.tar.gz'
@@ -39,8 +52,19 @@ _CTAT_Centrifuge_DisplayNamePrefix = 'CTAT_CentrifugeIndex_'
 _CentrifugeIndexFileExtension = 'cf'
 _NumBytesNeededForIndex = 7400130287 # 6.9 GB
 #_DownloadFileSize = 5790678746 # 5.4 Gigabytes.
-_Download_TestFile = 'write_testfile.txt'
 _DownloadSuccessFile = 'download_succeeded.txt'
+# As each member of the archive is extracted, it is recorded in the extracted members file,
+# so an extraction that is started again does not write the members that were finished before.
+_ExtractedMembersFile = 'extracted_members.txt'
+# The size of each file of the archive is recorded in the index manifest, to check the index against.
+_IndexManifestFile = 'index_manifest.txt'
+_DownloadBlockSize = 1048576 # 1 MB
+_ReadAheadBlocks = 16 # blocks downloaded ahead of the decompression.
+_DefaultDecompressionThreads = 4
+# The telemetry file is written next to the data manager's output file, with this appended to its name.
+_TelemetryFileSuffix = 'telemetry.jsonl'
+# The telemetry log of this run, which the download reports its bytes to.
+_Telemetry = ctat_transfer.telemetry
 
 class FileListParser(HTMLParser):
     def __init__(self):
@@ -62,6 +86,50 @@ class FileListParser(HTMLParser):
                         self.filenames.add(attribute[1])            
 # End of class FileListParser
 
+class read_ahead_reader(object):
+    # A file-like object that reads blocks of source in a background thread, up to _ReadAheadBlocks ahead,
+    # so the download goes on while the blocks already read are decompressed and written.
+    # An error reading source is raised again by read().
+    def __init__(self, source):
+        self.source = source
+        self.blocks = Queue.Queue(_ReadAheadBlocks)
+        self.block = ""
+        self.position = 0
+        self.finished = False
+        self.reader_thread = threading.Thread(target=self.read_blocks)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+    def read_blocks(self):
+        try:
+            while True:
+                block = self.source.read(_DownloadBlockSize)
+                self.blocks.put(block)
+                if not block:
+                    return
+        except BaseException:
+            self.blocks.put(sys.exc_info())
+    def read(self, size=_DownloadBlockSize):
+        pieces = list()
+        num_bytes = 0
+        while num_bytes < size:
+            if self.position >= len(self.block):
+                if self.finished:
+                    break
+                block = self.blocks.get()
+                if isinstance(block, tuple):
+                    self.finished = True
+                    raise block[0], block[1], block[2]
+                if not block:
+                    self.finished = True
+                    break
+                self.block, self.position = block, 0
+            piece = self.block[self.position:self.position + size - num_bytes]
+            self.position += len(piece)
+            num_bytes += len(piece)
+            pieces.append(piece)
+        return "".join(pieces)
+# End of class read_ahead_reader
+
 def get_ctat_centrifuge_index_locations():
     # For dynamic options need to return an interable with contents that are tuples with 3 items.
     # Item one is a string that is the display name put into the option list.
@@ -69,10 +137,11 @@ def get_ctat_centrifuge_index_locations():
     # Item three is a True or False value, indicating whether the item is selected.
     options = []
     # open the url and retrieve the filenames of the files in the directory.
-    resource = urllib2.urlopen(_CTAT_CentrifugeIndexPage_URL)
-    theHTML = resource.read()
+    # If the page cannot be fetched, the one supported index is still offered below.
+    theHTML = ctat_transfer.get_listing_html(_CTAT_CentrifugeIndexPage_URL)
     filelist_parser = FileListParser()
-    filelist_parser.feed(theHTML)
+    if theHTML is not None:
+        filelist_parser.feed(theHTML)
     # This is what was returned on 2018-04-23
     # ftp://ftp.ccb.jhu.edu/pub/infphilo/centrifuge/data/p_compressed_2018_4_15.tar.gz
     # ftp://ftp.ccb.jhu.edu/pub/infphilo/centrifuge/data/nt_2018_3_3.tar.gz
@@ -106,10 +175,194 @@ def get_ctat_centrifuge_index_locations():
 #    trained_url = params['param_dict']['trained_url']
 #    return trained_url
 
-def download_index(src_location, destination, force_download):
+def which(file):
+    # This procedure is similar to the linux "which" command. 
+    # It is used to find the location of an executable program that is in the PATH.
+    # However this implementation does not check whether the program's file is executable.
+    for path in os.environ["PATH"].split(os.pathsep):
+        if os.path.exists(os.path.join(path, file)):
+            return os.path.join(path, file)
+    return None
+
+def read_extracted_members(checkpoint_filepath):
+    # The checkpoint file written by stream_extract_index() has one line per extracted member.
+    # Each line holds the size of the member and its name, separated by a tab.
+    # Returns a dictionary of member names to sizes.
+    extracted_members = dict()
+    if os.path.exists(checkpoint_filepath):
+        with open(checkpoint_filepath, "r") as checkpoint_file:
+            for line in checkpoint_file:
+                if not line.endswith("\n"):
+                    # The last line was not completely written, so that member is not done.
+                    break
+                fields = line.rstrip("\n").split("\t", 1)
+                if len(fields) == 2 and fields[0].isdigit():
+                    extracted_members[fields[1]] = int(fields[0])
+    return extracted_members
+
+def feed_decompressor(source, decompressor_input, feed_errors):
+    # Copies source into the input of the decompression program. This runs in its own thread,
+    # so the download goes on while the decompression program and this program's extraction do their work.
+    # An error is put in feed_errors, to be raised again by the thread doing the extraction.
+    try:
+        while True:
+            block = source.read(_DownloadBlockSize)
+            if not block:
+                break
+            decompressor_input.write(block)
+    except BaseException:
+        feed_errors.append(sys.exc_info())
+    finally:
+        try:
+            decompressor_input.close()
+        except IOError:
+            # The decompression program has already stopped. Its exit status tells why.
+            pass
+
+def stream_extract_index(src_location, cannonical_destination, force_download, \
+                         decompression_threads=_DefaultDecompressionThreads):
+    # Extracts the archive at src_location into cannonical_destination as it is downloaded,
+    # so the archive is never written to disk.
+    # The download is read by a ctat_transfer.resumable_download_stream, so a dropped connection is resumed
+    # where it left off, and it holds a transfer slot, so it counts against the transfers allowed on the host.
+    # The archive is decompressed by pigz in its own process when pigz is in the PATH, using up to
+    # decompression_threads threads, and by python's tarfile otherwise. Either way the download,
+    # the decompression and the writing of the files are done at the same time.
+    # As each member is extracted, it is recorded in a checkpoint file in the destination.
+    # A gzip stream cannot be restarted part way through, so when an extraction that was stopped
+    # is run again, the archive is streamed again from the start, but the members that were extracted before
+    # are read past rather than written again.
+    # The size of every member of the archive is written to the index manifest, which validate_index_files() checks.
+    # Returns a dictionary of values for the telemetry summary of the stage.
+    checkpoint_filepath = os.path.join(cannonical_destination, _ExtractedMembersFile)
+    if force_download and os.path.exists(checkpoint_filepath):
+        os.remove(checkpoint_filepath)
+    extracted_members = read_extracted_members(checkpoint_filepath)
+    if len(extracted_members) > 0:
+        print "Resuming the extraction. {:d} members were previously extracted.".format(len(extracted_members))
+    print "Extracting the index as it is downloaded from:\n\t{:s}".format(src_location)
+    sys.stdout.flush()
+    with ctat_transfer.transfer_slot(src_location) as slot:
+        meter = ctat_transfer.progress_meter("download", src_location, ctat_transfer.size_of(src_location))
+        source = ctat_transfer.resumable_download_stream(src_location, slot=slot, meter=meter)
+        decompressor = None
+        feeder_thread = None
+        feed_errors = list()
+        if which("pigz") is not None:
+            command = ["pigz", "-dc", "-p", str(decompression_threads)]
+            print "Decompressing with the following command:\n\t{:s}".format(" ".join(command))
+            sys.stdout.flush()
+            decompressor = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            feeder_thread = threading.Thread(target=feed_decompressor, args=(source, decompressor.stdin, feed_errors))
+            feeder_thread.daemon = True
+            feeder_thread.start()
+            tar_stream, tar_mode = decompressor.stdout, "r|"
+        else:
+            tar_stream, tar_mode = read_ahead_reader(source), "r|gz"
+        index_members = list()
+        num_members_skipped = 0
+        try:
+            with tarfile.open(fileobj=tar_stream, mode=tar_mode, bufsize=_DownloadBlockSize) as archive_file, \
+                 open(checkpoint_filepath, "a") as checkpoint_file:
+                for member in archive_file:
+                    member_name = os.path.normpath(member.name)
+                    member_path = os.path.join(cannonical_destination, member_name)
+                    if member.isfile():
+                        index_members.append((member.size, member_name))
+                    if (not member.isdir()) and (extracted_members.get(member_name) == member.size) \
+                        and os.path.lexists(member_path) \
+                        and ((not member.isfile()) or (os.path.getsize(member_path) == member.size)):
+                        # Extracted by a previous attempt. The data is read past, but not written.
+                        num_members_skipped += 1
+                        continue
+                    archive_file.extract(member, path=cannonical_destination)
+                    checkpoint_file.write("{:d}\t{:s}\n".format(member.size, member_name))
+                    checkpoint_file.flush()
+                    os.fsync(checkpoint_file.fileno())
+            # Read anything after the end of the tar archive, so the whole download is checked.
+            while tar_stream.read(_DownloadBlockSize):
+                pass
+        finally:
+            if decompressor is not None:
+                decompressor.stdout.close()
+                decompressor_returncode = decompressor.wait()
+                feeder_thread.join()
+            source.close()
+        meter.finish()
+    if feed_errors:
+        raise feed_errors[0][0], feed_errors[0][1], feed_errors[0][2]
+    if (decompressor is not None) and (decompressor_returncode != 0):
+        raise subprocess.CalledProcessError(decompressor_returncode, " ".join(command))
+    if (source.total_bytes is not None) and (source.offset != source.total_bytes):
+        raise IOError("Download error:\n\tRead {:d} of the {:d} bytes of {:s}".format( \
+                      source.offset, source.total_bytes, src_location))
+    print "Read {:d} bytes from {:s}, resuming the download {:d} times.".format( \
+          source.offset, src_location, source.num_reconnects)
+    print "{:d} previously extracted members were skipped.".format(num_members_skipped)
+    sys.stdout.flush()
+    manifest_filepath = os.path.join(cannonical_destination, _IndexManifestFile)
+    with open(manifest_filepath + ".tmp", "w") as manifest_file:
+        for member_size, member_name in index_members:
+            manifest_file.write("{:d}\t{:s}\n".format(member_size, member_name))
+    os.rename(manifest_filepath + ".tmp", manifest_filepath)
+    os.remove(checkpoint_filepath)
+    return dict(downloaded_bytes=source.offset, num_reconnects=source.num_reconnects, \
+                num_members_skipped=num_members_skipped)
+
+def validate_index_files(index_directory, root_index_dirname=None):
+    # Checks that index_directory holds a complete Centrifuge Index and returns the path that
+    # the centrifuge program is given for it: the directory joined with the root name of the index files.
+    # The index is split into parts named root_name.#.cf, where # is 1, 2, 3 and so on.
+    # All of the parts must be there, numbered from 1 without a gap. When the index was downloaded,
+    # the index manifest records the size of each file in the archive, and each must have that size.
+    # If the directory holds more than one index, the one named root_index_dirname is used.
+    # Raises a ValueError saying what is wrong otherwise.
+    files_in_index_directory = set(os.listdir(index_directory))
+    index_parts = dict()
+    for filename in files_in_index_directory:
+        filename_parts = filename.rsplit(".", 2)
+        if (len(filename_parts) == 3) and (filename_parts[2] == _CentrifugeIndexFileExtension) \
+            and filename_parts[1].isdigit():
+            index_parts.setdefault(filename_parts[0], set()).add(int(filename_parts[1]))
+    if len(index_parts) == 0:
+        raise ValueError("Cannot find any Centrifuge Index files.\n" + \
+            "The contents of the directory {:s} are:\n\t".format(index_directory) + \
+            "\n\t".join(files_in_index_directory))
+    if root_index_dirname in index_parts:
+        index_root_name = root_index_dirname
+    elif len(index_parts) == 1:
+        index_root_name = index_parts.keys()[0]
+    else:
+        raise ValueError("The directory {:s} holds more than one Centrifuge Index:\n\t".format(index_directory) + \
+                         "\n\t".join(sorted(index_parts)))
+    part_numbers = index_parts[index_root_name]
+    missing_parts = [part_number for part_number in range(1, max(part_numbers) + 1) if part_number not in part_numbers]
+    problems = ["{:s}.{:d}.{:s} is missing.".format(index_root_name, part_number, _CentrifugeIndexFileExtension) \
+                for part_number in missing_parts]
+    manifest_filepath = os.path.join(index_directory, _IndexManifestFile)
+    if os.path.exists(manifest_filepath):
+        with open(manifest_filepath, "r") as manifest_file:
+            for line in manifest_file:
+                member_size, member_name = line.rstrip("\n").split("\t", 1)
+                member_path = os.path.join(index_directory, member_name)
+                if not os.path.exists(member_path):
+                    problems.append("{:s} is missing.".format(member_name))
+                elif os.path.getsize(member_path) != int(member_size):
+                    problems.append("{:s} has {:d} bytes, but the archive held {:s}.".format( \
+                                    member_name, os.path.getsize(member_path), member_size))
+    if problems:
+        raise ValueError("The Centrifuge Index in {:s} is not complete:\n\t".format(index_directory) + \
+                         "\n\t".join(sorted(set(problems))))
+    print "Found the {:d} parts of the Centrifuge Index {:s}.".format(len(part_numbers), index_root_name)
+    return os.path.join(index_directory, index_root_name)
+
+def download_index(src_location, destination, force_download, decompression_threads=_DefaultDecompressionThreads):
     # We do not know if the index has been downloaded already.
     # This function returns whether or not the index actually gets downloaded.
+    # decompression_threads is passed on to stream_extract_index().
     index_was_downloaded = False
+    # Earlier versions of the Galaxy form put quotes around the url, for the shell that ran curl.
+    src_location = src_location.strip('"')
     # Get the root filename of the Genome Directory. 
     # The part after the last '/' and before the first '.'
     root_index_dirname = src_location.split("/")[-1].split(".")[0]
@@ -118,36 +371,8 @@ def download_index(src_location, destination, force_download):
     cannonical_destination = os.path.realpath(destination) 
     if cannonical_destination.split("/")[-1] != root_index_dirname:
         cannonical_destination += "/" + root_index_dirname
-    if os.path.exists(cannonical_destination):
-        if not os.path.isdir(cannonical_destination):
-            raise ValueError("The destination is not a directory: " + \
-                             "{:s}".format(cannonical_destination))
-        # else all is good. It is a directory.
-    else:
-        # We need to create it.
-        try:
-            os.makedirs(cannonical_destination)
-        except os.error:
-            print "ERROR: Trying to create the following directory path:"
-            print "\t{:s}".format(cannonical_destination)
-            raise
-
-    # Make sure the directory now exists and we can write to it.
-    if not os.path.exists(cannonical_destination):
-        # It should have been created, but if it doesn't exist at this point
-        # in the code, something is wrong. Raise an error.
-        raise OSError("The destination directory could not be created: " + \
-                      "{:s}".format(cannonical_destination))
-    test_writing_file = "{:s}/{:s}".format(cannonical_destination, _Download_TestFile)
-    try:
-        filehandle = open(test_writing_file, "w")
-        filehandle.write("Testing writing to this file.")
-        filehandle.close()
-        os.remove(test_writing_file)
-    except IOError:
-        print "The destination directory could not be written into: " + \
-                      "{:s}".format(cannonical_destination)
-        raise
+    # The directory is created if needed, and must be writable.
+    cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(cannonical_destination, 0)
     
     # Get the list of files in the directory,
     # We use it to check for a previous download or extraction among other things.
@@ -156,15 +381,14 @@ def download_index(src_location, destination, force_download):
     download_success_file_path = "{:s}/{:s}".format(cannonical_destination, _DownloadSuccessFile)
     if (_DownloadSuccessFile not in orig_files_in_destdir) or force_download:
         # Check whether there is enough space on the device for the index.
-        statvfs = os.statvfs(cannonical_destination)
-        # fs_size = statvfs.f_frsize * statvfs.f_blocks          # Size of filesystem in bytes
-        # num_free_bytes = statvfs.f_frsize * statvfs.f_bfree    # Actual number of free bytes
-        num_avail_bytes = statvfs.f_frsize * statvfs.f_bavail    # Number of free bytes that ordinary users
-                                                                 # are allowed to use (excl. reserved space)
-        if (num_avail_bytes < _NumBytesNeededForIndex):
-            raise OSError("There is insufficient space ({:s} bytes)".format(str(num_avail_bytes)) + \
-                          " on the device of the destination directory: " + \
-                          "{:s}".format(cannonical_destination))
+        # The members extracted by an earlier attempt are already in place, so they need no more space.
+        if force_download:
+            num_bytes_extracted = 0
+        else:
+            num_bytes_extracted = sum(read_extracted_members( \
+                os.path.join(cannonical_destination, _ExtractedMembersFile)).values())
+        ctat_transfer.ensure_we_can_write_numbytes_to(cannonical_destination, \
+                                                      _NumBytesNeededForIndex - num_bytes_extracted)
     
         #Previous code to download and untar. Not using anymore.
         #full_filepath = os.path.join(destination, src_filename)
@@ -190,15 +414,14 @@ def download_index(src_location, destination, force_download):
             os.remove(download_success_file_path)
         # We want to transfer and untar the file without storing the tar file, because that
         # adds all that much more space to the needed amount of free space on the disk.
-        # Use subprocess to pipe the output of curl into tar.
-        # Make curl silent so progress is not printed to stderr.
-        command = "curl --silent {:s} | tar -xzf - -C {:s}".format(src_location, cannonical_destination)
-        try: # to send the command that downloads and extracts the file.
-            command_output = subprocess.check_output(command, shell=True)
-            # FIX - not sure check_output is what we want to use. If we want to have an error raised on
-            # any problem, maybe we should not be checking output.
-        except subprocess.CalledProcessError:
-            print "ERROR: Trying to run the following command:\n\t{:s}".format(command)
+        # The archive used to be piped from curl into tar, but then a dropped connection started the
+        # download over, and an error from curl was hidden by the exit status of tar.
+        try: # to download and extract the file.
+            _Telemetry.run_stage("download_and_extract_index", \
+                                 lambda: stream_extract_index(src_location, cannonical_destination, \
+                                                              force_download, decompression_threads))
+        except ctat_transfer.TransferErrors + (subprocess.CalledProcessError, tarfile.TarError):
+            print "ERROR: Trying to download and extract:\n\t{:s}".format(src_location)
             raise
         else:
             index_was_downloaded = True
@@ -208,32 +431,15 @@ def download_index(src_location, destination, force_download):
     if os.path.exists(cannonical_destination) and os.path.isdir(cannonical_destination):
         subprocess.check_call("ls -lad {:s}/* 2>&1".format(cannonical_destination), shell=True)
     
-    files_in_destdir = set(os.listdir(cannonical_destination))
-    found_filenames = set()
-    for filename in files_in_destdir:
-        # There should be three files, but some OS's might have created
-        # other files in the directory, or maybe the user did.
-        # Look for the index files.
-        # The download files' names should start with the root_index_dirname
-        # print "Is root: {:s} in file: {:s}".format(root_index_dirname, filename)
-        if root_index_dirname in filename:
-            found_filenames.add(filename)
-    # print "The found_filenames are:\n\t{:s}".format(str(found_filenames))
-    if (len(found_filenames) >= 3):
-        # FIX - we could md5 the files to make sure they are correct.
-        # Or at least check their sizes, to see if the download completed ok.
-        # Also we could check the names of the files.
-        try:
-            # Create a file to indicate that the download succeeded.
-            subprocess.check_call("touch {:s}".format(download_success_file_path), shell=True)
-        except IOError:
-            print "The download_success file could not be created: " + \
-                      "{:s}".format(download_success_file_path)
-            raise
-    else:
-        print "After download, the potential index files found are:\n\t{:s}".format(str(found_filenames))
-        raise ValueError("ERROR: Could not find the extracted index files " + \
-                         "in the destination directory:\n\t{:s}".format(cannonical_destination))
+    # The following raises a ValueError if any of the parts of the index are missing or have the wrong size.
+    validate_index_files(cannonical_destination, root_index_dirname)
+    try:
+        # Create a file to indicate that the download succeeded.
+        open(download_success_file_path, "w").close()
+    except IOError:
+        print "The download_success file could not be created: " + \
+                  "{:s}".format(download_success_file_path)
+        raise
 
     return (cannonical_destination, root_index_dirname, index_was_downloaded)
         
@@ -252,8 +458,22 @@ def main():
     parser.add_argument('-f', '--force_download', 
         help='Forces download of the Centrifuge Index, even if previously downloaded. ' + \
              'Requires download_location to be set in order to work.', action="store_true")
+    parser.add_argument('--decompression_threads', type=int, default=_DefaultDecompressionThreads, \
+        help='The number of threads pigz may use to decompress the index, if pigz is in the PATH.')
+    parser.add_argument('--telemetry_file', default="", \
+        help='Full path of the file where the telemetry events are written as JSON lines. ' + \
+             'By default it is written next to the output file, with ' + \
+             '.{:s} appended to the output file\'s name.'.format(_TelemetryFileSuffix))
     args = parser.parse_args()
 
+    if (args.telemetry_file is not None) and (args.telemetry_file != ""):
+        telemetry_filepath = args.telemetry_file
+    else:
+        telemetry_filepath = "{:s}.{:s}".format(os.path.realpath(args.output_filename), _TelemetryFileSuffix)
+    # The progress of the download, and any resumption of it, are recorded too.
+    _Telemetry.open(telemetry_filepath)
+    print "Telemetry is written to:\n\t{:s}".format(telemetry_filepath)
+
     # All of the input parameters are written by default to the output file prior to
     # this program being called.
     # But I do not get input values from the json file, but rather from command line.
@@ -274,7 +494,8 @@ def main():
         index_directory, root_index_dirname, index_was_downloaded = \
             download_index(src_location=args.download_location, \
                            destination=args.destination_path, \
-                           force_download=args.force_download)
+                           force_download=args.force_download, \
+                           decompression_threads=args.decompression_threads)
     else:
         cannonical_destination = os.path.realpath(args.destination_path)
         if not os.path.exists(cannonical_destination):
@@ -295,24 +516,10 @@ def main():
         # Get the root_index_dirname of the index from the index_directory name.
         root_index_dirname = index_directory.split("/")[-1].split(".")[0]
 
-    # Check if there is an actual Centrifuge Index file in the index_directory.
+    # Check that there is a complete Centrifuge Index in the index_directory.
     print "\nThe location of the Centrifuge Index is {:s}.\n".format(index_directory)
-    files_in_index_directory = set(os.listdir(index_directory))
-    index_file_found = False
-    index_file_path = index_directory
-    for filename in files_in_index_directory:
-        # The current index is split into 3 files.
-        # filenames are in the form: index_root_name.#.cf,
-        # where # is a numeral (1, 2, or 3)
-        # indicating the order of the files.
-        if filename.split(".")[-1] == _CentrifugeIndexFileExtension:
-            index_file_found = True
-            # The centrifuge program wants the root name of the files to be final part of the path.
-            index_file_path = "{:s}/{:s}".format(index_directory, filename.split(".")[0])
-    if not index_file_found:
-        raise ValueError("Cannot find any Centrifuge Index files.\n" + \
-            "The contents of the directory {:s} are:\n\t".format(index_directory) + \
-            "\n\t".join(files_in_index_directory))
+    # The centrifuge program wants the root name of the files to be final part of the path.
+    index_file_path = validate_index_files(index_directory, root_index_dirname)
 
     # Set the display_name
     if (args.display_name is None) or (args.display_name == ""):
@@ -341,6 +548,9 @@ def main():
     data_manager_dict['data_tables'] = {}
     data_manager_dict['data_tables'][_CTAT_CentrifugeIndexTableName] = []
     data_table_entry = dict(value=unique_id, name=display_name, path=index_file_path)
+    # The telemetry summary is not a column of the table, so it is not written to the .loc file,
+    # but it is kept with the data manager's output.
+    data_table_entry['telemetry'] = _Telemetry.summary()
     data_manager_dict['data_tables'][_CTAT_CentrifugeIndexTableName].append(data_table_entry)
 
     # Temporarily the output file's dictionary is written for debugging:
@@ -349,6 +559,7 @@ def main():
     # which then puts it into the correct .loc file (I think).
     # Remove the following line when testing without galaxy package.
     open(args.output_filename, 'wb').write(to_json_string(data_manager_dict))
+    _Telemetry.close()
 
 if __name__ == "__main__":
     main()
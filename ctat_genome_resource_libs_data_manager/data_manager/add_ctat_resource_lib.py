@@ -28,10 +28,22 @@ import os
 import shutil
 import tarfile
 import hashlib
-import urllib
 import urlparse
 import contextlib
 import subprocess
+# threading and Queue are used to download byte ranges of large archives over several connections at once.
+import threading
+import Queue
+# multiprocessing is used to hash the files of a library on several cores at once when checking it.
+import multiprocessing
+# ctypes is used to reserve disk space for downloaded and extracted files with the fallocate system call.
+import ctypes
+import ctypes.util
+import errno
+# fcntl and socket are used for the advisory locks that keep concurrent runs from writing the same files.
+import fcntl
+import socket
+import inspect
 
 # One can comment out the following line when testing without galaxy package.
 # In that case, also comment out the last line in main(). That is, the line that uses to_json_string.
@@ -47,8 +59,28 @@ from datetime import datetime
 
 # The Data Manager uses a subclass of HTMLParser to look through a web page's html 
 # searching for the filenames within anchor tags.
-import urllib2
 from HTMLParser import HTMLParser
+import json
+import time
+# scandir lists a directory along with the type of each entry, so finding the subdirectories
+# does not need a stat of every entry. It is in os from python 3.5, and the scandir package backports it to 2.7.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# The downloads, and the cache of the web pages listing the downloadable files, are done by ctat_transfer,
+# which is shared with the other CTAT Data Managers and is kept next to this file.
+# Galaxy also runs this file to build the dynamic option lists of the form (see the <code> tag in the .xml file),
+# without this directory in the python path and without setting __file__,
+# so the directory is found from the name of the file this code was compiled from.
+_DataManagerDirectory = os.path.dirname(os.path.realpath(inspect.currentframe().f_code.co_filename))
+if _DataManagerDirectory not in sys.path:
+    sys.path.insert(0, _DataManagerDirectory)
+import ctat_transfer
 
 _CTAT_ResourceLib_URL = 'https://data.broadinstitute.org/Trinity/CTAT_RESOURCE_LIB/'
 _CTAT_Mutation_URL = 'https://data.broadinstitute.org/Trinity/CTAT/mutation/'
@@ -58,6 +90,7 @@ _CTAT_ResourceLib_DisplayNamePrefix = 'CTAT_GenomeResourceLib_'
 _CTAT_ResourceLib_DefaultGenome = 'Unspecified_Genome'
 _CTAT_HumanFusionLib_FilenamePrefix = 'CTAT_HumanFusionLib'
 _CTAT_RefGenome_Filename = 'ref_genome.fa'
+_CTAT_GmapDirname = 'ref_genome.fa.gmap'
 _CTAT_MouseGenome_Prefix = 'Mouse'
 _CTAT_HumanGenome_Prefix = 'GRCh'
 _COSMIC_Mutant_Filename = 'CosmicMutantExport.tsv.gz'
@@ -70,6 +103,10 @@ _NumBytesNeededForPlugNPlayExtraction = 48318382080 # 45 Gigabytes. Largest arch
 # Built Human Genome archive (GRCh38_v27_CTAT_lib_Feb092018) with mutation lib is 46GB.
 # Fix - double check what amount needed when the library is gmap'ed.
 _NumBytesNeededForBuild = 66571993088 # 62 Gigabytes. FIX - This might not be correct.
+# The above are only used when the exact amounts are not known. The space needed to extract an archive
+# is recorded by name each time it is extracted (see record_extraction_size()),
+# and the space needed to build a library
+# is recorded in the source directory each time it is built (see record_build_size()).
 _NumBytesNeededForMutationResources = 4294967296 # 4 Gigabytes. Actually need about 3.8GB.
 # Once built the downloaded archive could be deleted to reduce the amount used, but with the archive
 # there and the Cosmic files and the built ctat_mutation_library, 3.8GB is needed.
@@ -82,20 +119,142 @@ _LibBuiltSuccessFile = 'build_succeeded.txt'
 _GmapSuccessFile = 'gmap_succeeded.txt'
 _MutationDownloadSuccessFile = 'mutation_download_succeeded.txt'
 _MutationIntegrationSuccessFile = 'mutation_integration_succeeded.txt'
+# Each stage holds a lock file next to its success file while it runs (see stage_lock).
+_DownloadLockFile = 'download.lock'
+_ExtractionLockFile = 'extraction.lock'
+_LibBuiltLockFile = 'build.lock'
+_GmapLockFile = 'gmap.lock'
+_MutationDownloadLockFile = 'mutation_download.lock'
+_MutationIntegrationLockFile = 'mutation_integration.lock'
+_LockPollInterval = 5 # seconds between attempts to take a lock held by another run.
+_LockWaitReportInterval = 600 # seconds between messages that a run is still waiting for a lock.
+# The stage locks held by the threads of this run, by the real path of the lock file. The number of holders
+# of a shared lock is kept, and -1 for an exclusive one. Changed only while holding _StageLockCondition.
+_StageLockHolders = dict()
+_StageLockCondition = threading.Condition()
+_DownloadSegmentsFile = 'segments_downloaded.txt'
+_ExtractedMembersFile = 'extracted_members.txt'
+_ArchiveManifestFile = 'manifest.txt'
+_BuildSizeFile = 'build_size.txt'
+_FilesystemBlockSize = 4096
+_ArchiveCacheSourceUrlsFile = 'source_urls.txt'
+_CacheLastUsedFile = 'last_used.txt'
+_CacheLockFile = 'cache.lock'
+_DefaultArchiveCacheMaxGigabytes = 100
+_BuildCacheKeyFile = 'build_cache_key.txt'
+_SourceHashesFile = 'source_hashes.txt'
+_DefaultBuildCacheMaxGigabytes = 300
+_SourceHashesLock = threading.Lock()
+# The files in the source data that prep_genome_lib.pl builds the library from (along with the
+# CTAT_HumanFusionLib file), and the programs that build it. These make up the key of a library in the build cache.
+_BuildSourceFilenames = ['ref_genome.fa', 'ref_annot.gtf', 'PFAM.domtblout.dat.gz', 'AnnotFilterRule.pm']
+_BuildPrograms = ['prep_genome_lib.pl', 'STAR']
+# A library linked from an existing library records where it was linked from in this file.
+_LinkedLibraryFile = 'linked_from.txt'
+# The entries in a built library that prep_genome_lib.pl writes to when it is run again over the library.
+# They are copied rather than hard linked when a library is linked from an existing one.
+_FilesRewrittenByBuild = ['__chkpts']
+_FilePrefixesRewrittenByBuild = ['pipeliner.']
+# The checksums of the files of an installed library are kept in the library in this file (see write_library_checksums()).
+_LibraryChecksumsFile = 'library_checksums.txt'
+_ChecksumBlockSize = 8388608 # 8 MB. Files are read in large blocks so hashing them is limited by the disk.
+_DownloadBlockSize = 1048576 # 1 MB
+_DownloadSegmentSize = 67108864 # 64 MB. The size of the byte ranges fetched by parallel downloads,
+                                 # and of the chunks whose md5sums are recorded so a download can be resumed.
+_NumSegmentDownloadAttempts = 3
+_DefaultNumDownloadConnections = 4
+# The decompression backends that extract_archive() can use.
+# pigz and zstd are external programs that decompress using more than one thread.
+# tarfile decompresses within this process on a single core.
+_DECOMPRESSION_AUTO = 'auto'
+_DECOMPRESSION_TARFILE = 'tarfile'
+_DECOMPRESSION_PIGZ = 'pigz'
+_DECOMPRESSION_ZSTD = 'zstd'
+_DecompressionBackends = [_DECOMPRESSION_AUTO, _DECOMPRESSION_TARFILE, _DECOMPRESSION_PIGZ, _DECOMPRESSION_ZSTD]
+_GzipMagicNumber = '\x1f\x8b'
+_ZstdMagicNumber = '\x28\xb5\x2f\xfd'
+# The library index records what search_for_genome_build_dir() found in each directory it looked in,
+# with the directory's modification time, so a directory that has not changed is not listed again.
+# Its location can be set with the CTAT_LIBRARY_INDEX environment variable.
+_LibraryIndexFilepath = os.environ.get('CTAT_LIBRARY_INDEX', \
+                                       os.path.join(os.path.expanduser('~'), '.ctat_library_index.json'))
+# A directory modified within this many seconds of being listed is not recorded in the index,
+# since a change made in the same second would not change its modification time.
+_LibraryIndexMtimeGrace = 2
+_LibraryIndexLock = threading.Lock()
+# The space each archive used when it was last extracted is kept by the archive's filename in this file,
+# so it is still known after the archive itself is removed. Its location can be set with
+# the CTAT_EXTRACTION_SIZES environment variable.
+_ExtractionSizesFilepath = os.environ.get('CTAT_EXTRACTION_SIZES', \
+                                          os.path.join(os.path.expanduser('~'), '.ctat_extraction_sizes.json'))
+_ExtractionSizesLock = threading.Lock()
+# The telemetry file is written next to the data manager's output file, with this appended to its name.
+_TelemetryFileSuffix = 'telemetry.jsonl'
+_ProcessSampleInterval = 5 # seconds between samples of the CPU time and memory of a child process.
 _LIBTYPE_SOURCE_DATA = 'source_data'
 _LIBTYPE_PLUG_N_PLAY = 'plug-n-play'
 
-class resumable_URL_opener(urllib.FancyURLopener):
-    # This class is used to do downloads that can restart a download from
-    # the point where it left off after a partial download was interupted.
-    # This class and code using it was found online:
-    # http://code.activestate.com/recipes/83208-resuming-download-of-a-file/
-    # A sub-class is created in order to overide error 206. 
-    # This error means a partial file is being sent,
-    # which is ok in this case.  Do nothing with this error.
-    def http_error_206(self, url, fp, errcode, errmsg, headers, data=None):
-        pass
-# End of class resumable_URL_opener
+# fallocate is used rather than posix_fallocate, because where the filesystem cannot reserve space (NFS, for one)
+# glibc's posix_fallocate writes zeros to the whole file instead, doubling the writes, while fallocate just fails.
+# FALLOC_FL_KEEP_SIZE reserves the space without changing the size of the file.
+_FALLOC_FL_KEEP_SIZE = 1
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc_fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+    _libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    _libc_fallocate = None
+
+class md5_computing_reader(object):
+    # This class wraps a file-like object, such as an open url, and computes 
+    # the md5sum of, and counts, the bytes as they are read through it.
+    # It is used to check the md5sum of an archive that is extracted as it is downloaded.
+    # If a progress_meter is given, the bytes are also counted by it.
+    def __init__(self, fileobj, meter=None):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+        self.meter = meter
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        self.bytes_read += len(data)
+        if self.meter is not None:
+            self.meter.add(len(data))
+        return data
+# End of class md5_computing_reader
+
+class segment_md5_recorder(object):
+    # This class is used by a single stream download to record the md5sum of each segment
+    # of the file in the segments file as soon as the segment has been written.
+    # Segment boundaries are at multiples of _DownloadSegmentSize, the same as for parallel downloads.
+    # When the download is resumed, the segments are verified against these md5sums,
+    # so bytes damaged by an interrupted write are found and downloaded again.
+    def __init__(self, segments_filepath, output_file, start_offset):
+        self.segments_filepath = segments_filepath
+        self.output_file = output_file
+        self.segment_start = start_offset
+        self.offset = start_offset
+        self.md5 = hashlib.md5()
+    def update(self, data):
+        while data:
+            segment_end = (self.offset // _DownloadSegmentSize + 1) * _DownloadSegmentSize
+            piece = data[:segment_end - self.offset]
+            self.md5.update(piece)
+            self.offset += len(piece)
+            data = data[len(piece):]
+            if self.offset == segment_end:
+                self.record_segment()
+    def record_segment(self):
+        # The data is flushed before the segment is recorded, so the record never gets ahead of the file.
+        if self.offset == self.segment_start:
+            return
+        self.output_file.flush()
+        with open(self.segments_filepath, "a") as segments_file:
+            segments_file.write("{:d}\t{:d}\t{:s}\n".format(self.segment_start, self.offset - 1, self.md5.hexdigest()))
+        self.segment_start = self.offset
+        self.md5 = hashlib.md5()
+# End of class segment_md5_recorder
 
 class FileListParser(HTMLParser):
     # The FileListParser object is used by get_ctat_genome_urls() and get_mutation_resource_urls(),
@@ -127,19 +286,146 @@ class FileListParser(HTMLParser):
                         self.urls.add(attribute[1])            
 # End of class FileListParser
 
+# The telemetry log of this run, which the transfers of ctat_transfer report their bytes to.
+_Telemetry = ctat_transfer.telemetry
+
+class stage_lock(object):
+    # An advisory lock, taken with flock() on lock_filepath, that is held while a stage writes to a location
+    # that another run of this data manager (started by another admin, or by another Galaxy handler)
+    # may be writing to at the same time, e.g. while an archive is downloaded into a download location.
+    # A second run asking for the lock waits until the first run has finished the stage. It then finds
+    # the success file the first run wrote and uses its download, extraction or build instead of doing it again.
+    # The kernel releases the lock if the process holding it dies, so a run that crashed leaves no stale lock.
+    # The lock file is left in place. While the lock is held it names the host and pid of the holder,
+    # which a waiting run prints.
+    # On NFS, Linux takes flock() locks as byte range locks, which the other nodes see. Those belong to the
+    # process rather than to the open file, so two stages of the same run would not exclude each other
+    # through them. A stage of this run therefore first takes the lock from the other stages of this run
+    # (see _StageLockHolders), and only then the flock() that excludes other runs.
+    # description is used in the messages, e.g. "the download of GRCh38_v27_CTAT_lib.source_data.tar.gz".
+    # If shared is True, the lock is a shared one, which other shared holders may hold at the same time,
+    # e.g. runs reading from a cache, while a run removing entries from it holds the lock alone.
+    # The holder is not written to a shared lock.
+    def __init__(self, lock_filepath, description, shared=False):
+        self.lock_filepath = lock_filepath
+        self.description = description
+        self.shared = shared
+        self.lock_file = None
+        self.waited_for_another_run = False
+    def __enter__(self):
+        lock_directory = os.path.dirname(self.lock_filepath)
+        if not os.path.isdir(lock_directory):
+            try:
+                os.makedirs(lock_directory)
+            except os.error:
+                # Another stage or run may have just created it.
+                if not os.path.isdir(lock_directory):
+                    raise
+        self.lock_key = os.path.realpath(self.lock_filepath)
+        self.waited_for_another_run = self.acquire_in_process()
+        try:
+            self.lock_file = open(self.lock_filepath, "a+")
+        except:
+            self.release_in_process()
+            raise
+        wait_start_time = time.time()
+        last_report_time = None
+        while True:
+            try:
+                fcntl.flock(self.lock_file.fileno(), (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+                break
+            except IOError as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    self.lock_file.close()
+                    self.release_in_process()
+                    raise
+            now = time.time()
+            if (last_report_time is None) or (now - last_report_time >= _LockWaitReportInterval):
+                self.lock_file.seek(0)
+                holder = self.lock_file.read().strip() or "unknown"
+                print "Waiting for {:s}, which another run is doing ({:s}). The lock is:\n\t{:s}".format( \
+                      self.description, holder, self.lock_filepath)
+                sys.stdout.flush()
+                if last_report_time is None:
+                    _Telemetry.event("lock_wait_started", lock=self.lock_filepath, holder=holder)
+                last_report_time = now
+            # Polling, rather than a blocking flock(), lets the thread still be interrupted while it waits.
+            try:
+                time.sleep(_LockPollInterval)
+            except:
+                self.lock_file.close()
+                self.release_in_process()
+                raise
+        if last_report_time is not None:
+            self.waited_for_another_run = True
+            waited_seconds = round(time.time() - wait_start_time, 3)
+            print "Finished waiting for {:s} after {:.0f} seconds.".format(self.description, waited_seconds)
+            sys.stdout.flush()
+            _Telemetry.event("lock_wait_finished", lock=self.lock_filepath, waited_seconds=waited_seconds)
+        if not self.shared:
+            self.lock_file.seek(0)
+            self.lock_file.truncate()
+            self.lock_file.write("host {:s} pid {:d} since {:s}\n".format(socket.gethostname(), os.getpid(), \
+                                 datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            self.lock_file.flush()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if not self.shared:
+                self.lock_file.seek(0)
+                self.lock_file.truncate()
+        finally:
+            try:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+                self.lock_file.close()
+            finally:
+                self.release_in_process()
+        return False
+    def acquire_in_process(self):
+        # Waits until no other stage of this run holds the lock in a way that excludes this one, then takes it.
+        # Returns whether it had to wait.
+        waited = False
+        with _StageLockCondition:
+            while True:
+                holders = _StageLockHolders.get(self.lock_key, 0)
+                if (holders == 0) or (self.shared and (holders > 0)):
+                    break
+                if not waited:
+                    print "Waiting for {:s}, which another stage of this run is doing.".format(self.description)
+                    sys.stdout.flush()
+                    waited = True
+                # Waiting with a timeout, like the polling for the flock(), lets the thread still be interrupted.
+                _StageLockCondition.wait(_LockPollInterval)
+            _StageLockHolders[self.lock_key] = (holders + 1) if self.shared else -1
+        return waited
+    def release_in_process(self):
+        with _StageLockCondition:
+            holders = _StageLockHolders.get(self.lock_key, 0)
+            if self.shared and (holders > 1):
+                _StageLockHolders[self.lock_key] = holders - 1
+            else:
+                _StageLockHolders.pop(self.lock_key, None)
+            _StageLockCondition.notify_all()
+    def still_forced(self, force, success_filepath):
+        # Returns whether a stage asked to redo its work (force) should still do so once it holds the lock.
+        # It should not when this run waited for another run that has just succeeded at the same stage,
+        # since the result of that run is as new as the one this run would make.
+        if force and self.waited_for_another_run and os.path.exists(success_filepath):
+            print "Another run has just finished {:s}, so it is used rather than redone.".format(self.description)
+            sys.stdout.flush()
+            return False
+        return force
+# End of class stage_lock
+
 def get_ctat_genome_urls():
     # open the url and retrieve the urls of the files in the directory.
     # If we can't get the list, send a default list.
 
     build_default_list = False
     default_url_filename = "GRCh38_v27_CTAT_lib_Feb092018.plug-n-play.tar.gz"
-    resource = urllib2.urlopen(_CTAT_ResourceLib_URL)
-    if resource is None:
+    theHTML = ctat_transfer.get_listing_html(_CTAT_ResourceLib_URL)
+    if (theHTML is None) or (theHTML == ""):
         build_default_list = True
-    else:
-        theHTML = resource.read()
-        if (theHTML is None) or (theHTML == ""):
-            build_default_list = True
     if build_default_list:
         # These are the filenames for what was there at least until 2018/10/09.
         urls_to_return = set()
@@ -162,7 +448,7 @@ def get_ctat_genome_urls():
     found_default_url = False
     if len([item for item in urls_to_return if default_url_filename in item]) > 0:
         found_default_url = True
-    for i, url in enumerate(filelist_parser.urls):
+    for i, url in enumerate(urls_to_return):
         # The urls should look like: 
         # https://data.broadinstitute.org/Trinity/CTAT_RESOURCE_LIB/GRCh37_v19_CTAT_lib_Feb092018.plug-n-play.tar.gz
         # https://data.broadinstitute.org/Trinity/CTAT_RESOURCE_LIB/Mouse_M16_CTAT_lib_Feb202018.source_data.tar.gz
@@ -196,13 +482,9 @@ def get_mutation_resource_urls():
     # In that case we wouldn't provide a pull down interface that would call this.
     # FIX - 
     build_default_list = False
-    resource = urllib2.urlopen(_CTAT_Mutation_URL)
-    if resource is None:
+    theHTML = ctat_transfer.get_listing_html(_CTAT_Mutation_URL)
+    if (theHTML is None) or (theHTML == ""):
         build_default_list = True
-    else:
-        theHTML = resource.read()
-        if (theHTML is None) or (theHTML == ""):
-            build_default_list = True
     if build_default_list:
         # These are the filenames for what was there at least until 2018/10/09.
         urls_to_return = set()
@@ -218,7 +500,7 @@ def get_mutation_resource_urls():
     # Item two is the value that is put into the parameter associated with the option list.
     # Item three is a True or False value, indicating whether the item is selected.
     options = []
-    for i, url in enumerate(filelist_parser.urls):
+    for i, url in enumerate(urls_to_return):
         # The urls should look like: 
         # https://data.broadinstitute.org/Trinity/CTAT/mutation/mc7.tar.gz
         # https://data.broadinstitute.org/Trinity/CTAT/mutation/hg19.tar.gz
@@ -291,12 +573,92 @@ def which(file):
             return os.path.join(path, file)
     return None
 
+def process_tree_usage(root_pid):
+    # Returns a tuple of the CPU seconds used so far and the resident memory, in bytes, of the process root_pid
+    # and all of its descendants, read from /proc. The CPU time of descendants that have already
+    # exited and been waited for is included in their parent's children's times, so it is not lost.
+    # Returns None if /proc cannot be read (e.g. not linux) or the process is gone.
+    parents = dict()
+    usages = dict()
+    clock_ticks = float(os.sysconf("SC_CLK_TCK"))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    try:
+        pids = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open("/proc/{:d}/stat".format(pid)) as stat_file:
+                stat = stat_file.read()
+        except IOError:
+            # The process exited after /proc was listed.
+            continue
+        # The command name, in parentheses, can hold spaces, so the fields are split after it.
+        fields = stat[stat.rfind(")") + 2:].split()
+        parents[pid] = int(fields[1])
+        usages[pid] = ((int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])) / clock_ticks, \
+                       int(fields[21]) * page_size)
+    if root_pid not in usages:
+        return None
+    tree = set([root_pid])
+    num_in_tree = 0
+    while num_in_tree != len(tree):
+        num_in_tree = len(tree)
+        tree.update([pid for pid, parent in parents.items() if parent in tree])
+    return (sum([usages[pid][0] for pid in tree]), sum([usages[pid][1] for pid in tree]))
+
+def run_monitored_command(command, **popen_args):
+    # Runs command like subprocess.check_call(), with popen_args passed on to subprocess.Popen.
+    # While it runs, the CPU time and resident memory of the command and the processes it starts
+    # (e.g. STAR, started by prep_genome_lib.pl) are sampled every _ProcessSampleInterval seconds
+    # and recorded in the telemetry log.
+    # When it finishes, its CPU time and the peak memory of its largest process are taken from wait4().
+    start_time = time.time()
+    process = subprocess.Popen(command, **popen_args)
+    stage = _Telemetry.current_stage()
+    command_name = command if isinstance(command, basestring) else " ".join(command)
+    _Telemetry.event("process_started", stage, command=command_name, pid=process.pid)
+    peak_rss_bytes = 0
+    last_sample = start_time
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except OSError as error:
+            if error.errno == errno.EINTR:
+                continue
+            raise
+        if pid != 0:
+            break
+        time.sleep(0.5)
+        if time.time() - last_sample >= _ProcessSampleInterval:
+            last_sample = time.time()
+            usage = process_tree_usage(process.pid)
+            if usage is not None:
+                peak_rss_bytes = max(peak_rss_bytes, usage[1])
+                _Telemetry.event("process_sample", stage, command=command_name, pid=process.pid, \
+                                 cpu_seconds=round(usage[0], 2), rss_bytes=usage[1])
+    # The process has been waited for here, so Popen must not wait for it again.
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    cpu_seconds = rusage.ru_utime + rusage.ru_stime
+    # ru_maxrss is in kilobytes on linux.
+    peak_rss_bytes = max(peak_rss_bytes, rusage.ru_maxrss * 1024)
+    _Telemetry.event("process_finished", stage, command=command_name, pid=process.pid, \
+                     returncode=process.returncode, wall_seconds=round(time.time() - start_time, 3), \
+                     cpu_seconds=round(cpu_seconds, 2), peak_rss_bytes=peak_rss_bytes)
+    _Telemetry.add_process(stage, cpu_seconds, peak_rss_bytes)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command_name)
+    return 0
+
 def size_of_file_at(file_url):
     # Returns the size of the file at file_url.
-    # We have to open the file, in order to find out how big it is.
-    file_retriever = resumable_URL_opener()
-    with contextlib.closing(file_retriever.open(file_url)) as filelike_object:
-       filesize = int(filelike_object.headers['Content-Length'])
+    # The server is asked with a HEAD request on a pooled connection, so none of the file is sent.
+    filesize = ctat_transfer.size_of(file_url)
+    if filesize is None:
+        raise IOError("The server does not give the size of {:s}".format(file_url))
     return filesize
 
 def md5sum_for(filename, blocksize=2**20):
@@ -312,6 +674,28 @@ def md5sum_for(filename, blocksize=2**20):
                 finished = True
     return m.hexdigest()
 
+def update_md5_from_file(md5_object, filename, start, end, blocksize=2**20):
+    # Updates md5_object with bytes start through end (inclusive) of filename.
+    # This is used to bring an md5 computed while downloading up to date with bytes
+    # that are already on disk, for example those from an interrupted download.
+    with open(filename, "rb") as f:
+        f.seek(start)
+        bytes_left = end - start + 1
+        while bytes_left > 0:
+            buf = f.read(min(blocksize, bytes_left))
+            if not buf:
+                raise IOError("Unexpected end of file at byte {:d} of {:s}".format(end - bytes_left + 1, filename))
+            md5_object.update(buf)
+            bytes_left -= len(buf)
+    return md5_object
+
+def md5sum_from_web_for(file_url):
+    # Reads the md5sum published alongside file_url, in the file named file_url + ".md5".
+    # The first field of the first line of that file is the md5sum.
+    md5_url = "{:s}.md5".format(file_url)
+    md5sum_from_web = ctat_transfer.read_url(md5_url).splitlines()[0].strip().split()[0]
+    return md5sum_from_web
+
 def ctat_library_type(filepath):
     # This function pulls out the string indicating the library type of the file.
     # If the filename indicates source_data, as opposed to plug-n-play, 
@@ -341,9 +725,20 @@ def find_genome_name_in_path(path, raise_error=False):
     return genome_name
 
 def bytes_needed_to_extract(archive_filepath):
-    # FIX -- The following should be replaced by a series of statements that return the right value for each archive.
-    # The numbers used now estimates for the human genome, and so are big enough for the mouse genome, so ok for now.
-    # FIX --
+    # Returns the exact number of bytes needed to extract archive_filepath (a path or a url) when its manifest 
+    # was written by an earlier extraction of it (see write_archive_manifest()), or else when an earlier
+    # extraction of an archive of the same name recorded its size (see record_extraction_size()),
+    # which is still known when the archive was removed after that extraction.
+    # Otherwise, for the first extraction of an archive, an estimate for the type of archive is returned,
+    # since finding the exact number would mean decompressing the whole archive once more just to read its headers.
+    # The estimates are for the human genome, and so are big enough for the mouse genome.
+    if os.path.exists(archive_filepath):
+        manifest = read_archive_manifest(archive_filepath)
+        if manifest is not None:
+            return manifest['num_bytes']
+    recorded_size = load_extraction_sizes().get(archive_filename_of(archive_filepath))
+    if (recorded_size is not None) and isinstance(recorded_size.get('num_bytes'), (int, long)):
+        return recorded_size['num_bytes']
     bytes_needed = _NumBytesNeededForPlugNPlayExtraction
     if (ctat_library_type(archive_filepath) == _LIBTYPE_SOURCE_DATA):
         bytes_needed = _NumBytesNeededForSourceDataExtraction
@@ -351,11 +746,64 @@ def bytes_needed_to_extract(archive_filepath):
         bytes_needed = _NumBytesNeededForPlugNPlayExtraction
     return bytes_needed
 
+def archive_filename_of(archive_filepath):
+    # Returns the filename of archive_filepath, which may be a path or a url.
+    return os.path.basename(urlparse.urlparse(archive_filepath).path)
+
+def load_extraction_sizes():
+    # Returns the extraction sizes recorded by record_extraction_size(), a dictionary mapping 
+    # archive filenames to the number of files (num_files) and bytes (num_bytes) of their extraction.
+    # A missing or unreadable file is treated as empty.
+    try:
+        with open(_ExtractionSizesFilepath, "r") as sizes_file:
+            return json.load(sizes_file).get('archives', dict())
+    except (IOError, ValueError, AttributeError):
+        return dict()
+
+def record_extraction_size(archive_filepath, num_files, num_bytes):
+    # Records the space that extracting archive_filepath (a path or a url) used, by the archive's filename,
+    # so bytes_needed_to_extract() can use the real size for later extractions of the archive,
+    # whether it is extracted from the same file, downloaded again, or streamed.
+    # The file is written to a temporary file and renamed into place, like the library index.
+    with _ExtractionSizesLock:
+        extraction_sizes = load_extraction_sizes()
+        extraction_sizes[archive_filename_of(archive_filepath)] = dict(num_files=num_files, num_bytes=num_bytes)
+        temporary_filepath = "{:s}.{:d}.tmp".format(_ExtractionSizesFilepath, os.getpid())
+        try:
+            with open(temporary_filepath, "w") as sizes_file:
+                json.dump(dict(archives=extraction_sizes), sizes_file)
+            os.rename(temporary_filepath, _ExtractionSizesFilepath)
+        except (IOError, OSError) as sizes_error:
+            # The sizes only make the space check exact, so not being able to write them is not an error.
+            print "Could not record the extraction size in {:s}: {:s}".format(_ExtractionSizesFilepath, str(sizes_error))
+            sys.stdout.flush()
+
 def bytes_needed_to_build(source_data_filepath):
-    # FIX - The following should be replaced by a series of statements that return the right value for each archive.
-    # The numbers used now estimates that largest size needed. Also, it is probably not correct.
+    # Returns the number of bytes a previous build of source_data_filepath used, if one was recorded
+    # by record_build_size(), otherwise the estimate of the largest size needed.
+    build_size_filepath = os.path.join(source_data_filepath, \
+        "{:s}.{:s}".format(os.path.basename(source_data_filepath), _BuildSizeFile))
+    if os.path.exists(build_size_filepath):
+        with open(build_size_filepath, "r") as build_size_file:
+            recorded_size = build_size_file.readline().strip()
+        if recorded_size.isdigit():
+            return int(recorded_size)
     return _NumBytesNeededForBuild
 
+def record_build_size(source_data_filepath, genome_build_directory):
+    # Records the space that building source_data_filepath into genome_build_directory used,
+    # so bytes_needed_to_build() can use the real size for later builds of the same source data.
+    # Only the outputs of the build are counted. The gmap index and the mutation library are not,
+    # since gmap_build may still be writing into the same directory when the build finishes.
+    build_size_filepath = os.path.join(source_data_filepath, \
+        "{:s}.{:s}".format(os.path.basename(source_data_filepath), _BuildSizeFile))
+    num_bytes = directory_size_in_bytes(genome_build_directory, is_excluded_from_build_cache)
+    with open(build_size_filepath, "w") as build_size_file:
+        build_size_file.write("{:d}\n{:s}\n".format(num_bytes, genome_build_directory))
+    print "The built library uses {:d} bytes.".format(num_bytes)
+    sys.stdout.flush()
+    return num_bytes
+
 def create_success_file(full_file_path, contents=None):
     # full_file_path is the path to the file to write.
     #     It should not exist before calling this function,
@@ -373,7 +821,255 @@ def create_success_file(full_file_path, contents=None):
         sys.stdout.flush()
         raise
 
-def download_file_from_url(file_url, dest_dir, resume_download=True):
+def server_accepts_byte_ranges(file_url):
+    # Returns True if the server for file_url says that it will send byte ranges of the file.
+    # Only http and https servers are asked. For other schemes (e.g. ftp) False is returned,
+    # so the caller falls back to a single stream download.
+    return ctat_transfer.accepts_byte_ranges(file_url)
+
+def read_completed_segments(segments_filepath):
+    # The segments file has one line per completed segment of a download.
+    # Each line holds the start and end (inclusive) byte offsets of the segment
+    # and the md5sum of the bytes of the segment.
+    # Returns a dictionary mapping (start, end) tuples to md5sums.
+    # Lines written by older versions of this code have no md5sum. Those segments map to None.
+    completed_segments = dict()
+    if os.path.exists(segments_filepath):
+        with open(segments_filepath, "r") as segments_file:
+            for line in segments_file:
+                fields = line.split()
+                # A torn last line (from an interrupted write) is ignored, 
+                # so that segment will simply be downloaded again.
+                if len(fields) in (2, 3) and fields[0].isdigit() and fields[1].isdigit() \
+                   and (int(fields[1]) >= int(fields[0])):
+                    md5sum = None
+                    if len(fields) == 3:
+                        if len(fields[2]) != 32:
+                            continue
+                        md5sum = fields[2]
+                    completed_segments[(int(fields[0]), int(fields[1]))] = md5sum
+    return completed_segments
+
+def write_completed_segments(segments_filepath, completed_segments):
+    # Rewrites the segments file so that it holds only the segments in completed_segments,
+    # a dictionary like the one returned by read_completed_segments().
+    with open(segments_filepath + ".tmp", "w") as segments_file:
+        for start, end in sorted(completed_segments):
+            md5sum = completed_segments[(start, end)]
+            if md5sum is None:
+                segments_file.write("{:d}\t{:d}\n".format(start, end))
+            else:
+                segments_file.write("{:d}\t{:d}\t{:s}\n".format(start, end, md5sum))
+    os.rename(segments_filepath + ".tmp", segments_filepath)
+
+def verify_segments(filename, completed_segments, md5_object, blocksize=2**20):
+    # Reads back each segment in completed_segments (see read_completed_segments())
+    # and checks it against the md5sum recorded for it. 
+    # Segments recorded without an md5sum are accepted as they are.
+    # While the segments are contiguous from the start of the file and intact, md5_object,
+    # the md5 of the whole file, is advanced over them too, so the bytes are only read once.
+    # Returns a tuple of a dictionary of the intact segments, the updated md5_object,
+    # and the offset up to which md5_object has been advanced.
+    intact_segments = dict()
+    md5_offset = 0
+    with open(filename, "rb") as f:
+        for start, end in sorted(completed_segments):
+            expected_md5sum = completed_segments[(start, end)]
+            in_sequence = (start == md5_offset)
+            segment_md5 = hashlib.md5()
+            # The md5 of the file is advanced on a copy, in case this segment turns out to be bad.
+            file_md5 = md5_object.copy() if in_sequence else None
+            f.seek(start)
+            bytes_left = end - start + 1
+            while bytes_left > 0:
+                buf = f.read(min(blocksize, bytes_left))
+                if not buf:
+                    break
+                segment_md5.update(buf)
+                if file_md5 is not None:
+                    file_md5.update(buf)
+                bytes_left -= len(buf)
+            if (bytes_left == 0) and ((expected_md5sum is None) or (segment_md5.hexdigest() == expected_md5sum)):
+                intact_segments[(start, end)] = expected_md5sum
+                if in_sequence:
+                    md5_object = file_md5
+                    md5_offset = end + 1
+            else:
+                print "The previously downloaded bytes {:d}-{:d} of {:s} ".format(start, end, filename) + \
+                      "are damaged and will be downloaded again."
+                sys.stdout.flush()
+    return (intact_segments, md5_object, md5_offset)
+
+def download_segment(file_url, dest_fullpath, start, end, meter=None):
+    # Downloads bytes start through end (inclusive) of file_url and writes them in place,
+    # at the same offsets, into dest_fullpath, which must already exist.
+    # If a progress_meter is given, the bytes are counted by it as they arrive.
+    # The range is fetched on a pooled connection while holding a transfer slot (see ctat_transfer.transfer_slot),
+    # so each connection of a parallel download counts against the transfers allowed on the host.
+    # Raises an IOError if the server does not send back the whole range.
+    # Returns the md5sum of the bytes of the range.
+    bytes_left = end - start + 1
+    segment_md5 = hashlib.md5()
+    with ctat_transfer.transfer_slot(file_url) as slot, \
+         contextlib.closing(ctat_transfer.open_url(file_url, start, end, slot=slot)) as source_file:
+        if source_file.status != 206:
+            raise IOError("The server did not return a partial file for the range " + \
+                          "{:d}-{:d} of {:s}".format(start, end, file_url))
+        with open(dest_fullpath, "r+b") as output_file:
+            output_file.seek(start)
+            while bytes_left > 0:
+                data = source_file.read(min(_DownloadBlockSize, bytes_left))
+                if not data:
+                    break
+                output_file.write(data)
+                segment_md5.update(data)
+                bytes_left -= len(data)
+                if meter is not None:
+                    meter.add(len(data))
+    if bytes_left != 0:
+        raise IOError("Download of the range {:d}-{:d} of {:s} ".format(start, end, file_url) + \
+                      "ended {:d} bytes short.".format(bytes_left))
+    return segment_md5.hexdigest()
+
+def download_file_in_segments(file_url, dest_fullpath, source_filesize, \
+                              num_connections, resume_download=True):
+    # Downloads file_url into dest_fullpath using num_connections simultaneous connections.
+    # The file is split into byte ranges of _DownloadSegmentSize bytes.
+    # The destination file is first extended to its final size, and then each worker thread
+    # takes the next range off of a queue, fetches it and writes it in place.
+    # The ranges that have completed are recorded, with their md5sums, in a segments file next to
+    # the destination file, so a download that is interrupted can be resumed without fetching those ranges again.
+    # On resume, each recorded range is checked against its md5sum, and only damaged ranges are fetched again.
+    # If resume_download is True and the destination file exists but there is no segments file,
+    # the existing file is assumed to be a partial single stream download 
+    # and all ranges that lie entirely within the existing bytes are considered complete.
+    # The md5sum of the file is computed while downloading. Ranges arrive out of order, 
+    # so the md5 is advanced over each range as soon as all of the ranges before it have landed,
+    # while the range's bytes are still in the page cache. 
+    #
+    # Returns a tuple of the number of bytes that were downloaded and the md5sum of the file.
+    segments_filepath = "{:s}.{:s}".format(dest_fullpath, _DownloadSegmentsFile)
+    completed_segments = set()
+    all_segments = [(start, min(start + _DownloadSegmentSize, source_filesize) - 1) \
+                    for start in xrange(0, source_filesize, _DownloadSegmentSize)]
+    # md5_state holds the md5 object and the offset up to which the file has been hashed.
+    md5_state = dict(md5=hashlib.md5(), offset=0)
+    if resume_download and os.path.exists(dest_fullpath):
+        existing_size = os.path.getsize(dest_fullpath)
+        if os.path.exists(segments_filepath):
+            recorded_segments = read_completed_segments(segments_filepath)
+            for segment in recorded_segments.keys():
+                if segment not in all_segments:
+                    del recorded_segments[segment]
+            print "Verifying the {:d} segments previously downloaded.".format(len(recorded_segments))
+            sys.stdout.flush()
+            intact_segments, md5_state['md5'], md5_state['offset'] = \
+                verify_segments(dest_fullpath, recorded_segments, md5_state['md5'])
+            write_completed_segments(segments_filepath, intact_segments)
+            completed_segments = set(intact_segments.keys())
+            print "Resuming the download. {:d} of {:d} segments ".format(len(completed_segments), len(all_segments)) + \
+                  "were previously downloaded and verified."
+        elif existing_size <= source_filesize:
+            # The previous download was done as a single stream.
+            completed_segments = set([segment for segment in all_segments if segment[1] < existing_size])
+            print "Resuming the download after the {:d} bytes previously downloaded.".format(existing_size)
+        else:
+            print "The existing file is larger than the source file, so a new download will be done."
+            os.remove(dest_fullpath)
+    else:
+        if os.path.exists(dest_fullpath):
+            os.remove(dest_fullpath)
+        if os.path.exists(segments_filepath):
+            os.remove(segments_filepath)
+    sys.stdout.flush()
+
+    # Preallocate the file. The disk space for all of it is reserved first, so a full disk is found now
+    # rather than part way through the download (where the filesystem can reserve space, see preallocate_file_space()),
+    # and then it is extended to its final size. Any bytes already present are not changed.
+    with open(dest_fullpath, "ab") as output_file:
+        preallocate_file_space(output_file.fileno(), source_filesize)
+        output_file.truncate(source_filesize)
+
+    segments_to_download = Queue.Queue()
+    for segment in all_segments:
+        if segment not in completed_segments:
+            segments_to_download.put(segment)
+    num_segments_to_download = segments_to_download.qsize()
+    print "Downloading {:d} segments using {:d} connections.".format(num_segments_to_download, num_connections)
+    sys.stdout.flush()
+
+    segments_lock = threading.Lock()
+    download_errors = list()
+    bytes_read = [0]
+    meter = ctat_transfer.progress_meter("download", file_url, source_filesize, \
+                           sum([end - start + 1 for start, end in completed_segments]))
+    md5_lock = threading.Lock()
+    segment_ends = dict(all_segments)
+
+    def advance_md5():
+        # Hash every completed range that directly follows the bytes hashed so far.
+        with md5_lock:
+            while md5_state['offset'] < source_filesize:
+                start = md5_state['offset']
+                end = segment_ends[start]
+                with segments_lock:
+                    if (start, end) not in completed_segments:
+                        return
+                update_md5_from_file(md5_state['md5'], dest_fullpath, start, end)
+                md5_state['offset'] = end + 1
+
+    # Ranges from a previous download that were not hashed while verifying are hashed here.
+    advance_md5()
+
+    def download_worker():
+        while not download_errors:
+            try:
+                start, end = segments_to_download.get_nowait()
+            except Queue.Empty:
+                return
+            attempt = 1
+            while True:
+                try:
+                    segment_md5sum = download_segment(file_url, dest_fullpath, start, end, meter)
+                    break
+                except ctat_transfer.TransferErrors as error:
+                    if attempt >= _NumSegmentDownloadAttempts:
+                        with segments_lock:
+                            download_errors.append(error)
+                        return
+                    print "Retrying download of the range {:d}-{:d} after error: {:s}".format(start, end, str(error))
+                    sys.stdout.flush()
+                    attempt += 1
+            with segments_lock:
+                with open(segments_filepath, "a") as segments_file:
+                    segments_file.write("{:d}\t{:d}\t{:s}\n".format(start, end, segment_md5sum))
+                completed_segments.add((start, end))
+                bytes_read[0] += end - start + 1
+            advance_md5()
+
+    workers = [threading.Thread(target=download_worker) for i in range(min(num_connections, max(num_segments_to_download, 1)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    meter.finish()
+    if download_errors:
+        print "Error while attempting to download {:s}".format(file_url)
+        sys.stdout.flush()
+        raise IOError("Download of {:s} failed. ".format(file_url) + \
+                      "{:d} segment(s) could not be downloaded:\n\t".format(len(download_errors)) + \
+                      "\n\t".join([str(error) for error in download_errors]))
+    advance_md5()
+    if md5_state['offset'] != source_filesize:
+        raise IOError("Download of {:s} failed. Only the first ".format(file_url) + \
+                      "{:d} of {:d} bytes could be verified.".format(md5_state['offset'], source_filesize))
+    # All segments are now in place, so the segments file is no longer needed.
+    if os.path.exists(segments_filepath):
+        os.remove(segments_filepath)
+    return (bytes_read[0], md5_state['md5'].hexdigest())
+
+def download_file_from_url(file_url, dest_dir, resume_download=True, num_connections=1):
     # Some of the code used in this procedure was downloaded and modified for our needs.
     # That code was at: http://code.activestate.com/recipes/83208-resuming-download-of-a-file/
     # Given a file_url, downloads that file to dest_dir.
@@ -382,76 +1078,135 @@ def download_file_from_url(file_url, dest_dir, resume_download=True):
     # If resume_download is True (the default), the function will attempt to resume the download where it left off,
     # if, for example, a previous download was interupted.
     # If resume_download is False, any existing download of the file is deleted and a new download is started.
+    # If num_connections is greater than 1 and the server accepts byte range requests,
+    # the file is downloaded in segments over that many simultaneous connections.
+    # Otherwise it is downloaded as a single stream.
+    # The md5sum of the file is computed as the bytes arrive, so the file does not
+    # need to be read again to check it. When a download is resumed, 
+    # only the bytes that were already on disk are read back to compute the md5sum.
+    # The md5sum of each segment of the file is also recorded in a segments file as the segment lands.
+    # When a download is resumed, the bytes already on disk are checked against those md5sums,
+    # and it is resumed from the end of the last intact segment, so a damaged tail is downloaded again.
+    #
+    # Returns a tuple of the full path of the downloaded file and its md5sum.
     
-    # DOWNLOAD_BLOCK_SIZE = 65536 # 64KB. Old number was 8192 or 8KB.
-    DOWNLOAD_BLOCK_SIZE = 1048576 # 1 MB
     download_complete = False
     existing_size = 0
     bytes_read = 0
-    file_retriever = resumable_URL_opener()
+    md5sum = None
     dest_filename = os.path.basename(file_url)
     dest_fullpath = os.path.join(dest_dir, dest_filename)
+    segments_filepath = "{:s}.{:s}".format(dest_fullpath, _DownloadSegmentsFile)
     source_filesize = size_of_file_at(file_url)
     print "Downloading {:s}\nSize of the file is {:d}".format(file_url, source_filesize)
     print "Destination file for the download is {:s}".format(dest_fullpath)
     sys.stdout.flush()
 
-    # If the file exists and resume_download is requested, then only download the remainder
-    if resume_download and os.path.exists(dest_fullpath):
-        existing_size = os.path.getsize(dest_fullpath)
-        #If the file exists, but we already have the whole thing, don't download again
-        print "The destination file exists and is {:d} bytes in size.".format(existing_size)
-        if (source_filesize == existing_size):
-            print "The file has already been completely downloaded:\n\t{:s}".format(dest_fullpath)
-            download_complete = True
-        else:
-            header = "Range","bytes={:s}-".format(str(existing_size))
-            print "Adding header to resume download:\n\t{:s}".format(header)
-            file_retriever.addheader("Range","bytes={:s}-".format(str(existing_size)))
-        # We open even if download is complete, to avoid adding code to determine whether to close.
-        output_file = open(dest_fullpath,"ab")
-    else:
-        if os.path.exists(dest_fullpath):
-            print "The destination file exists:\n\t{:s}".format(dest_fullpath)
-            print "However a new download has been requested."
-            print "The download will overwrite the existing file."
-        else:
-            print "The destination file does not exist yet."
-        existing_size = 0
-        output_file = open(dest_fullpath,"wb")
-    sys.stdout.flush()
-
-    try:
-        # Check whether there is enough space on the device for the rest of the file to download.
+    if (num_connections > 1) and server_accepts_byte_ranges(file_url):
+        # Check whether there is enough space on the device for the whole file.
+        # Ranges already downloaded are within the preallocated file, so the whole size is needed.
         statvfs = os.statvfs(dest_dir)
-        num_avail_bytes = statvfs.f_frsize * statvfs.f_bavail    
-        # num_avail_bytes is the number of free bytes that ordinary users
-        # are allowed to use (excl. reserved space)
-        # Perhaps should subtract some padding amount from num_avail_bytes
-        # rather than raising only if there is less than exactly what is needed.
-        if (num_avail_bytes < (source_filesize-existing_size)):
+        num_avail_bytes = statvfs.f_frsize * statvfs.f_bavail
+        if os.path.exists(dest_fullpath):
+            num_avail_bytes += os.path.getsize(dest_fullpath)
+        if (num_avail_bytes < source_filesize):
             raise OSError("There is insufficient space ({:s} bytes)".format(str(num_avail_bytes)) + \
                           " on the device of the destination directory for the download: " + \
-                          "{:s}".format(cannonical_destination))
-        
-        source_file = file_retriever.open(file_url)
-        while not download_complete:
-            data = source_file.read(DOWNLOAD_BLOCK_SIZE)
-            if data:
-                output_file.write(data)
-                bytes_read = bytes_read + len(data)
-            else:
+                          "{:s}".format(dest_dir))
+        bytes_read, md5sum = download_file_in_segments(file_url, dest_fullpath, source_filesize, \
+                                                       num_connections, resume_download)
+    else:
+        if num_connections > 1:
+            print "The server does not accept byte range requests, so the file will be downloaded as a single stream."
+        md5_object = hashlib.md5()
+        previous_bytes_hashed = False
+        # If the file exists and resume_download is requested, then only download the remainder
+        if resume_download and os.path.exists(dest_fullpath):
+            existing_size = os.path.getsize(dest_fullpath)
+            print "The destination file exists and is {:d} bytes in size.".format(existing_size)
+            if os.path.exists(segments_filepath):
+                # Keep only the bytes up to the end of the last intact segment.
+                print "Verifying the segments previously downloaded."
+                sys.stdout.flush()
+                intact_segments, md5_object, verified_size = \
+                    verify_segments(dest_fullpath, read_completed_segments(segments_filepath), md5_object)
+                if verified_size < existing_size:
+                    print "Only the first {:d} bytes could be verified. ".format(verified_size) + \
+                          "The rest of the file will be downloaded again."
+                    with open(dest_fullpath, "r+b") as damaged_file:
+                        damaged_file.truncate(verified_size)
+                    existing_size = verified_size
+                write_completed_segments(segments_filepath, \
+                    dict([(segment, md5sum) for segment, md5sum in intact_segments.items() if segment[1] < verified_size]))
+                previous_bytes_hashed = True
+            #If the file exists, but we already have the whole thing, don't download again
+            if (source_filesize == existing_size):
+                print "The file has already been completely downloaded:\n\t{:s}".format(dest_fullpath)
                 download_complete = True
-        source_file.close()
-    except IOError:
-        print "Error while attempting to download {:s}".format(file_url)
+            else:
+                print "Resuming the download from byte {:d}.".format(existing_size)
+            # We open even if download is complete, to avoid adding code to determine whether to close.
+            output_file = open(dest_fullpath,"ab")
+        else:
+            if os.path.exists(dest_fullpath):
+                print "The destination file exists:\n\t{:s}".format(dest_fullpath)
+                print "However a new download has been requested."
+                print "The download will overwrite the existing file."
+            else:
+                print "The destination file does not exist yet."
+            if os.path.exists(segments_filepath):
+                os.remove(segments_filepath)
+            existing_size = 0
+            output_file = open(dest_fullpath,"wb")
         sys.stdout.flush()
-        raise
-    finally:
-        output_file.close()
-    
-    for k,v in source_file.headers.items():
-        print k, "=",v
+        if (existing_size > 0) and not previous_bytes_hashed:
+            # hashlib cannot save its state between runs, so the bytes from the
+            # previous download are hashed before the rest of the file is downloaded.
+            # They were downloaded without a segments file, so they cannot be verified.
+            print "Computing the md5sum of the {:d} bytes previously downloaded.".format(existing_size)
+            sys.stdout.flush()
+            update_md5_from_file(md5_object, dest_fullpath, 0, existing_size - 1)
+        segment_recorder = segment_md5_recorder(segments_filepath, output_file, existing_size)
+
+        try:
+            # Check whether there is enough space on the device for the rest of the file to download.
+            statvfs = os.statvfs(dest_dir)
+            num_avail_bytes = statvfs.f_frsize * statvfs.f_bavail    
+            # num_avail_bytes is the number of free bytes that ordinary users
+            # are allowed to use (excl. reserved space)
+            # Perhaps should subtract some padding amount from num_avail_bytes
+            # rather than raising only if there is less than exactly what is needed.
+            if (num_avail_bytes < (source_filesize-existing_size)):
+                raise OSError("There is insufficient space ({:s} bytes)".format(str(num_avail_bytes)) + \
+                              " on the device of the destination directory for the download: " + \
+                              "{:s}".format(dest_dir))
+            
+            meter = ctat_transfer.progress_meter("download", file_url, source_filesize, existing_size)
+            if not download_complete:
+                # A dropped connection is resumed by the stream, from the byte where it stopped.
+                with ctat_transfer.transfer_slot(file_url) as slot:
+                    source_file = ctat_transfer.resumable_download_stream(file_url, existing_size, slot, meter)
+                    try:
+                        while not download_complete:
+                            data = source_file.read(_DownloadBlockSize)
+                            if data:
+                                output_file.write(data)
+                                md5_object.update(data)
+                                segment_recorder.update(data)
+                                bytes_read = bytes_read + len(data)
+                            else:
+                                download_complete = True
+                    finally:
+                        source_file.close()
+            segment_recorder.record_segment()
+            meter.finish()
+        except ctat_transfer.TransferErrors:
+            print "Error while attempting to download {:s}".format(file_url)
+            sys.stdout.flush()
+            raise
+        finally:
+            output_file.close()
+        md5sum = md5_object.hexdigest()
     print "Downloaded {:s} bytes from {:s}".format(str(bytes_read), str(file_url))
     dest_filesize = os.path.getsize(dest_fullpath)
     print "{:s} {:s}".format(str(dest_filesize), str(dest_fullpath))
@@ -461,63 +1216,114 @@ def download_file_from_url(file_url, dest_dir, resume_download=True):
             "The source file\n\t\t{:d}\t{:s}\n\t".format(source_filesize, file_url) + \
             "and the destination file\n\t\t{:d}\t{:s}\n\t".format(dest_filesize, dest_fullpath) + \
             "are different sizes.")
-    return dest_fullpath
-
-def ensure_we_can_write_numbytes_to(destination, numbytes):
-    # Attempts to create the destination directory if it does not exist.
-    # Tests whether a file can be written to that directory.
-    # Tests whether there is numbytes space on the device of the destination.
-    # Raises errors if it cannot do any of the above.
-    #
-    # Returns the full specification of the destination path. 
-    # We want to make sure that destination is an absolute fully specified path.
-    cannonical_destination = os.path.realpath(destination)
-    if os.path.exists(cannonical_destination):
-        if not os.path.isdir(cannonical_destination):
-            raise ValueError("The destination is not a directory: " + \
-                             "{:s}".format(cannonical_destination))
-        # else all is good. It is a directory.
-    else:
-        # We need to create it since it does not exist.
-        try:
-            os.makedirs(cannonical_destination)
-        except os.error:
-            print "ERROR: Trying to create the following directory path:"
-            print "\t{:s}".format(cannonical_destination)
-            sys.stdout.flush()
-            raise
-    # Make sure the directory now exists and we can write to it.
-    if not os.path.exists(cannonical_destination):
-        # It should have been created, but if it doesn't exist at this point
-        # in the code, something is wrong. Raise an error.
-        raise OSError("The destination directory could not be created: " + \
-                      "{:s}".format(cannonical_destination))
-    test_writing_filename = "{:s}.{:s}".format(os.path.basename(cannonical_destination), _Write_TestFile)
-    test_writing_filepath = os.path.join(cannonical_destination, test_writing_filename)
+    # The whole file is now in place, so the segments file is no longer needed.
+    if os.path.exists(segments_filepath):
+        os.remove(segments_filepath)
+    return (dest_fullpath, md5sum)
+
+def link_or_copy_file(source_path, dest_path):
+    # Makes dest_path a hard link to source_path, so no space is used and no data is copied.
+    # If that is not possible (e.g. they are on different devices), cp --reflink=auto is used,
+    # which shares the data blocks on filesystems that support copy-on-write, and copies otherwise.
     try:
-        with open(test_writing_filepath, "w") as test_writing_file:
-            test_writing_file.write("Testing writing to this file.")
-        if os.path.exists(test_writing_filepath):
-            os.remove(test_writing_filepath)
-    except IOError:
-        print "The destination directory could not be written into:\n\t" + \
-              "{:s}".format(cannonical_destination)
+        os.link(source_path, dest_path)
+    except OSError as link_error:
+        print "Could not hard link {:s}: {:s}".format(source_path, str(link_error))
+        print "Copying it (using a reflink if the filesystem supports one) to:\n\t{:s}".format(dest_path)
         sys.stdout.flush()
-        raise
-    # Check whether there are numbytes available on cannonical_destination's device.
-    statvfs = os.statvfs(cannonical_destination)
-    # fs_size = statvfs.f_frsize * statvfs.f_blocks          # Size of filesystem in bytes
-    # num_free_bytes = statvfs.f_frsize * statvfs.f_bfree    # Actual number of free bytes
-    num_avail_bytes = statvfs.f_frsize * statvfs.f_bavail    # Number of free bytes that ordinary users
-                                                             # are allowed to use (excl. reserved space)
-    if (num_avail_bytes < numbytes):
-        raise OSError("There is insufficient space ({:s} bytes)".format(str(num_avail_bytes)) + \
-                        " on the device of the destination directory:\n\t" + \
-                        "{:s}\n\t{:d} bytes are needed.".format(cannonical_destination, numbytes))
-
-    return cannonical_destination
-
-def download_genome_archive(source_url, destination, force_new_download=False):
+        subprocess.check_call(["cp", "--reflink=auto", source_path, dest_path])
+
+def cached_archive_path(archive_cache_location, md5sum, archive_filename):
+    # Archives in the cache are stored by their md5sum, so the same archive downloaded
+    # from a different url (for example, a mirror) is only stored once.
+    # Each entry is a directory named with the md5sum holding the archive, a file listing the urls
+    # it was downloaded from, and a file whose modification time records when the entry was last used.
+    return os.path.join(os.path.realpath(archive_cache_location), md5sum, archive_filename)
+
+def mark_cache_entry_used(cache_entry_directory):
+    # The last used file is touched rather than the archive itself, 
+    # because the archive may be hard linked into install locations.
+    last_used_filepath = os.path.join(cache_entry_directory, _CacheLastUsedFile)
+    with open(last_used_filepath, "a"):
+        os.utime(last_used_filepath, None)
+
+def cache_entries(cache_location):
+    # Returns a list of (last_used_time, size_in_bytes, entry_directory) for each entry in the cache.
+    # This is used for both the archive cache and the build cache. Entries in both are directories named by an md5sum.
+    entries = list()
+    if not os.path.isdir(cache_location):
+        return entries
+    for entry_name in os.listdir(cache_location):
+        entry_directory = os.path.join(cache_location, entry_name)
+        last_used_filepath = os.path.join(entry_directory, _CacheLastUsedFile)
+        if (len(entry_name) != 32) or not os.path.exists(last_used_filepath):
+            # Not a cache entry, or an entry that is still being added.
+            continue
+        entries.append((os.path.getmtime(last_used_filepath), directory_size_in_bytes(entry_directory), entry_directory))
+    return entries
+
+def cache_lock(cache_location, shared=False):
+    # Returns the lock of the cache at cache_location (see stage_lock). Runs restoring from the cache hold it
+    # shared, and a run removing entries holds it alone, so an entry is never removed while it is being restored.
+    return stage_lock(os.path.join(cache_location, _CacheLockFile), \
+                      "the use of the cache in {:s}".format(cache_location), shared)
+
+def evict_from_cache(cache_location, max_cache_bytes, keep_entry_directory=None):
+    # Removes the least recently used entries from the cache until it holds no more than max_cache_bytes.
+    # The entry in keep_entry_directory (normally the one just added) is never removed.
+    with cache_lock(cache_location):
+        entries = cache_entries(cache_location)
+        cache_bytes = sum([entry[1] for entry in entries])
+        for last_used_time, entry_size, entry_directory in sorted(entries):
+            if cache_bytes <= max_cache_bytes:
+                break
+            if entry_directory == keep_entry_directory:
+                continue
+            print "Removing the least recently used entry from the cache:\n\t{:s}".format(entry_directory)
+            sys.stdout.flush()
+            shutil.rmtree(entry_directory)
+            cache_bytes -= entry_size
+    return cache_bytes
+
+def add_archive_to_cache(archive_filepath, md5sum, source_url, archive_cache_location, max_cache_bytes):
+    # Places a verified archive into the archive cache and then evicts old entries
+    # if the cache is over max_cache_bytes.
+    cache_filepath = cached_archive_path(archive_cache_location, md5sum, os.path.basename(archive_filepath))
+    cache_entry_directory = os.path.dirname(cache_filepath)
+    if not os.path.exists(cache_filepath):
+        if not os.path.isdir(cache_entry_directory):
+            os.makedirs(cache_entry_directory)
+        # Link or copy to a temporary name first, so a partly copied archive is never found in the cache.
+        partial_filepath = "{:s}.partial.{:d}".format(cache_filepath, os.getpid())
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        link_or_copy_file(archive_filepath, partial_filepath)
+        os.rename(partial_filepath, cache_filepath)
+        print "Added the archive to the archive cache:\n\t{:s}".format(cache_filepath)
+    with open(os.path.join(cache_entry_directory, _ArchiveCacheSourceUrlsFile), "a") as source_urls_file:
+        source_urls_file.write("{:s}\n".format(source_url))
+    mark_cache_entry_used(cache_entry_directory)
+    sys.stdout.flush()
+    evict_from_cache(os.path.realpath(archive_cache_location), max_cache_bytes, cache_entry_directory)
+
+def download_genome_archive(source_url, destination, force_new_download=False, \
+                            num_connections=_DefaultNumDownloadConnections, \
+                            archive_cache_location=None, max_cache_bytes=None):
+    # Does locked_download_genome_archive() holding the download lock of the archive in the destination
+    # (see stage_lock), so a second run downloading the same archive to the same destination 
+    # waits for the first one and then uses its download.
+    source_filename = os.path.basename(urlparse.urlparse(source_url).path)
+    cannonical_destination = os.path.realpath(destination)
+    with stage_lock(os.path.join(cannonical_destination, "{:s}.{:s}".format(source_filename, _DownloadLockFile)), \
+                    "the download of {:s}".format(source_filename)) as download_lock:
+        force_new_download = download_lock.still_forced(force_new_download, \
+            os.path.join(cannonical_destination, "{:s}.{:s}".format(source_filename, _DownloadSuccessFile)))
+        return locked_download_genome_archive(source_url, destination, force_new_download, num_connections, \
+                                              archive_cache_location, max_cache_bytes)
+
+def locked_download_genome_archive(source_url, destination, force_new_download=False, \
+                                   num_connections=_DefaultNumDownloadConnections, \
+                                   archive_cache_location=None, max_cache_bytes=None):
     # This function downloads but does not extract the archive at source_url.
     # This function can be called on a file whose download was interrupted, and if force_new_download
     # is False, the download will proceed where it left off.
@@ -536,6 +1342,13 @@ def download_genome_archive(source_url, destination, force_new_download=False):
     #     it is best to send in absolute fully specified path names so you know to where
     #     the source file is going to be copied.
     # force_new_download if True, will cause a new download to occur, even if the file has been downloaded previously.
+    # num_connections is the number of simultaneous connections used to download the file.
+    # archive_cache_location, if set, is a directory holding previously downloaded archives.
+    #     If the archive with the md5sum given on the web is in the cache, it is linked into the
+    #     destination rather than downloaded. Otherwise, after it is downloaded and its md5sum checked,
+    #     it is added to the cache and the least recently used archives are removed from the cache
+    #     until it holds no more than max_cache_bytes.
+    #     force_new_download skips the look up in the cache.
     #
     # Returns the canonical path to the file that was downloaded.
     
@@ -553,13 +1366,17 @@ def download_genome_archive(source_url, destination, force_new_download=False):
     sys.stdout.flush()
     # The next is done so that if the source_url does not have a genome name in it, an error will be raised.
     find_genome_name_in_path(source_url, raise_error=True)
-    cannonical_destination = ensure_we_can_write_numbytes_to(destination, size_of_file_at(source_url))
+    source_filesize = size_of_file_at(source_url)
+    download_success_filename = "{:s}.{:s}".format(source_filename, _DownloadSuccessFile)
+    # No space is needed when the archive was already downloaded, e.g. by another run this one waited for.
+    already_downloaded = (not force_new_download) and \
+        os.path.exists(os.path.join(os.path.realpath(destination), download_success_filename))
+    cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, 0 if already_downloaded else source_filesize)
     
     # Get the list of files in the directory,
     # We use it to check for a previous download.
     orig_files_in_destdir = set(os.listdir(cannonical_destination))
     # See whether the file has been downloaded already.
-    download_success_filename = "{:s}.{:s}".format(source_filename, _DownloadSuccessFile)
     download_success_full_file_path = os.path.join(cannonical_destination, download_success_filename)
     if ((download_success_filename not in orig_files_in_destdir) \
         or force_new_download):    
@@ -568,28 +1385,49 @@ def download_genome_archive(source_url, destination, force_new_download=False):
             # the success file needs to be removed
             # until the download has succeeded.
             os.remove(download_success_full_file_path)
-        # The following raises an error if the download fails for some reason.
-        dest_fullpath = download_file_from_url(source_url, cannonical_destination, \
-                                               resume_download=(not force_new_download))
-        # Check the md5sum of the cannonical_destination file to ensure the data in the file is correct.
-        file_retriever = resumable_URL_opener()
-        md5_url = "{:s}.md5".format(source_url)
-        print "Checking the md5sum of the downloaded file."
-        try:
-            md5_file = file_retriever.open(md5_url, "r")
-            md5sum_from_web = md5_file.readlines()[0].strip().split()[0]
-            md5_file.close()
-            md5sum_from_file = md5sum_for(dest_fullpath)
-        except IOError:
-            print "Error while attempting to check the md5sum for {:s}".format(dest_fullpath)
-            sys.stdout.flush()
-            raise        
-        if md5sum_from_web != md5sum_from_file:
-            raise IOError("Download error:\n\t" + \
-                          "The md5 sum for\n\t\t({:s})\n\t".format(dest_fullpath) + \
-                          "does not match the value read from the web:\n\t\t" + \
-                          "({:s} != {:s})".format(md5sum_from_file, md5sum_from_web))
-        print "Check of md5sum succeeded."
+        dest_fullpath = os.path.join(cannonical_destination, os.path.basename(source_url))
+        if force_new_download and os.path.exists(dest_fullpath):
+            # The existing file might be a hard link to an archive in the archive cache,
+            # so it is removed rather than overwritten in place.
+            os.remove(dest_fullpath)
+        cached_archive = None
+        if (archive_cache_location is not None) and (archive_cache_location != "") and not force_new_download:
+            md5sum_from_web = md5sum_from_web_for(source_url)
+            cached_archive = cached_archive_path(archive_cache_location, md5sum_from_web, os.path.basename(source_url))
+            # The cache lock is held shared while the archive is linked, so it is not evicted part way through.
+            with cache_lock(os.path.realpath(archive_cache_location), shared=True):
+                if (not os.path.exists(cached_archive)) or (os.path.getsize(cached_archive) != source_filesize):
+                    cached_archive = None
+                else:
+                    print "The archive was found in the archive cache:\n\t{:s}".format(cached_archive)
+                    sys.stdout.flush()
+                    if os.path.exists(dest_fullpath):
+                        os.remove(dest_fullpath)
+                    link_or_copy_file(cached_archive, dest_fullpath)
+                    mark_cache_entry_used(os.path.dirname(cached_archive))
+        if cached_archive is None:
+            # The following raises an error if the download fails for some reason.
+            dest_fullpath, md5sum_from_file = download_file_from_url(source_url, cannonical_destination, \
+                                                                     resume_download=(not force_new_download), \
+                                                                     num_connections=num_connections)
+            # Check the md5sum of the cannonical_destination file to ensure the data in the file is correct.
+            # The md5sum of the file was computed by download_file_from_url() as the file was downloaded.
+            print "Checking the md5sum of the downloaded file."
+            try:
+                md5sum_from_web = md5sum_from_web_for(source_url)
+            except IOError:
+                print "Error while attempting to check the md5sum for {:s}".format(dest_fullpath)
+                sys.stdout.flush()
+                raise        
+            if md5sum_from_web != md5sum_from_file:
+                raise IOError("Download error:\n\t" + \
+                              "The md5 sum for\n\t\t({:s})\n\t".format(dest_fullpath) + \
+                              "does not match the value read from the web:\n\t\t" + \
+                              "({:s} != {:s})".format(md5sum_from_file, md5sum_from_web))
+            print "Check of md5sum succeeded."
+            if (archive_cache_location is not None) and (archive_cache_location != ""):
+                add_archive_to_cache(dest_fullpath, md5sum_from_web, source_url, \
+                                     archive_cache_location, max_cache_bytes)
         create_success_file(download_success_full_file_path, \
                             "Download of:\n\t{:s}\n".format(source_url) + \
                             "to:\n\t{:s}\nsucceeded.".format(dest_fullpath))
@@ -613,14 +1451,190 @@ def download_genome_archive(source_url, destination, force_new_download=False):
     
     return dest_fullpath
 
-def extract_archive(archive_filepath, destination, force_new_extraction=False):
+def archive_compression_type(archive_filepath):
+    # Returns _DECOMPRESSION_PIGZ for gzip files, _DECOMPRESSION_ZSTD for zstd files
+    # and None for anything else, based on the first bytes of the file.
+    with open(archive_filepath, "rb") as archive_file:
+        magic_number = archive_file.read(len(_ZstdMagicNumber))
+    if magic_number.startswith(_GzipMagicNumber):
+        return _DECOMPRESSION_PIGZ
+    elif magic_number == _ZstdMagicNumber:
+        return _DECOMPRESSION_ZSTD
+    return None
+
+def decompression_command_for(archive_filepath, decompression_backend=_DECOMPRESSION_AUTO, num_threads=1):
+    # Returns the command (as a list) that decompresses archive_filepath to stdout
+    # using the requested decompression_backend, or None if tarfile should do the decompression.
+    # With _DECOMPRESSION_AUTO, pigz is used for gzip archives and zstd for zstd archives,
+    # when those programs are in the PATH.
+    # If the requested program is not in the PATH, or does not handle this kind of archive,
+    # this falls back to tarfile, except for zstd archives, which tarfile cannot read.
+    # A zstd archive can only be extracted with zstd, so a ValueError is raised if zstd will not be used.
+    if decompression_backend not in _DecompressionBackends:
+        raise ValueError("Unknown decompression backend: {:s}".format(str(decompression_backend)))
+    compression_type = archive_compression_type(archive_filepath)
+    if (compression_type == _DECOMPRESSION_ZSTD) and \
+        (decompression_backend not in (_DECOMPRESSION_AUTO, _DECOMPRESSION_ZSTD)):
+        raise ValueError("The {:s} decompression backend cannot read zstd archives. ".format(decompression_backend) + \
+                         "Use the zstd (or auto) backend to extract:\n\t{:s}".format(archive_filepath))
+    if decompression_backend == _DECOMPRESSION_TARFILE:
+        return None
+    if (compression_type is None) or \
+        (decompression_backend not in (_DECOMPRESSION_AUTO, compression_type)):
+        print "The {:s} decompression backend cannot be used on:\n\t{:s}".format(decompression_backend, archive_filepath)
+        print "Falling back to tarfile."
+        sys.stdout.flush()
+        return None
+    if which(compression_type) is None:
+        if compression_type == _DECOMPRESSION_ZSTD:
+            raise ValueError("The zstd program must be in the PATH to extract:\n\t{:s}".format(archive_filepath))
+        print "Could not find {:s} in the PATH. Falling back to tarfile.".format(compression_type)
+        sys.stdout.flush()
+        return None
+    if compression_type == _DECOMPRESSION_PIGZ:
+        # pigz inflates on one thread, but reads, writes and checks the crc on other threads,
+        # so decompression runs as a pipeline rather than all on one core.
+        return ["pigz", "--decompress", "--stdout", "--processes", str(num_threads), archive_filepath]
+    else:
+        # zstd decompresses on a single thread, but at several times the speed of gzip,
+        # and still runs in parallel with the writing of the files.
+        return ["zstd", "--decompress", "--stdout", "--quiet", archive_filepath]
+
+class preallocating_TarFile(tarfile.TarFile):
+    # A TarFile that reserves the space for each regular file before writing it,
+    # so files are laid out contiguously and a full disk is found before the data is written.
+    # makefile() is the method tarfile uses to write the data of a regular file member.
+    # If meter is set to a progress_meter, the bytes of each file written are counted by it.
+    # If manifest_members is set to a list, the (size, type, name) of each member extracted is added to it,
+    # so the manifest of the archive is made by the extraction itself (see write_archive_manifest()).
+    meter = None
+    manifest_members = None
+    def extract(self, member, path=""):
+        if self.manifest_members is not None:
+            self.manifest_members.append(manifest_member(member))
+        tarfile.TarFile.extract(self, member, path)
+
+    def makefile(self, tarinfo, targetpath):
+        if (getattr(tarinfo, "sparse", None) is not None) or (tarinfo.size == 0):
+            tarfile.TarFile.makefile(self, tarinfo, targetpath)
+        else:
+            with open(targetpath, "wb") as target:
+                preallocate_file_space(target.fileno(), tarinfo.size)
+                self.fileobj.seek(tarinfo.offset_data)
+                tarfile.copyfileobj(self.fileobj, target, tarinfo.size)
+        if self.meter is not None:
+            self.meter.add(tarinfo.size)
+# End of class preallocating_TarFile
+
+def preallocate_file_space(fileno, numbytes):
+    # Reserves the first numbytes of disk space for the open file fileno, without changing its size.
+    # Python 2's os module does not have fallocate, so the libc function is used when available.
+    # If it is not available, or the filesystem does not support it, nothing is reserved.
+    if (_libc_fallocate is None) or (numbytes <= 0):
+        return
+    if _libc_fallocate(fileno, _FALLOC_FL_KEEP_SIZE, ctypes.c_int64(0), ctypes.c_int64(numbytes)) != 0:
+        error_number = ctypes.get_errno()
+        if error_number == errno.ENOSPC:
+            raise OSError(error_number, "There is insufficient space to write {:d} bytes.".format(numbytes))
+
+def manifest_member(member):
+    # Returns the (size, type, name) of the tarfile member, as kept in the manifest of an archive.
+    if member.isdir():
+        member_type = "d"
+    elif member.isfile():
+        member_type = "f"
+    else:
+        member_type = "l"
+    return (member.size, member_type, member.name)
+
+def archive_manifest_path(archive_filepath):
+    return "{:s}.{:s}".format(archive_filepath, _ArchiveManifestFile)
+
+def read_archive_manifest(archive_filepath):
+    # Returns the manifest previously written by write_archive_manifest() for archive_filepath,
+    # or None if there is none, or it was written for a different version of the archive.
+    # The manifest is a dictionary with the number of files (num_files), the number of bytes
+    # the extracted files will take on disk (num_bytes), and a list of (size, type, name) for each member.
+    manifest_filepath = archive_manifest_path(archive_filepath)
+    if not (os.path.exists(manifest_filepath) and os.path.exists(archive_filepath)):
+        return None
+    with open(manifest_filepath, "r") as manifest_file:
+        header = manifest_file.readline().rstrip("\n").split("\t")
+        if (len(header) != 4) or (int(header[0]) != os.path.getsize(archive_filepath)) \
+            or (int(header[1]) != int(os.path.getmtime(archive_filepath))):
+            return None
+        members = list()
+        for line in manifest_file:
+            size, member_type, name = line.rstrip("\n").split("\t", 2)
+            members.append((int(size), member_type, name))
+    return dict(num_files=int(header[2]), num_bytes=int(header[3]), members=members)
+
+def manifest_totals(members):
+    # Returns the number of files and the number of bytes on disk that extracting
+    # the members, a list of (size, type, name), takes.
+    num_files = 0
+    num_bytes = 0
+    for size, member_type, name in members:
+        # Space on disk is allocated in whole blocks, so round each member up to a whole block.
+        num_bytes += ((size + _FilesystemBlockSize - 1) // _FilesystemBlockSize) * _FilesystemBlockSize
+        if member_type == "d":
+            num_bytes += _FilesystemBlockSize
+        elif member_type == "f":
+            num_files += 1
+    return (num_files, num_bytes)
+
+def write_archive_manifest(archive_filepath, members):
+    # Saves the manifest of archive_filepath next to it, from the list of (size, type, name) of its members
+    # recorded while extracting it, so the next extraction knows exactly how much space it needs.
+    # Returns the manifest as described in read_archive_manifest().
+    num_files, num_bytes = manifest_totals(members)
+    manifest_filepath = archive_manifest_path(archive_filepath)
+    with open(manifest_filepath, "w") as manifest_file:
+        manifest_file.write("{:d}\t{:d}\t{:d}\t{:d}\n".format(os.path.getsize(archive_filepath), \
+                            int(os.path.getmtime(archive_filepath)), num_files, num_bytes))
+        for size, member_type, name in members:
+            manifest_file.write("{:d}\t{:s}\t{:s}\n".format(size, member_type, name))
+    print "The archive holds {:d} files, which need {:d} bytes when extracted.".format(num_files, num_bytes)
+    sys.stdout.flush()
+    return dict(num_files=num_files, num_bytes=num_bytes, members=members)
+
+def directory_size_in_bytes(directory_path, is_excluded=None):
+    # Returns the disk space used by all of the files under directory_path.
+    # Hard links to the same file are only counted once.
+    # If is_excluded is given, the files and directories in the top level of directory_path
+    # for whose names it returns True are not counted.
+    num_bytes = 0
+    seen_inodes = set()
+    for dirpath, dirnames, filenames in os.walk(directory_path):
+        if (dirpath == directory_path) and (is_excluded is not None):
+            dirnames[:] = [dirname for dirname in dirnames if not is_excluded(dirname)]
+            filenames = [filename for filename in filenames if not is_excluded(filename)]
+        for filename in filenames + dirnames:
+            file_stat = os.lstat(os.path.join(dirpath, filename))
+            if (file_stat.st_dev, file_stat.st_ino) not in seen_inodes:
+                seen_inodes.add((file_stat.st_dev, file_stat.st_ino))
+                num_bytes += file_stat.st_blocks * 512
+    return num_bytes
+
+def extract_archive(archive_filepath, destination, force_new_extraction=False, \
+                    decompression_backend=_DECOMPRESSION_AUTO, decompression_threads=1):
     # Generic function will use tarfile object to extract the given archive_filepath
     # to the destination. If a file indicating a previous successful extraction exists
     # the file is not extracted again unless force_new_extraction is True.
     # This procedure does not write the extraction success file, because some error checking
     # is dependant on the file being extracted. The calling procedure can/should write the 
     # success file after doing error checking.
-    cannonical_destination = ensure_we_can_write_numbytes_to(destination, bytes_needed_to_extract(archive_filepath))
+    # decompression_backend selects the program used to decompress the archive 
+    # (see decompression_command_for()), using up to decompression_threads threads.
+    # When an external program does the decompression, tarfile reads the tar stream 
+    # from its output, so decompression and writing of the files happen at the same time.
+    # The space needed is taken from the archive's manifest, if it was extracted before, and otherwise estimated.
+    # The manifest is written from the members as they are extracted, so the archive is only decompressed once.
+    if already_extracted(archive_filepath, destination, force_new_extraction):
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, 0)
+    else:
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, \
+            bytes_needed_to_extract(archive_filepath))
     
     # Create the name of the file used to indicate prior success of the file's extraction.
     extraction_success_filename = "{:s}.{:s}".format(os.path.basename(archive_filepath), _ExtractionSuccessFile)
@@ -636,8 +1650,37 @@ def extract_archive(archive_filepath, destination, force_new_extraction=False):
             # the success file needs to be removed
             # until the extraction has succeeded.
             os.remove(extraction_success_full_file_path)
-        with tarfile.open(archive_filepath, mode="r:*") as archive_file:
-            archive_file.extractall(path=cannonical_destination)
+        command = decompression_command_for(archive_filepath, decompression_backend, decompression_threads)
+        # The meter counts the bytes of the extracted files, against the total from the manifest.
+        manifest = read_archive_manifest(archive_filepath)
+        meter = ctat_transfer.progress_meter("extraction", archive_filepath, \
+                               sum([member[0] for member in manifest["members"]]) if manifest else None)
+        manifest_members = list()
+        if command is None:
+            with preallocating_TarFile.open(archive_filepath, mode="r:*") as archive_file:
+                archive_file.meter = meter
+                archive_file.manifest_members = manifest_members
+                archive_file.extractall(path=cannonical_destination)
+        else:
+            print "Decompressing the archive with the following command:\n\t{:s}".format(" ".join(command))
+            sys.stdout.flush()
+            decompressor = subprocess.Popen(command, stdout=subprocess.PIPE)
+            try:
+                with preallocating_TarFile.open(fileobj=decompressor.stdout, mode="r|") as archive_file:
+                    archive_file.meter = meter
+                    archive_file.manifest_members = manifest_members
+                    archive_file.extractall(path=cannonical_destination)
+            finally:
+                decompressor.stdout.close()
+                returncode = decompressor.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, " ".join(command))
+        meter.finish()
+        # Only an extraction that read the whole archive without error gives its manifest.
+        if manifest is None:
+            manifest = write_archive_manifest(archive_filepath, manifest_members)
+        # The manifest goes when the archive is removed, so the size is also recorded by the archive's name.
+        record_extraction_size(archive_filepath, manifest['num_files'], manifest['num_bytes'])
     elif (extraction_success_filename in orig_files_in_destination):
         # The archive was successfully extracted before so we do not do it again.
         print "The extraction success file exists, so no new extraction was attempted:"
@@ -656,11 +1699,157 @@ def extract_archive(archive_filepath, destination, force_new_extraction=False):
     sys.stdout.flush()
     return
 
-def extract_genome_file(archive_filepath, destination, force_new_extraction=False, keep_archive=False):
+def read_extracted_members(checkpoint_filepath):
+    # The checkpoint file written by stream_extract_archive() has one line per extracted member.
+    # Each line holds the size of the member and its name, separated by a tab.
+    # Returns a dictionary of member names to sizes.
+    extracted_members = dict()
+    if os.path.exists(checkpoint_filepath):
+        with open(checkpoint_filepath, "r") as checkpoint_file:
+            for line in checkpoint_file:
+                if not line.endswith("\n"):
+                    # The last line was not completely written, so that member is not done.
+                    break
+                fields = line.rstrip("\n").split("\t", 1)
+                if len(fields) == 2 and fields[0].isdigit():
+                    extracted_members[fields[1]] = int(fields[0])
+    return extracted_members
+
+def stream_extract_archive(source_url, destination, force_new_extraction=False):
+    # Extracts the archive at source_url into destination as it is downloaded,
+    # so the archive is never written to disk.
+    # Like extract_archive(), if a file indicating a previous successful extraction exists
+    # the archive is not extracted again unless force_new_extraction is True,
+    # and this procedure does not write the extraction success file.
+    #
+    # As each member is extracted, it is recorded in a checkpoint file in the destination.
+    # A gzip stream cannot be restarted part way through, so when an interrupted extraction is 
+    # resumed the archive is streamed again from the start, but members that were previously
+    # extracted are skipped over rather than written again.
+    # The md5sum of the stream is computed as it is read and checked against the .md5 file on the web.
+    # If they do not match, an IOError is raised and the checkpoint file is removed,
+    # so the next attempt will write every member again.
+    if already_extracted(source_url, destination, force_new_extraction):
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, 0)
+    else:
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, bytes_needed_to_extract(source_url))
+    archive_filename = archive_filename_of(source_url)
+    extraction_success_filename = "{:s}.{:s}".format(archive_filename, _ExtractionSuccessFile)
+    extraction_success_full_file_path = os.path.join(cannonical_destination, extraction_success_filename)
+    checkpoint_filepath = os.path.join(cannonical_destination, \
+                                       "{:s}.{:s}".format(archive_filename, _ExtractedMembersFile))
+
+    orig_files_in_destination = set(os.listdir(cannonical_destination))
+    if ((extraction_success_filename not in orig_files_in_destination) \
+        or force_new_extraction):
+        if (extraction_success_filename in orig_files_in_destination):
+            # Since we are redoing the extraction, 
+            # the success file needs to be removed
+            # until the extraction has succeeded.
+            os.remove(extraction_success_full_file_path)
+        if force_new_extraction and os.path.exists(checkpoint_filepath):
+            os.remove(checkpoint_filepath)
+        extracted_members = read_extracted_members(checkpoint_filepath)
+        if len(extracted_members) > 0:
+            print "Resuming the extraction. {:d} members were previously extracted.".format(len(extracted_members))
+        print "Extracting the archive as it is downloaded from:\n\t{:s}".format(source_url)
+        sys.stdout.flush()
+        num_members_skipped = 0
+        # Every member is listed, including those skipped, so the size of the whole extraction can be recorded.
+        manifest_members = list()
+        # The download is resumed where it stopped if the connection drops, so the stream is not started over.
+        with ctat_transfer.transfer_slot(source_url) as slot, \
+             contextlib.closing(ctat_transfer.resumable_download_stream(source_url, slot=slot)) as source_file:
+            source_stream = md5_computing_reader(source_file, ctat_transfer.progress_meter("download", source_url, \
+                                                 ctat_transfer.size_of(source_url)))
+            with tarfile.open(fileobj=source_stream, mode="r|*") as archive_file, \
+                 open(checkpoint_filepath, "a") as checkpoint_file:
+                for member in archive_file:
+                    manifest_members.append(manifest_member(member))
+                    member_path = os.path.join(cannonical_destination, member.name)
+                    if (not member.isdir()) and (extracted_members.get(member.name) == member.size) \
+                        and os.path.lexists(member_path) \
+                        and ((not member.isfile()) or (os.path.getsize(member_path) == member.size)):
+                        # Extracted by a previous attempt. The data is read past, but not written.
+                        num_members_skipped += 1
+                        continue
+                    archive_file.extract(member, path=cannonical_destination)
+                    checkpoint_file.write("{:d}\t{:s}\n".format(member.size, member.name))
+                    checkpoint_file.flush()
+                    os.fsync(checkpoint_file.fileno())
+            # Read anything after the end of the tar archive so the md5sum covers the whole file.
+            while source_stream.read(_DownloadBlockSize):
+                pass
+            source_stream.meter.finish()
+        print "Read {:d} bytes from {:s}".format(source_stream.bytes_read, source_url)
+        print "{:d} previously extracted members were skipped.".format(num_members_skipped)
+        print "Checking the md5sum of the downloaded stream."
+        sys.stdout.flush()
+        md5sum_from_stream = source_stream.md5.hexdigest()
+        md5sum_from_web = md5sum_from_web_for(source_url)
+        if md5sum_from_web != md5sum_from_stream:
+            os.remove(checkpoint_filepath)
+            raise IOError("Download error:\n\t" + \
+                          "The md5 sum for\n\t\t({:s})\n\t".format(source_url) + \
+                          "does not match the value read from the web:\n\t\t" + \
+                          "({:s} != {:s})".format(md5sum_from_stream, md5sum_from_web))
+        print "Check of md5sum succeeded."
+        os.remove(checkpoint_filepath)
+        # No archive is written to hold a manifest, so only the size of the extraction is kept.
+        num_files, num_bytes = manifest_totals(manifest_members)
+        print "The archive held {:d} files, which needed {:d} bytes when extracted.".format(num_files, num_bytes)
+        sys.stdout.flush()
+        record_extraction_size(source_url, num_files, num_bytes)
+    elif (extraction_success_filename in orig_files_in_destination):
+        # The archive was successfully extracted before so we do not do it again.
+        print "The extraction success file exists, so no new extraction was attempted:"
+        print "\t{:s}".format(extraction_success_full_file_path)
+        print "Remove the success file or set <force new extraction> if you want a new extraction to occur."
+    else:
+        print "stream_extract_archive(): This code should never be printed. Something is wrong."
+    sys.stdout.flush()
+    
+    # Some code to help us if errors occur.
+    print "\n*******************************************************"
+    print "* Finished extraction. Destination directory listing. *"
+    sys.stdout.flush()
+    print_directory_contents(cannonical_destination, 1)
+    print "*******************************************************\n"
+    sys.stdout.flush()
+    return
+
+def extract_genome_file(archive_filepath, destination, force_new_extraction=False, keep_archive=False, \
+                        stream_from_url=False, decompression_backend=_DECOMPRESSION_AUTO, decompression_threads=1):
+    # Does locked_extract_genome_file() holding the extraction lock of the archive in the destination
+    # (see stage_lock), so a second run extracting the same archive to the same destination 
+    # waits for the first one and then uses its extraction.
+    archive_filename = os.path.basename(archive_filepath)
+    cannonical_destination = os.path.realpath(destination)
+    with stage_lock(os.path.join(cannonical_destination, "{:s}.{:s}".format(archive_filename, _ExtractionLockFile)), \
+                    "the extraction of {:s}".format(archive_filename)) as extraction_lock:
+        force_new_extraction = extraction_lock.still_forced(force_new_extraction, \
+            os.path.join(cannonical_destination, "{:s}.{:s}".format(archive_filename, _ExtractionSuccessFile)))
+        return locked_extract_genome_file(archive_filepath, destination, force_new_extraction, keep_archive, \
+                                          stream_from_url, decompression_backend, decompression_threads)
+
+def already_extracted(archive_filepath, destination, force_new_extraction):
+    # Returns True if archive_filepath (a path or a url) was successfully extracted into destination before,
+    # and is not to be extracted again. Then no space is needed for the extraction, and the archive,
+    # which may have been removed after that extraction, is not read to find how much space is needed.
+    extraction_success_filename = "{:s}.{:s}".format(archive_filename_of(archive_filepath), _ExtractionSuccessFile)
+    return (not force_new_extraction) and \
+        os.path.exists(os.path.join(os.path.realpath(destination), extraction_success_filename))
+
+def locked_extract_genome_file(archive_filepath, destination, force_new_extraction=False, keep_archive=False, \
+                               stream_from_url=False, decompression_backend=_DECOMPRESSION_AUTO, \
+                               decompression_threads=1):
     # Extract a CTAT Genome Reference Library archive file.
     # It is best if archive_filepath is an absolute, fully specified filepath, not a relative one.
     # destination is the directory to which the archive will be extracted.
     # force_new_extraction can be used to cause extraction to occur, even if the file was extracted before.
+    # If stream_from_url is True, archive_filepath is the url of the archive, 
+    # which is extracted as it is downloaded.
+    # decompression_backend and decompression_threads are passed on to extract_archive().
     #
     # Returns extracted_directory
     #     The full path of the top level directory that is 
@@ -669,13 +1858,21 @@ def extract_genome_file(archive_filepath, destination, force_new_extraction=Fals
     print "Extracting:\n\t {:s}".format(str(archive_filepath))
     print "to:\n\t{:s}".format(destination)
     sys.stdout.flush()
-    cannonical_destination = ensure_we_can_write_numbytes_to(destination, bytes_needed_to_extract(archive_filepath))
+    if already_extracted(archive_filepath, destination, force_new_extraction):
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, 0)
+    else:
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, \
+            bytes_needed_to_extract(archive_filepath))
     # Get the root filename of the Genome Directory from the source file's name. 
     # That should also be the name of the extracted directory.
     genome_dirname = find_genome_name_in_path(archive_filepath, raise_error=True)
         
     orig_files_in_destination = set(os.listdir(cannonical_destination))
-    extract_archive(archive_filepath, destination, force_new_extraction)
+    if stream_from_url:
+        stream_extract_archive(archive_filepath, destination, force_new_extraction)
+    else:
+        extract_archive(archive_filepath, destination, force_new_extraction, \
+                        decompression_backend, decompression_threads)
     newfiles_in_destdir = set(os.listdir(cannonical_destination)) - orig_files_in_destination
 
     if (genome_dirname not in newfiles_in_destdir):
@@ -718,9 +1915,307 @@ def extract_genome_file(archive_filepath, destination, force_new_extraction=Fals
         # else: # It was removed previously, so we don't need to remove it again.
     return extracted_directory
 
-def get_gmap_success_filename(genome_build_directory):
+def link_or_copy_tree(source_directory, dest_directory, is_excluded=None):
+    # Recreates the directory tree at source_directory in dest_directory, hard linking each file,
+    # so no space is used and no data is copied. If a file cannot be hard linked (e.g. the directories are
+    # on different devices) it is copied with cp --reflink=auto. Existing files in dest_directory are replaced.
+    # is_excluded, if given, is called with the name of each entry in the top level of source_directory,
+    # and the entries it returns True for are left out.
+    printed_copy_message = False
+    for dirpath, dirnames, filenames in os.walk(source_directory):
+        relative_path = os.path.relpath(dirpath, source_directory)
+        target_dirpath = os.path.normpath(os.path.join(dest_directory, relative_path))
+        if (relative_path == ".") and (is_excluded is not None):
+            dirnames[:] = [dirname for dirname in dirnames if not is_excluded(dirname)]
+            filenames = [filename for filename in filenames if not is_excluded(filename)]
+        if not os.path.isdir(target_dirpath):
+            os.makedirs(target_dirpath)
+        # os.walk does not descend into symbolic links to directories. They are recreated as links.
+        linked_dirnames = [dirname for dirname in dirnames if os.path.islink(os.path.join(dirpath, dirname))]
+        for filename in filenames + linked_dirnames:
+            source_path = os.path.join(dirpath, filename)
+            target_path = os.path.join(target_dirpath, filename)
+            if os.path.lexists(target_path):
+                if os.path.isdir(target_path) and not os.path.islink(target_path):
+                    shutil.rmtree(target_path)
+                else:
+                    os.remove(target_path)
+            if os.path.islink(source_path):
+                os.symlink(os.readlink(source_path), target_path)
+                continue
+            try:
+                os.link(source_path, target_path)
+            except OSError as link_error:
+                if not printed_copy_message:
+                    print "Could not hard link {:s}: {:s}".format(source_path, str(link_error))
+                    print "Copying the files (using reflinks if the filesystem supports them) instead."
+                    sys.stdout.flush()
+                    printed_copy_message = True
+                subprocess.check_call(["cp", "--reflink=auto", "--preserve=mode,timestamps", source_path, target_path])
+        dirnames[:] = [dirname for dirname in dirnames if dirname not in linked_dirnames]
+
+def tool_fingerprint(command):
+    # Returns the md5sum of the program that would be run for command, or "not_found".
+    # This identifies the version of the program without having to know how to ask each program for it.
+    # (prep_genome_lib.pl and gmap_build are scripts, so different versions have different contents.)
+    command_path = which(command)
+    if command_path is None:
+        return "not_found"
+    return md5sum_for(os.path.realpath(command_path))
+
+def source_file_md5sums(directory, filenames):
+    # Returns a dictionary mapping each of filenames (in directory) to its md5sum.
+    # The source files are several gigabytes, so their md5sums are recorded in the directory
+    # with the size and modification time of each file, and a file is only hashed again if those changed.
+    # The build and gmap stages ask for the md5sum of ref_genome.fa at the same time, so this is done
+    # under a lock, and the second one finds the md5sum recorded by the first.
+    with _SourceHashesLock:
+        return locked_source_file_md5sums(directory, filenames)
+
+def locked_source_file_md5sums(directory, filenames):
+    # This does the work of source_file_md5sums(), which must be holding _SourceHashesLock.
+    hashes_filepath = os.path.join(directory, "{:s}.{:s}".format(os.path.basename(directory), _SourceHashesFile))
+    recorded_hashes = dict()
+    if os.path.exists(hashes_filepath):
+        with open(hashes_filepath, "r") as hashes_file:
+            for line in hashes_file:
+                fields = line.rstrip("\n").split("\t")
+                if (len(fields) == 4) and fields[1].isdigit() and fields[2].isdigit() and (len(fields[3]) == 32):
+                    recorded_hashes[fields[0]] = (int(fields[1]), int(fields[2]), fields[3])
+    md5sums = dict()
+    hashes_changed = False
+    for filename in filenames:
+        file_stat = os.stat(os.path.join(directory, filename))
+        recorded = recorded_hashes.get(filename)
+        if (recorded is None) or (recorded[0] != file_stat.st_size) or (recorded[1] != int(file_stat.st_mtime)):
+            print "Computing the md5sum of {:s}".format(os.path.join(directory, filename))
+            sys.stdout.flush()
+            recorded = (file_stat.st_size, int(file_stat.st_mtime), md5sum_for(os.path.join(directory, filename)))
+            recorded_hashes[filename] = recorded
+            hashes_changed = True
+        md5sums[filename] = recorded[2]
+    if hashes_changed:
+        try:
+            with open(hashes_filepath + ".tmp", "w") as hashes_file:
+                for filename in sorted(recorded_hashes):
+                    hashes_file.write("{:s}\t{:d}\t{:d}\t{:s}\n".format(filename, *recorded_hashes[filename]))
+            os.rename(hashes_filepath + ".tmp", hashes_filepath)
+        except (IOError, OSError):
+            # The directory may be read only. The md5sums will simply be computed again next time.
+            pass
+    return md5sums
+
+def library_cache_key(genome_source_directory):
+    # Returns a tuple of the key of the library built from genome_source_directory in the build cache,
+    # and a description of what went into the key. The key is the md5sum of the description, which lists
+    # the md5sums of the source files that prep_genome_lib.pl reads and of the programs that build the library.
+    source_filenames = [filename for filename in os.listdir(genome_source_directory) \
+                        if (filename in _BuildSourceFilenames) \
+                           or (filename.split(".")[0] == _CTAT_HumanFusionLib_FilenamePrefix)]
+    md5sums = source_file_md5sums(genome_source_directory, source_filenames)
+    key_description = "".join(["{:s}\t{:s}\n".format(filename, md5sums[filename]) for filename in sorted(md5sums)])
+    for command in _BuildPrograms:
+        key_description += "{:s}\t{:s}\n".format(command, tool_fingerprint(command))
+    return (hashlib.md5(key_description).hexdigest(), key_description)
+
+def gmap_cache_key(genome_fasta_filepath):
+    # Returns a tuple of the key of the gmap index of genome_fasta_filepath in the build cache,
+    # and a description of what went into the key.
+    md5sums = source_file_md5sums(os.path.dirname(genome_fasta_filepath), [os.path.basename(genome_fasta_filepath)])
+    key_description = "{:s}\t{:s}\n".format(_CTAT_RefGenome_Filename, md5sums.values()[0]) + \
+                      "gmap_build\t{:s}\n".format(tool_fingerprint("gmap_build"))
+    return (hashlib.md5(key_description).hexdigest(), key_description)
+
+def is_excluded_from_build_cache(filename):
+    # Returns True for the names of the files in the top level of a genome build directory
+    # that are not made by prep_genome_lib.pl, so they are not stored in the cache with the library.
+    # The gmap index is stored as a separate entry.
+    return (filename == _CTAT_GmapDirname) or (filename == _CTAT_MutationLibDirname) \
+           or filename.startswith("mutation_lib") \
+           or any([filename.endswith("." + marker_filename) for marker_filename in \
+                   (_GmapSuccessFile, _MutationDownloadSuccessFile, _MutationIntegrationSuccessFile, \
+                    _BuildCacheKeyFile, _SourceHashesFile, _Write_TestFile, _LinkedLibraryFile, \
+                    _GmapLockFile, _MutationDownloadLockFile, _MutationIntegrationLockFile)])
+
+def restore_from_build_cache(build_cache_location, cache_key, entry_name, dest_directory):
+    # If the build cache holds an entry for cache_key, links (or copies) its entry_name directory into
+    # dest_directory and returns True. Otherwise returns False.
+    # The cache lock is held shared while the entry is linked, so it is not evicted part way through.
+    cache_location = os.path.realpath(build_cache_location)
+    cache_entry_directory = os.path.join(cache_location, cache_key)
+    cached_directory = os.path.join(cache_entry_directory, entry_name)
+    with cache_lock(cache_location, shared=True):
+        if not (os.path.isdir(cached_directory) and os.path.exists(os.path.join(cache_entry_directory, _CacheLastUsedFile))):
+            return False
+        print "Found a prebuilt copy in the build cache:\n\t{:s}".format(cached_directory)
+        print "Linking it into:\n\t{:s}".format(dest_directory)
+        sys.stdout.flush()
+        mark_cache_entry_used(cache_entry_directory)
+        link_or_copy_tree(cached_directory, dest_directory)
+        # The key is recorded in the destination, to show that its files are shared with the cache
+        # (see release_build_cache_links()).
+        shutil.copyfile(os.path.join(cache_entry_directory, _BuildCacheKeyFile), \
+                        os.path.join(dest_directory, "{:s}.{:s}".format(entry_name, _BuildCacheKeyFile)))
+    return True
+
+def release_build_cache_links(genome_build_directory):
+    # The files of a library restored from the build cache are hard links to the files in the cache,
+    # and those of a library linked from an existing library (see link_existing_library()) 
+    # are hard links to the files of that library.
+    # A library that was built here and then added to the cache shares its files with the cache too.
+    # prep_genome_lib.pl overwrites its output files in place, so before the library is rebuilt,
+    # the files it shares with the cache or the other library are removed, which leaves them unchanged.
+    # Every file with more than one link is removed, whether or not the library is marked as shared,
+    # since libraries built before the markers were written are not marked.
+    key_filepath = os.path.join(genome_build_directory, "{:s}.{:s}".format(_CTAT_Build_dirname, _BuildCacheKeyFile))
+    linked_from_filepath = os.path.join(genome_build_directory, \
+                                        "{:s}.{:s}".format(_CTAT_Build_dirname, _LinkedLibraryFile))
+    marker_filepaths = [filepath for filepath in (key_filepath, linked_from_filepath) if os.path.exists(filepath)]
+    if not os.path.isdir(genome_build_directory):
+        return
+    num_files_removed = 0
+    for dirpath, dirnames, filenames in os.walk(genome_build_directory):
+        if dirpath == genome_build_directory:
+            dirnames[:] = [dirname for dirname in dirnames if not is_excluded_from_build_cache(dirname)]
+            filenames = [filename for filename in filenames if not is_excluded_from_build_cache(filename)]
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if (not os.path.islink(filepath)) and (os.stat(filepath).st_nlink > 1):
+                os.remove(filepath)
+                num_files_removed += 1
+    if num_files_removed > 0:
+        print "Removed the {:d} files the library shares with other copies before rebuilding it.".format(num_files_removed)
+        sys.stdout.flush()
+    for marker_filepath in marker_filepaths:
+        os.remove(marker_filepath)
+
+def add_to_build_cache(built_directory, build_cache_location, cache_key, key_description, entry_name, \
+                       max_cache_bytes, is_excluded=None):
+    # Stores built_directory in the build cache under cache_key, as a directory named entry_name,
+    # unless the cache already has that entry, and then evicts old entries if the cache is over max_cache_bytes.
+    cache_location = os.path.realpath(build_cache_location)
+    cache_entry_directory = os.path.join(cache_location, cache_key)
+    if not os.path.exists(os.path.join(cache_entry_directory, _CacheLastUsedFile)):
+        # Build the entry under a temporary name first, so a partly stored entry is never found in the cache.
+        partial_entry_directory = "{:s}.partial.{:d}".format(cache_entry_directory, os.getpid())
+        if os.path.exists(partial_entry_directory):
+            shutil.rmtree(partial_entry_directory)
+        os.makedirs(partial_entry_directory)
+        link_or_copy_tree(built_directory, os.path.join(partial_entry_directory, entry_name), is_excluded)
+        with open(os.path.join(partial_entry_directory, _BuildCacheKeyFile), "w") as key_file:
+            key_file.write(key_description)
+        mark_cache_entry_used(partial_entry_directory)
+        try:
+            os.rename(partial_entry_directory, cache_entry_directory)
+            print "Added {:s} to the build cache:\n\t{:s}".format(built_directory, cache_entry_directory)
+        except OSError:
+            # Another install added the same entry in the meantime.
+            shutil.rmtree(partial_entry_directory)
+    mark_cache_entry_used(cache_entry_directory)
+    # Like a library restored from the cache, the built directory now shares its files with the cache,
+    # so the key is recorded in it (see release_build_cache_links()).
+    with open(os.path.join(built_directory, "{:s}.{:s}".format(entry_name, _BuildCacheKeyFile)), "w") as key_file:
+        key_file.write(key_description)
+    sys.stdout.flush()
+    evict_from_cache(cache_location, max_cache_bytes, cache_entry_directory)
+
+def device_of(path):
+    # Returns the device of path, or of its nearest existing parent directory if path does not exist yet.
+    path = os.path.realpath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+def existing_library_for(genome_source_directory, genome_build_directory):
+    # Returns the directory of a library that was completely built from genome_source_directory somewhere
+    # other than genome_build_directory, or None if there is none.
+    # The places looked at are the build directory inside the source directory, where the library is built
+    # by default, and the build directory recorded by record_build_size() for the last build.
+    # Only a build that wrote the build success file into the source directory is used,
+    # and a library that was itself linked from another one is not.
+    src_filename = os.path.basename(genome_source_directory)
+    build_success_file_path = os.path.join(genome_source_directory, \
+                                           "{:s}.{:s}".format(src_filename, _LibBuiltSuccessFile))
+    if not os.path.exists(build_success_file_path):
+        return None
+    candidate_directories = [os.path.join(genome_source_directory, _CTAT_Build_dirname)]
+    build_size_filepath = os.path.join(genome_source_directory, "{:s}.{:s}".format(src_filename, _BuildSizeFile))
+    if os.path.exists(build_size_filepath):
+        with open(build_size_filepath, "r") as build_size_file:
+            build_size_lines = build_size_file.read().splitlines()
+        if len(build_size_lines) > 1:
+            candidate_directories.append(build_size_lines[1].strip())
+    for candidate_directory in candidate_directories:
+        candidate_directory = os.path.realpath(candidate_directory)
+        if (candidate_directory != os.path.realpath(genome_build_directory)) \
+           and os.path.exists(os.path.join(candidate_directory, _CTAT_RefGenome_Filename)) \
+           and not os.path.exists(os.path.join(candidate_directory, \
+                                               "{:s}.{:s}".format(_CTAT_Build_dirname, _LinkedLibraryFile))):
+            return candidate_directory
+    return None
+
+def is_rewritten_by_build(filename):
+    # Returns True for the names of the entries in the top level of a built library that prep_genome_lib.pl
+    # writes to, and for the success and marker files this data manager writes into the library.
+    return (filename in _FilesRewrittenByBuild) \
+           or any([filename.startswith(prefix) for prefix in _FilePrefixesRewrittenByBuild]) \
+           or any([filename.endswith("." + marker_filename) for marker_filename in \
+                   (_GmapSuccessFile, _MutationDownloadSuccessFile, _MutationIntegrationSuccessFile, \
+                    _BuildCacheKeyFile, _SourceHashesFile, _LinkedLibraryFile, _LibraryChecksumsFile, \
+                    _GmapLockFile, _MutationDownloadLockFile, _MutationIntegrationLockFile)])
+
+def reflinks_supported(source_directory, dest_directory):
+    # Returns True if a file in source_directory can be copied into dest_directory as a reflink,
+    # that is a copy that shares the data of the original until one of them is written to.
+    test_filepath = os.path.join(dest_directory, \
+                                 "{:s}.{:s}".format(threading.current_thread().name, _Write_TestFile))
+    for filename in os.listdir(source_directory):
+        source_path = os.path.join(source_directory, filename)
+        if os.path.isfile(source_path) and not os.path.islink(source_path):
+            with open(os.devnull, "w") as devnull:
+                supported = subprocess.call(["cp", "--reflink=always", source_path, test_filepath], \
+                                            stdout=devnull, stderr=devnull) == 0
+            if os.path.exists(test_filepath):
+                os.remove(test_filepath)
+            return supported
+    return False
+
+def link_existing_library(library_directory, dest_directory):
+    # Makes dest_directory a copy of the library in library_directory, which must be on the same filesystem,
+    # without copying its data, so registering a library that is already built takes seconds and no space.
+    # If the filesystem supports reflinks (copy on write, e.g. btrfs or xfs), every file is a reflink,
+    # so either library can later be changed without affecting the other.
+    # Otherwise the files are hard links, except for the entries that prep_genome_lib.pl writes to and
+    # the success files (see is_rewritten_by_build()), which are copied. Where the library was linked from 
+    # is recorded in dest_directory, so the shared files are removed before it is rebuilt 
+    # (see release_build_cache_links()). gmap_the_library() and integrate_mutation_resources() remove 
+    # the gmap index and the mutation library before making them again, so those can be shared as well.
+    if reflinks_supported(library_directory, dest_directory):
+        print "Copying the library with reflinks from:\n\t{:s}".format(library_directory)
+        sys.stdout.flush()
+        subprocess.check_call(["cp", "-a", "--reflink=always", os.path.join(library_directory, "."), dest_directory])
+        return
+    print "Hard linking the library from:\n\t{:s}".format(library_directory)
+    sys.stdout.flush()
+    link_or_copy_tree(library_directory, dest_directory, is_rewritten_by_build)
+    for filename in os.listdir(library_directory):
+        if not is_rewritten_by_build(filename):
+            continue
+        source_path = os.path.join(library_directory, filename)
+        target_path = os.path.join(dest_directory, filename)
+        if os.path.isdir(target_path) and not os.path.islink(target_path):
+            shutil.rmtree(target_path)
+        elif os.path.lexists(target_path):
+            os.remove(target_path)
+        subprocess.check_call(["cp", "-a", "--reflink=auto", source_path, target_path])
+    with open(os.path.join(dest_directory, "{:s}.{:s}".format(_CTAT_Build_dirname, _LinkedLibraryFile)), "w") \
+        as linked_from_file:
+        linked_from_file.write("{:s}\n".format(library_directory))
+
+def get_gmap_success_filename(genome_build_directory, marker_filename=_GmapSuccessFile):
     # This function was created because there are two places where the success_filename was being created.
     # Using this function makes sure that the names being used are the same.
+    # The name of the gmap lock file is made the same way, by passing _GmapLockFile as the marker_filename.
     # FIX - We could use a static string like "gmap_build" as the first part of the name, 
     #     rather than the genome name, and maybe that would be more logical. 
     #     The name in that case would not be different in different libraries.
@@ -728,14 +2223,44 @@ def get_gmap_success_filename(genome_build_directory):
     genome_name = find_genome_name_in_path(genome_build_directory)
     if genome_name is None:
         genome_name = os.path.basename(genome_build_directory)
-    return "{:s}.{:s}".format(genome_name, _GmapSuccessFile)
+    return "{:s}.{:s}".format(genome_name, marker_filename)
 
-def gmap_the_library(genome_build_directory, force_new_gmap=False):
+def gmap_the_library(genome_build_directory, force_new_gmap=False, genome_fasta_filepath=None, \
+                     build_cache_location=None, max_cache_bytes=None):
+    # Does locked_gmap_the_library() holding the gmap lock in the genome_build_directory (see stage_lock),
+    # so a second run indexing the same library waits for the first one and then uses its index.
+    gmap_success_filename = get_gmap_success_filename(genome_build_directory)
+    gmap_lock_filepath = os.path.join(genome_build_directory, \
+                                      get_gmap_success_filename(genome_build_directory, _GmapLockFile))
+    with stage_lock(gmap_lock_filepath, \
+                    "the gmap_build of {:s}".format(genome_build_directory)) as gmap_lock:
+        force_new_gmap = gmap_lock.still_forced(force_new_gmap, \
+                                                os.path.join(genome_build_directory, gmap_success_filename))
+        locked_gmap_the_library(genome_build_directory, force_new_gmap, genome_fasta_filepath, \
+                                build_cache_location, max_cache_bytes)
+
+def locked_gmap_the_library(genome_build_directory, force_new_gmap=False, genome_fasta_filepath=None, \
+                            build_cache_location=None, max_cache_bytes=None):
     # This is the processing that needs to happen for the ctat_gmap_fusion tool to work.
     # genome_build_directory should normally be a fully specified path, 
     # though this function should work even if it is relative.
+    # genome_fasta_filepath is the genome that is indexed. By default it is the ref_genome.fa
+    # in the genome_build_directory. When the library is being built from source data at the same time,
+    # the ref_genome.fa of the source data is given instead, since prep_genome_lib.pl
+    # is still in the process of writing the library.
+    # If build_cache_location is set, a gmap index of the same genome made by the same gmap_build
+    # is linked from the build cache instead of being built, and a new index is added to the cache.
     # The gmap_build command prints messages out to stderr, even when there is not an error,
     # so I route stderr to stdout.
+    if genome_fasta_filepath is None:
+        genome_fasta_filepath = os.path.join(genome_build_directory, _CTAT_RefGenome_Filename)
+    if not os.path.exists(genome_build_directory):
+        try:
+            os.makedirs(genome_build_directory)
+        except os.error:
+            # The build of the library, running at the same time, may have just created it.
+            if not os.path.isdir(genome_build_directory):
+                raise
     
     # Create the name of the file used to indicate prior success of gmap.
     gmap_success_filename = get_gmap_success_filename(genome_build_directory)
@@ -750,24 +2275,39 @@ def gmap_the_library(genome_build_directory, force_new_gmap=False):
             # the success file needs to be removed
             # until the gmap has succeeded.
             os.remove(gmap_success_full_file_path)
-        command = "gmap_build -D {:s}/ -d ref_genome.fa.gmap -k 13 {:s}/ref_genome.fa 2>&1".format( \
-        	   genome_build_directory, genome_build_directory)
-        print "Doing a gmap_build with the following command:\n\t{:s}\n".format(command)
-        sys.stdout.flush()
-        try: # to send the gmap_build command.
-            subprocess.check_call(command, shell=True)
-        except subprocess.CalledProcessError:
-            print "ERROR: While trying to run the gmap_build command on the library:\n\t{:s}".format(command)
-            sys.stdout.flush()
-            raise
-        finally:
-            sys.stdout.flush()
-            # Some code to help us if errors occur.
-            print "\n*******************************\nAfter running gmap_build."
-            sys.stdout.flush()
-            print_directory_contents(genome_build_directory, 2)
-            print "*******************************\n"
+        # A previous index is removed rather than overwritten, since its files may be shared with the build cache.
+        gmap_directory = os.path.join(genome_build_directory, _CTAT_GmapDirname)
+        if os.path.exists(gmap_directory):
+            shutil.rmtree(gmap_directory)
+        use_build_cache = (build_cache_location is not None) and (build_cache_location != "")
+        restored_from_cache = False
+        if use_build_cache:
+            cache_key, key_description = gmap_cache_key(genome_fasta_filepath)
+            if not force_new_gmap:
+                restored_from_cache = restore_from_build_cache(build_cache_location, cache_key, \
+                                                               _CTAT_GmapDirname, gmap_directory)
+        if not restored_from_cache:
+            command = "gmap_build -D {:s}/ -d {:s} -k 13 {:s} 2>&1".format( \
+            	   genome_build_directory, _CTAT_GmapDirname, genome_fasta_filepath)
+            print "Doing a gmap_build with the following command:\n\t{:s}\n".format(command)
             sys.stdout.flush()
+            try: # to send the gmap_build command.
+                run_monitored_command(command, shell=True)
+            except subprocess.CalledProcessError:
+                print "ERROR: While trying to run the gmap_build command on the library:\n\t{:s}".format(command)
+                sys.stdout.flush()
+                raise
+            finally:
+                sys.stdout.flush()
+                # Some code to help us if errors occur.
+                print "\n*******************************\nAfter running gmap_build."
+                sys.stdout.flush()
+                print_directory_contents(genome_build_directory, 2)
+                print "*******************************\n"
+                sys.stdout.flush()
+            if use_build_cache:
+                add_to_build_cache(gmap_directory, build_cache_location, cache_key, key_description, \
+                                   _CTAT_GmapDirname, max_cache_bytes)
         create_success_file(gmap_success_full_file_path, \
                     "gmap of:\n\t{:s}\nsucceeded.".format(genome_build_directory))
     elif gmap_success_filename in orig_files_in_build_dir:
@@ -782,13 +2322,39 @@ def gmap_the_library(genome_build_directory, force_new_gmap=False):
 
 def build_the_library(genome_source_directory, \
                       genome_build_directory, force_new_build=False, \
-                      gmap_build=False, force_gmap_build=False):
+                      gmap_build=False, force_gmap_build=False, \
+                      build_cache_location=None, max_cache_bytes=None, link_existing=False):
+    # Does locked_build_the_library() holding the build lock of the source data (see stage_lock).
+    # The lock is in the genome_source_directory, next to the build success file, so a second run building
+    # the same source data waits for the first one and then uses its library.
+    if (genome_source_directory is None) or (genome_source_directory == "" ) or not os.path.exists(genome_source_directory):
+        raise ValueError("Cannot build the CTAT Genome Resource Library. " + \
+                         "The source directory does not exist:\n\t{:s}".format(str(genome_source_directory)))
+    src_filename = os.path.basename(genome_source_directory)
+    with stage_lock(os.path.join(genome_source_directory, "{:s}.{:s}".format(src_filename, _LibBuiltLockFile)), \
+                    "the build of {:s}".format(genome_source_directory)) as build_lock:
+        force_new_build = build_lock.still_forced(force_new_build, \
+            os.path.join(genome_source_directory, "{:s}.{:s}".format(src_filename, _LibBuiltSuccessFile)))
+        locked_build_the_library(genome_source_directory, genome_build_directory, force_new_build, \
+                                 gmap_build, force_gmap_build, build_cache_location, max_cache_bytes, link_existing)
+
+def locked_build_the_library(genome_source_directory, \
+                             genome_build_directory, force_new_build=False, \
+                             gmap_build=False, force_gmap_build=False, \
+                             build_cache_location=None, max_cache_bytes=None, link_existing=False):
     """ genome_source_directory is the location of the source_data needed to build the library.
         Normally it is fully specified, but could be relative.
         genome_build_directory is the location where the library will be built.
         It can be relative to the current working directory or an absolute path.
         build specifies whether to run prep_genome_lib.pl even if it was run before.
 		gmap_build specifies whether to run gmap_build or not.
+        build_cache_location, if set, is a directory of libraries built before, on this or other nodes,
+        keyed by the md5sums of the source files and of the programs that build the library.
+        If it holds the library for genome_source_directory, that library is linked into genome_build_directory
+        instead of running prep_genome_lib.pl, and a library that is built is added to it.
+        If link_existing is True and the source data was already built into a library elsewhere on the
+        same filesystem (see existing_library_for()), genome_build_directory is made from links to
+        that library (see link_existing_library()) instead of running prep_genome_lib.pl.
         The prep_genome_lib.pl command can send messages out to stderr, even when there is not an error,
         so I route stderr to stdout.
 
@@ -805,11 +2371,24 @@ def build_the_library(genome_source_directory, \
 		gmap_build -D ctat_genome_lib_build_dir -d ref_genome.fa.gmap -k 13 ctat_genome_lib_build_dir/ref_genome.fa"
     """
 
-    if (genome_source_directory is None) or (genome_source_directory == "" ) or not os.path.exists(genome_source_directory):
-        raise ValueError("Cannot build the CTAT Genome Resource Library. " + \
-                         "The source directory does not exist:\n\t{:s}".format(str(genome_source_directory)))
-    cannonical_destination = ensure_we_can_write_numbytes_to(genome_build_directory, \
-                                                             bytes_needed_to_build(genome_source_directory))
+    existing_library_directory = None
+    if link_existing and not force_new_build:
+        existing_library_directory = existing_library_for(genome_source_directory, genome_build_directory)
+        if (existing_library_directory is not None) \
+           and (device_of(existing_library_directory) != device_of(genome_build_directory)):
+            print "The library already built at:\n\t{:s}\n".format(existing_library_directory) + \
+                  "is on a different filesystem from the build location, so it cannot be linked."
+            sys.stdout.flush()
+            existing_library_directory = None
+    already_built = (not force_new_build) and os.path.exists(os.path.join(genome_source_directory, \
+        "{:s}.{:s}".format(os.path.basename(genome_source_directory), _LibBuiltSuccessFile)))
+    if (existing_library_directory is not None) or already_built:
+        # Linking uses no space beyond the few files that are copied,
+        # and a library that was already built, e.g. by another run this one waited for, needs none.
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(genome_build_directory, 0)
+    else:
+        cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(genome_build_directory, \
+                                                                 bytes_needed_to_build(genome_source_directory))
     print "Building the CTAT Genome Resource Library from source data at:\n\t{:s}".format(str(genome_source_directory))
     print "The Destination directory is at:\n\t{:s}".format(str(cannonical_destination))
     sys.stdout.flush()
@@ -820,66 +2399,49 @@ def build_the_library(genome_source_directory, \
     files_in_sourcedir = set(os.listdir(genome_source_directory))
     build_success_filename = "{:s}.{:s}".format(src_filename, _LibBuiltSuccessFile)
     build_success_file_path = os.path.join(genome_source_directory, build_success_filename)
-    if (build_success_filename not in files_in_sourcedir) or force_new_build:
-        os.chdir(genome_source_directory)
+    # The build success file is in the source directory, so when the library was built somewhere else,
+    # it is found there even though the build location does not have the library yet.
+    library_needs_linking = (existing_library_directory is not None) \
+        and not os.path.exists(os.path.join(cannonical_destination, _CTAT_RefGenome_Filename))
+    if library_needs_linking:
+        print "The library was already built at:\n\t{:s}".format(existing_library_directory)
+        link_existing_library(existing_library_directory, cannonical_destination)
+        if gmap_build:
+            gmap_the_library(cannonical_destination, force_gmap_build, \
+                             build_cache_location=build_cache_location, max_cache_bytes=max_cache_bytes)
+    elif (build_success_filename not in files_in_sourcedir) or force_new_build:
         if (build_success_filename in files_in_sourcedir):
             # Since we are redoing the build, 
             # the success file needs to be removed
             # until the build has succeeded.
             os.remove(build_success_file_path)
-        # Create the command that builds the Genome Resource Library form the source data.
-        command = "prep_genome_lib.pl --genome_fa ref_genome.fa --gtf ref_annot.gtf " + \
-        	   "--pfam_db PFAM.domtblout.dat.gz " + \
-        	   "--output_dir {:s} ".format(cannonical_destination)
-        found_HumanFusionLib = False
-        HumanFusionLib_filename = "NoFileFound"
-        for filename in os.listdir(genome_source_directory):
-            # At the time this was written, the filename was CTAT_HumanFusionLib.v0.1.0.dat.gz
-            # We only check the prefix, in case other versions are used later.
-            # I assume there is only one in the directory, but if there are more than one, 
-            # the later one, alphabetically, will be used.
-            if filename.split(".")[0] == _CTAT_HumanFusionLib_FilenamePrefix:
-        	found_HumanFusionLib = True
-        	filename_of_HumanFusionLib = filename
-        if found_HumanFusionLib:
-            # The mouse genomes do not have a fusion_annot_lib
-            # so only add the following for Human genomes.
-            command += "--fusion_annot_lib {:s} ".format(filename_of_HumanFusionLib) + \
-        	       "--annot_filter_rule AnnotFilterRule.pm "
-        if gmap_build:
-            command += "--gmap_build "
-        # Send stderr of the command to stdout, because some functions may write to stderr,
-        # even though no error has occurred. We will depend on error code return in order
-        # to know if an error occurred.
-        command += " 2>&1"
-        print "About to run the following command:\n\t{:s}".format(command)
-        sys.stdout.flush()
-        try: # to send the prep_genome_lib command.
-            subprocess.check_call(command, shell=True)
-        except subprocess.CalledProcessError:
-            print "ERROR: While trying to run the prep_genome_lib.pl command " + \
-                  "on the CTAT Genome Resource Library:\n\t{:s}".format(command)
-            raise
-        finally:
-            # Some code to help us if errors occur.
-            print "\n*******************************"
-            print "Contents of Genome Source Directory {:s}:".format(genome_source_directory)
-            sys.stdout.flush()
-            print_directory_contents(genome_source_directory, 2)
-            print "\nContents of Genome Build Directory {:s}:".format(cannonical_destination)
-            sys.stdout.flush()
-            print_directory_contents(cannonical_destination, 2)
-            print "*******************************\n"
-            sys.stdout.flush()
+        use_build_cache = (build_cache_location is not None) and (build_cache_location != "")
+        restored_from_cache = False
+        if use_build_cache:
+            cache_key, key_description = library_cache_key(genome_source_directory)
+            if not force_new_build:
+                restored_from_cache = restore_from_build_cache(build_cache_location, cache_key, \
+                                                               _CTAT_Build_dirname, cannonical_destination)
+        if not restored_from_cache:
+            release_build_cache_links(cannonical_destination)
+            run_prep_genome_lib(genome_source_directory, cannonical_destination, gmap_build)
+            if use_build_cache:
+                add_to_build_cache(cannonical_destination, build_cache_location, cache_key, key_description, \
+                                   _CTAT_Build_dirname, max_cache_bytes, is_excluded_from_build_cache)
+        record_build_size(genome_source_directory, cannonical_destination)
         create_success_file(build_success_file_path, \
                             "Build of:\n\t{:s}\n".format(genome_source_directory) + \
                             "to:\n\t{:s}\nsucceeded.".format(cannonical_destination))
-        if gmap_build:
+        if gmap_build and not restored_from_cache:
             # Create the gmap success file.
             gmap_success_filename = get_gmap_success_filename(cannonical_destination)
             gmap_success_full_file_path = os.path.join(cannonical_destination, gmap_success_filename)
             create_success_file(gmap_success_full_file_path, \
                                 "gmap of:\n\t{:s}\nsucceeded.".format(cannonical_destination))
+        elif gmap_build:
+            # The cached library does not include a gmap index.
+            gmap_the_library(cannonical_destination, force_gmap_build, \
+                             build_cache_location=build_cache_location, max_cache_bytes=max_cache_bytes)
     elif (build_success_filename in files_in_sourcedir):
         print "The build success file exists, so no build is being attempted:"
         print "\t{:s}".format(build_success_file_path)
@@ -888,14 +2450,65 @@ def build_the_library(genome_source_directory, \
         if gmap_build:
             print "Checking if we need to gmap the library."
             sys.stdout.flush()
-            gmap_the_library(cannonical_destination, force_gmap_build)
+            gmap_the_library(cannonical_destination, force_gmap_build, \
+                             build_cache_location=build_cache_location, max_cache_bytes=max_cache_bytes)
             sys.stdout.flush()
             # gmap_the_library creates a gmap success file if it succeeds.
     else:
         print "build_the_library(): This code should never be printed. Something is wrong."
     sys.stdout.flush()
     return
-	# End of build_the_library()
+	# End of locked_build_the_library()
+
+def run_prep_genome_lib(genome_source_directory, cannonical_destination, gmap_build=False):
+    # Runs prep_genome_lib.pl to build the library from the source data in genome_source_directory
+    # into cannonical_destination. This is called by build_the_library().
+    # Create the command that builds the Genome Resource Library form the source data.
+    command = "prep_genome_lib.pl --genome_fa ref_genome.fa --gtf ref_annot.gtf " + \
+               "--pfam_db PFAM.domtblout.dat.gz " + \
+               "--output_dir {:s} ".format(cannonical_destination)
+    found_HumanFusionLib = False
+    HumanFusionLib_filename = "NoFileFound"
+    for filename in os.listdir(genome_source_directory):
+        # At the time this was written, the filename was CTAT_HumanFusionLib.v0.1.0.dat.gz
+        # We only check the prefix, in case other versions are used later.
+        # I assume there is only one in the directory, but if there are more than one, 
+        # the later one, alphabetically, will be used.
+        if filename.split(".")[0] == _CTAT_HumanFusionLib_FilenamePrefix:
+            found_HumanFusionLib = True
+            filename_of_HumanFusionLib = filename
+    if found_HumanFusionLib:
+        # The mouse genomes do not have a fusion_annot_lib
+        # so only add the following for Human genomes.
+        command += "--fusion_annot_lib {:s} ".format(filename_of_HumanFusionLib) + \
+                   "--annot_filter_rule AnnotFilterRule.pm "
+    if gmap_build:
+        command += "--gmap_build "
+    # Send stderr of the command to stdout, because some functions may write to stderr,
+    # even though no error has occurred. We will depend on error code return in order
+    # to know if an error occurred.
+    command += " 2>&1"
+    print "About to run the following command:\n\t{:s}".format(command)
+    sys.stdout.flush()
+    try: # to send the prep_genome_lib command.
+        # The command is run from within the source directory, rather than changing this process's
+        # working directory, because other stages may be running in this process at the same time.
+        run_monitored_command(command, shell=True, cwd=genome_source_directory)
+    except subprocess.CalledProcessError:
+        print "ERROR: While trying to run the prep_genome_lib.pl command " + \
+              "on the CTAT Genome Resource Library:\n\t{:s}".format(command)
+        raise
+    finally:
+        # Some code to help us if errors occur.
+        print "\n*******************************"
+        print "Contents of Genome Source Directory {:s}:".format(genome_source_directory)
+        sys.stdout.flush()
+        print_directory_contents(genome_source_directory, 2)
+        print "\nContents of Genome Build Directory {:s}:".format(cannonical_destination)
+        sys.stdout.flush()
+        print_directory_contents(cannonical_destination, 2)
+        print "*******************************\n"
+        sys.stdout.flush()
 
 def find_path_to_mutation_lib_integration():
     # We are assuming that we exist inside of a conda environment and that the directory that we want
@@ -946,7 +2559,8 @@ def find_path_to_picard_home():
     return picard_home
 	    
 def download_and_integrate_mutation_resources(source_url, genome_build_directory, cosmic_resources_location=None, \
-                                              force_new_download=False, force_new_integration=False):
+                                              force_new_download=False, force_new_integration=False, \
+                                              num_connections=_DefaultNumDownloadConnections):
     # source_url is the url of the mutation resources archive to download.
     # genome_build_dir is the location where the archive will be placed.
     # If cosmic_files_location is set, that is the location where the files are presumed to exist.
@@ -955,6 +2569,7 @@ def download_and_integrate_mutation_resources(source_url, genome_build_directory
     # it will be downloaded again.
     # If force_new_integration is True, the resources will be integrated again, even if there has been a
     # a previous successful integration.
+    # num_connections is the number of simultaneous connections used to download the archive.
     # The ctat-mutation-lib-integration command may print messages out to stderr, even when there is not an error.
     # FIX - However, I forgot to route stderr to stdout as I did with other commands.
     #     I have left it this way for now because I do not want to do another round of testing.
@@ -993,15 +2608,52 @@ def download_and_integrate_mutation_resources(source_url, genome_build_directory
     print "***********************************\n"
     sys.stdout.flush()
     # It is assumed that this procedure is only called with a valid genome_build_directory.
+    mutation_archive_filepath = download_mutation_resources(source_url, genome_build_directory, \
+                                                            force_new_download, num_connections)
+    integrate_mutation_resources(source_url, mutation_archive_filepath, genome_build_directory, \
+                                 cosmic_resources_location, force_new_integration)
+    return
+
+def mutation_resources_url(source_url):
+    # Returns source_url, completed with _CTAT_Mutation_URL if it is only a filename.
     url_parts = urlparse.urlparse(source_url)
-    source_filename = os.path.basename(url_parts.path)
     if url_parts.scheme == "":
         # Then we were given a source_url without a leading https: or similar.
         # Assume we only were given the filename and that it exists at _CTAT_Mutation_URL.
         source_url = urlparse.urljoin(_CTAT_Mutation_URL, source_url)
+    return source_url
+
+def download_mutation_resources(source_url, destination, force_new_download=False, \
+                                num_connections=_DefaultNumDownloadConnections):
+    # Does locked_download_mutation_resources() holding the download lock of the archive in the destination
+    # (see stage_lock), so a second run downloading the same mutation resources to the same destination
+    # waits for the first one and then uses its download.
+    # Returns the full path of the downloaded archive.
+    source_filename = os.path.basename(urlparse.urlparse(mutation_resources_url(source_url)).path)
+    cannonical_destination = os.path.realpath(destination)
+    with stage_lock(os.path.join(cannonical_destination, \
+                                 "{:s}.{:s}".format(source_filename, _MutationDownloadLockFile)), \
+                    "the download of {:s}".format(source_filename)) as download_lock:
+        force_new_download = download_lock.still_forced(force_new_download, os.path.join(cannonical_destination, \
+            "{:s}.{:s}".format(source_filename, _MutationDownloadSuccessFile)))
+        return locked_download_mutation_resources(source_url, destination, force_new_download, num_connections)
+
+def locked_download_mutation_resources(source_url, destination, force_new_download=False, \
+                                       num_connections=_DefaultNumDownloadConnections):
+    # Downloads the mutation resources archive at source_url into destination, 
+    # unless a previous download there succeeded.
+    # The destination need not be the genome build directory. main() downloads the archive into 
+    # the download location while the library is still being built, and integrate_mutation_resources()
+    # then links it into the genome build directory.
+    # Returns the full path of the downloaded archive.
+    source_url = mutation_resources_url(source_url)
+    source_filename = os.path.basename(urlparse.urlparse(source_url).path)
     # FIX - We might want to otherwise check if we have a valid url and/or if we can reach it.
-    cannonical_destination = ensure_we_can_write_numbytes_to(genome_build_directory, _NumBytesNeededForMutationResources)
-    print "Download and Integrate a Mutation Resource Archive."
+    already_downloaded = (not force_new_download) and os.path.exists(os.path.join(os.path.realpath(destination), \
+        "{:s}.{:s}".format(source_filename, _MutationDownloadSuccessFile)))
+    cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(destination, \
+        0 if already_downloaded else _NumBytesNeededForMutationResources)
+    print "Download a Mutation Resource Archive."
     print "The source URL is:\n\t{:s}".format(str(source_url))
     print "The destination is:\n\t{:s}".format(str(cannonical_destination))
     sys.stdout.flush()
@@ -1021,7 +2673,9 @@ def download_and_integrate_mutation_resources(source_url, genome_build_directory
             # until the download has succeeded.
             os.remove(download_success_file_path)
         # The following raises an IOError if the download fails for some reason.
-        archive_fullpath = download_file_from_url(source_url, cannonical_destination, resume_download=(not force_new_download))
+        archive_fullpath, archive_md5sum = download_file_from_url(source_url, cannonical_destination, \
+                                                                  resume_download=(not force_new_download), \
+                                                                  num_connections=num_connections)
         create_success_file(download_success_file_path, \
                         "Download of the mutation resource archive:\n\t{:s}\n".format(source_url) + \
                         "to:\n\t{:s}\nsucceeded.".format(cannonical_destination))
@@ -1030,9 +2684,53 @@ def download_and_integrate_mutation_resources(source_url, genome_build_directory
         print "\t{:s}".format(download_success_file_path)
         print "Remove the file or set <new_mutation_download> if you want a new download to occur."
     else:
-        print "download_and_integrate_mutation_resources() - Download: This code should never be printed. Something is wrong."
+        print "download_mutation_resources(): This code should never be printed. Something is wrong."
     sys.stdout.flush()
-    
+    return os.path.join(cannonical_destination, source_filename)
+
+def integrate_mutation_resources(source_url, mutation_archive_filepath, genome_build_directory, \
+                                 cosmic_resources_location=None, force_new_integration=False):
+    # Does locked_integrate_mutation_resources() holding the integration lock in the genome_build_directory
+    # (see stage_lock), so a second run integrating the same mutation resources into the same library
+    # waits for the first one and then uses its integration.
+    source_filename = os.path.basename(urlparse.urlparse(mutation_resources_url(source_url)).path)
+    cannonical_destination = os.path.realpath(genome_build_directory)
+    with stage_lock(os.path.join(cannonical_destination, \
+                                 "{:s}.{:s}".format(source_filename, _MutationIntegrationLockFile)), \
+                    "the integration of {:s}".format(source_filename)) as integration_lock:
+        force_new_integration = integration_lock.still_forced(force_new_integration, \
+            os.path.join(cannonical_destination, "{:s}.{:s}".format(source_filename, _MutationIntegrationSuccessFile)))
+        locked_integrate_mutation_resources(source_url, mutation_archive_filepath, genome_build_directory, \
+                                            cosmic_resources_location, force_new_integration)
+
+def locked_integrate_mutation_resources(source_url, mutation_archive_filepath, genome_build_directory, \
+                                        cosmic_resources_location=None, force_new_integration=False):
+    # Integrates the mutation resources, downloaded from source_url into mutation_archive_filepath,
+    # with the library in genome_build_directory.
+    # See download_and_integrate_mutation_resources() for the details of the process.
+    source_url = mutation_resources_url(source_url)
+    source_filename = os.path.basename(urlparse.urlparse(source_url).path)
+    already_integrated = (not force_new_integration) and os.path.exists(os.path.join( \
+        os.path.realpath(genome_build_directory), "{:s}.{:s}".format(source_filename, _MutationIntegrationSuccessFile)))
+    cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(genome_build_directory, \
+        0 if already_integrated else _NumBytesNeededForMutationResources)
+    print "Integrate a Mutation Resource Archive."
+    print "The archive is:\n\t{:s}".format(str(mutation_archive_filepath))
+    print "The genome build directory is:\n\t{:s}".format(str(cannonical_destination))
+    sys.stdout.flush()
+    orig_files_in_destdir = set(os.listdir(cannonical_destination))
+    # The archive is expected to be in the genome build directory.
+    # If it was downloaded elsewhere, it is linked (or copied) into place,
+    # replacing any different copy left there by an earlier download.
+    archive_in_build_dir = os.path.join(cannonical_destination, source_filename)
+    if os.path.realpath(mutation_archive_filepath) != os.path.realpath(archive_in_build_dir):
+        if os.path.exists(archive_in_build_dir) \
+           and not os.path.samefile(mutation_archive_filepath, archive_in_build_dir) \
+           and (os.path.getsize(mutation_archive_filepath) != os.path.getsize(archive_in_build_dir)):
+            os.remove(archive_in_build_dir)
+        if not os.path.exists(archive_in_build_dir):
+            link_or_copy_file(mutation_archive_filepath, archive_in_build_dir)
+
     # INTEGRATION SECTION
     integration_success_file = "{:s}.{:s}".format(source_filename, _MutationIntegrationSuccessFile)
     integration_success_file_path = os.path.join(cannonical_destination, integration_success_file)
@@ -1071,7 +2769,7 @@ def download_and_integrate_mutation_resources(source_url, genome_build_directory
                   "--CosmicCodingMuts {:s} ".format(cosmic_coding_full_path) + \
                   "--genome_lib_dir {:s}".format(cannonical_destination)
         try: # to send the ctat-mutation-lib-integration command.
-            subprocess.check_call(command, shell=True)
+            run_monitored_command(command, shell=True)
         except subprocess.CalledProcessError:
             print "ERROR: While trying to integrate the mutation resources:\n\t{:s}".format(command)
             sys.stdout.flush()
@@ -1092,11 +2790,71 @@ def download_and_integrate_mutation_resources(source_url, genome_build_directory
         print "\t{:s}".format(integration_success_file_path)
         print "Remove the file or set <new_mutation_integration> if you want a new integration to occur."
     else:
-        print "download_and_integrate_mutation_resources() - Integration: This code should never be printed. Something is wrong."
+        print "integrate_mutation_resources(): This code should never be printed. Something is wrong."
     sys.stdout.flush()
     return
 
+def load_library_index():
+    # Returns the library index, a dictionary mapping directory paths to what scan_directory() found in them.
+    # A missing or unreadable index is treated as empty.
+    try:
+        with open(_LibraryIndexFilepath, "r") as index_file:
+            return json.load(index_file).get('directories', dict())
+    except (IOError, ValueError, AttributeError):
+        return dict()
+
+def save_library_index(library_index):
+    # Writes the library index to a temporary file and renames it into place,
+    # so an index being written is never read.
+    temporary_filepath = "{:s}.{:d}.tmp".format(_LibraryIndexFilepath, os.getpid())
+    try:
+        with open(temporary_filepath, "w") as index_file:
+            json.dump(dict(directories=library_index), index_file)
+        os.rename(temporary_filepath, _LibraryIndexFilepath)
+    except (IOError, OSError) as index_error:
+        # The index only saves time, so not being able to write it is not an error.
+        print "Could not write the library index {:s}: {:s}".format(_LibraryIndexFilepath, str(index_error))
+        sys.stdout.flush()
+
+def scan_directory(directory_path, library_index=None):
+    # Lists directory_path for search_for_genome_build_dir().
+    # Returns a tuple of the sorted names of the subdirectories of directory_path,
+    # whether it holds a _CTAT_Build_dirname, and whether it holds a _CTAT_RefGenome_Filename.
+    # If library_index has an entry for directory_path with the directory's current modification time,
+    # the entry is returned without listing the directory. Otherwise library_index is updated.
+    directory_mtime = os.stat(directory_path).st_mtime
+    if library_index is not None:
+        index_entry = library_index.get(directory_path)
+        if (index_entry is not None) and (index_entry.get('mtime') == directory_mtime):
+            return (index_entry['subdirs'], index_entry['has_build_dir'], index_entry['has_ref_genome'])
+    if scandir is not None:
+        entry_names = set()
+        subdirs = list()
+        for entry in scandir(directory_path):
+            entry_names.add(entry.name)
+            if entry.is_dir():
+                subdirs.append(entry.name)
+    else:
+        entry_names = set(os.listdir(directory_path))
+        subdirs = [entry for entry in entry_names if os.path.isdir(os.path.join(directory_path, entry))]
+    subdirs.sort()
+    has_build_dir = _CTAT_Build_dirname in entry_names
+    has_ref_genome = _CTAT_RefGenome_Filename in entry_names
+    if (library_index is not None) and ((time.time() - directory_mtime) > _LibraryIndexMtimeGrace):
+        library_index[directory_path] = dict(mtime=directory_mtime, subdirs=subdirs, \
+                                             has_build_dir=has_build_dir, has_ref_genome=has_ref_genome)
+    return (subdirs, has_build_dir, has_ref_genome)
+
 def search_for_genome_build_dir(top_dir_path):
+    # The directories are read through the library index (see scan_directory()),
+    # so searching the same unchanged directories again only needs a stat of each directory.
+    with _LibraryIndexLock:
+        library_index = load_library_index()
+        genome_build_directory = search_for_genome_build_dir_in(top_dir_path, library_index)
+        save_library_index(library_index)
+    return genome_build_directory
+
+def search_for_genome_build_dir_in(top_dir_path, library_index):
     # If we do not download the directory, the topdir_path could be the
     # location of the genome resource library, but we also want to allow the
     # user to give the same value for top_dir_path that they do when a
@@ -1128,8 +2886,8 @@ def search_for_genome_build_dir(top_dir_path):
         # Look for it inside of the top_dir_path directory.
         print "Looking inside of: {:s}".format(top_dir_full_path)
         sys.stdout.flush()
-        top_dir_contents = os.listdir(top_dir_full_path)
-        if (_CTAT_Build_dirname in top_dir_contents):
+        subdirs, top_dir_has_build_dir, top_dir_has_ref_genome = scan_directory(top_dir_full_path, library_index)
+        if top_dir_has_build_dir:
             # The genome_build_directory is inside of the top_dir_path directory.
             print "1. Found it."
             sys.stdout.flush()
@@ -1141,28 +2899,25 @@ def search_for_genome_build_dir(top_dir_path):
             subdirs_with_genome_files = list()
             build_dirs_in_sub_subdirs = list()
             sub_subdirs_with_genome_files = list()
-            subdirs = [entry for entry in top_dir_contents if (os.path.isdir("{:s}/{:s}".format(top_dir_full_path,entry)))]
             for subdir in subdirs:
                 subdir_path = "{:s}/{:s}".format(top_dir_full_path, subdir)
-                subdir_path_contents = os.listdir(subdir_path)
-                # print "Is it one of:\n\t" + "\n\t".join(subdir_path_contents)
-                if (_CTAT_Build_dirname in subdir_path_contents):
+                sub_subdirs, subdir_has_build_dir, subdir_has_ref_genome = scan_directory(subdir_path, library_index)
+                if subdir_has_build_dir:
                     # The genome_build_directory is inside of the subdir_path directory.
                     print "2a, Found one."
                     build_dirs_in_subdirs.append("{:s}/{:s}".format(subdir_path, _CTAT_Build_dirname))
-                if (_CTAT_RefGenome_Filename in subdir_path_contents):
+                if subdir_has_ref_genome:
                     subdirs_with_genome_files.append(subdir_path)
                 # Since we are already looping, loop through all dirs one level deeper as well.
-                sub_subdirs = [entry for entry in subdir_path_contents if (os.path.isdir("{:s}/{:s}".format(subdir_path,entry)))]
                 for sub_subdir in sub_subdirs:
                     sub_subdir_path = "{:s}/{:s}".format(subdir_path, sub_subdir)
-                    sub_subdir_path_contents = os.listdir(sub_subdir_path)
-                    # print "Is it one of:\n\t" + "\n\t".join(sub_subdir_path_contents)
-                    if (_CTAT_Build_dirname in sub_subdir_path_contents):
+                    unused_subdirs, sub_subdir_has_build_dir, sub_subdir_has_ref_genome = \
+                        scan_directory(sub_subdir_path, library_index)
+                    if sub_subdir_has_build_dir:
                         # The genome_build_directory is inside of the sub_subdir_path directory.
                         print "3a. Found one."
                         build_dirs_in_sub_subdirs.append("{:s}/{:s}".format(sub_subdir_path, _CTAT_Build_dirname))
-                    if (_CTAT_RefGenome_Filename in sub_subdir_path_contents):
+                    if sub_subdir_has_ref_genome:
                         sub_subdirs_with_genome_files.append(sub_subdir_path)
             # Hopefully there is one and only one found build directory.
             # If none are found we check for a directory containing the genome reference file,
@@ -1209,7 +2964,7 @@ def search_for_genome_build_dir(top_dir_path):
                 sys.stdout.flush()
                 genome_build_directory = subdirs_with_genome_files[0]
                 print_warning = True
-            elif (_CTAT_RefGenome_Filename in top_dir_contents):
+            elif top_dir_has_ref_genome:
                 print "1c. Maybe found it."
                 sys.stdout.flush()
                 genome_build_directory = top_dir_full_path
@@ -1237,7 +2992,7 @@ def search_for_genome_build_dir(top_dir_path):
         raise ValueError("Cannot find the CTAT Genome Resource Library " + \
             "in the given directory:\n\t{:s}".format(top_dir_full_path))
     else:
-        if (_CTAT_RefGenome_Filename not in os.listdir(genome_build_directory)):
+        if not scan_directory(genome_build_directory, library_index)[2]:
             print "\n***************************************"
             print "\nWARNING: Cannot find Genome Reference file {:s} ".format(_CTAT_RefGenome_Filename) + \
                 "in the genome build directory:\n\t{:s}".format(genome_build_directory)
@@ -1256,6 +3011,150 @@ def search_for_genome_build_dir(top_dir_path):
             sys.stdout.flush()
     return genome_build_directory
 
+def library_checksums_path(library_directory):
+    return os.path.join(library_directory, "{:s}.{:s}".format(_CTAT_Build_dirname, _LibraryChecksumsFile))
+
+def read_library_checksums(library_directory):
+    # Returns the checksums previously written by write_library_checksums() for library_directory,
+    # as a dictionary of each file's path, relative to library_directory, to a tuple of its md5sum, size and
+    # modification time. Returns None if there are none.
+    checksums_filepath = library_checksums_path(library_directory)
+    if not os.path.exists(checksums_filepath):
+        return None
+    checksums = dict()
+    with open(checksums_filepath, "r") as checksums_file:
+        for line in checksums_file:
+            md5sum, size, mtime, relative_path = line.rstrip("\n").split("\t", 3)
+            checksums[relative_path] = (md5sum, int(size), int(mtime))
+    return checksums
+
+def library_files(library_directory):
+    # Returns a dictionary of the path, relative to library_directory, of each file in the library
+    # to a tuple of its size and modification time. The entries that prep_genome_lib.pl or this
+    # data manager rewrite (see is_rewritten_by_build()) are not part of the library's data, so they are left out.
+    files = dict()
+    for dirpath, dirnames, filenames in os.walk(library_directory):
+        if dirpath == library_directory:
+            dirnames[:] = [dirname for dirname in dirnames if not is_rewritten_by_build(dirname)]
+            filenames = [filename for filename in filenames \
+                         if not (is_rewritten_by_build(filename) or filename.endswith(_Write_TestFile))]
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if os.path.islink(filepath):
+                continue
+            file_stat = os.stat(filepath)
+            files[os.path.relpath(filepath, library_directory)] = (file_stat.st_size, int(file_stat.st_mtime))
+    return files
+
+def md5sum_of_library_file(filepath):
+    # Returns a tuple of filepath, its md5sum and None, or of filepath, None and the error if it could not be read.
+    # This runs in the worker processes of hash_library_files(), so it is a module level function.
+    md5_object = hashlib.md5()
+    try:
+        with open(filepath, "rb") as library_file:
+            while True:
+                data = library_file.read(_ChecksumBlockSize)
+                if not data:
+                    break
+                md5_object.update(data)
+    except (IOError, OSError) as read_error:
+        return (filepath, None, str(read_error))
+    return (filepath, md5_object.hexdigest(), None)
+
+def hash_library_files(library_directory, relative_paths, file_sizes, num_processes):
+    # Computes the md5sums of the files at relative_paths, in library_directory, using num_processes processes,
+    # each reading whole files sequentially in large blocks, so several files are read from the disk at once.
+    # The largest files are started first, so one large file does not hold up the end.
+    # Returns a dictionary of each relative path to a tuple of its md5sum (None if it could not be read) and the error.
+    relative_paths = sorted(relative_paths, key=lambda relative_path: file_sizes[relative_path], reverse=True)
+    filepaths = [os.path.join(library_directory, relative_path) for relative_path in relative_paths]
+    meter = ctat_transfer.progress_meter("checksum", library_directory, \
+                                         sum([file_sizes[path] for path in relative_paths]))
+    results = dict()
+    pool = None
+    if (num_processes > 1) and (len(filepaths) > 1):
+        pool = multiprocessing.Pool(min(num_processes, len(filepaths)))
+        file_results = pool.imap_unordered(md5sum_of_library_file, filepaths)
+    else:
+        file_results = (md5sum_of_library_file(filepath) for filepath in filepaths)
+    try:
+        for filepath, md5sum, read_error in file_results:
+            relative_path = os.path.relpath(filepath, library_directory)
+            results[relative_path] = (md5sum, read_error)
+            meter.add(file_sizes[relative_path])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    meter.finish()
+    return results
+
+def write_library_checksums(library_directory, num_processes=1):
+    # Writes the md5sum, size and modification time of every file of the library in library_directory
+    # into a checksums file in the library, so it can later be checked with verify_library().
+    # Files whose size and modification time match the checksums already written are not hashed again,
+    # so rewriting the checksums after a gmap_build or mutation integration only reads the new files.
+    previous_checksums = read_library_checksums(library_directory) or dict()
+    files = library_files(library_directory)
+    changed_paths = [relative_path for relative_path, (size, mtime) in files.items() \
+                     if previous_checksums.get(relative_path, (None, None, None))[1:] != (size, mtime)]
+    print "Computing the checksums of {:d} of the {:d} files of the library ".format(len(changed_paths), len(files)) + \
+          "using {:d} processes.".format(num_processes)
+    sys.stdout.flush()
+    file_sizes = dict([(relative_path, size) for relative_path, (size, mtime) in files.items()])
+    hashed = hash_library_files(library_directory, changed_paths, file_sizes, num_processes)
+    unreadable_paths = sorted([relative_path for relative_path, (md5sum, read_error) in hashed.items() if md5sum is None])
+    if unreadable_paths:
+        raise IOError("The following files of the library could not be read:\n\t" + \
+                      "\n\t".join(["{:s}: {:s}".format(path, hashed[path][1]) for path in unreadable_paths]))
+    checksums_filepath = library_checksums_path(library_directory)
+    # Write to a temporary file and rename it, so the checksums file is never partly written.
+    temporary_filepath = "{:s}.{:d}.tmp".format(checksums_filepath, os.getpid())
+    with open(temporary_filepath, "w") as checksums_file:
+        for relative_path in sorted(files.keys()):
+            size, mtime = files[relative_path]
+            if relative_path in hashed:
+                md5sum = hashed[relative_path][0]
+            else:
+                md5sum = previous_checksums[relative_path][0]
+            checksums_file.write("{:s}\t{:d}\t{:d}\t{:s}\n".format(md5sum, size, mtime, relative_path))
+    os.rename(temporary_filepath, checksums_filepath)
+    print "The checksums of the library were written to:\n\t{:s}".format(checksums_filepath)
+    sys.stdout.flush()
+
+def verify_library(library_directory, num_processes=1):
+    # Checks every file of the library in library_directory against the checksums written by 
+    # write_library_checksums(), reading num_processes files at once.
+    # A file whose size has changed is reported as corrupted without being read.
+    # Returns a tuple of the lists of missing files, corrupted files and files that have no recorded checksum.
+    checksums = read_library_checksums(library_directory)
+    if checksums is None:
+        raise ValueError("There are no checksums recorded for the library:\n\t{:s}".format(library_directory))
+    files = library_files(library_directory)
+    missing_paths = sorted([relative_path for relative_path in checksums if relative_path not in files])
+    unrecorded_paths = sorted([relative_path for relative_path in files if relative_path not in checksums])
+    resized_paths = [relative_path for relative_path in checksums \
+                     if (relative_path in files) and (files[relative_path][0] != checksums[relative_path][1])]
+    paths_to_hash = [relative_path for relative_path in checksums \
+                     if (relative_path in files) and (relative_path not in resized_paths)]
+    print "Verifying {:d} files of the library using {:d} processes:\n\t{:s}".format(len(paths_to_hash), \
+          num_processes, library_directory)
+    sys.stdout.flush()
+    file_sizes = dict([(relative_path, size) for relative_path, (size, mtime) in files.items()])
+    hashed = hash_library_files(library_directory, paths_to_hash, file_sizes, num_processes)
+    corrupted_paths = sorted(resized_paths + [relative_path for relative_path, (md5sum, read_error) in hashed.items() \
+                                              if md5sum != checksums[relative_path][0]])
+    for label, paths in (("Missing", missing_paths), ("Corrupted", corrupted_paths), \
+                         ("Not recorded in the checksums", unrecorded_paths)):
+        if paths:
+            print "{:s} files ({:d}):\n\t{:s}".format(label, len(paths), "\n\t".join(paths))
+    if not (missing_paths or corrupted_paths):
+        print "All {:d} files of the library match their checksums.".format(len(checksums))
+    sys.stdout.flush()
+    _Telemetry.event("library_verified", library=library_directory, num_files=len(checksums), \
+                     missing=len(missing_paths), corrupted=len(corrupted_paths), unrecorded=len(unrecorded_paths))
+    return (missing_paths, corrupted_paths, unrecorded_paths)
+
 def build_directory_from_build_location(src_filename, build_location):
     # This function is used to make sure our builds follow the covention of placing the build in a directory named
     # _CTAT_Build_dirname, which is normally inside of a directory named for the genome name.
@@ -1277,6 +3176,103 @@ def build_directory_from_build_location(src_filename, build_location):
         build_directory = os.path.join(build_location, genome_dir_name, _CTAT_Build_dirname)
     return build_directory
 
+class stage_scheduler(object):
+    # The work done by main() is split into stages, each declared with the names of the values
+    # it needs (its inputs) and the names of the values it produces (its outputs).
+    # A stage depends on the stages that produce its inputs. The stages form a dependency graph,
+    # and each stage is started in its own thread as soon as all of the stages it depends on have finished,
+    # so stages that do not depend on each other run at the same time
+    # (e.g. downloading the mutation resources while prep_genome_lib.pl runs).
+    # Each stage function still checks and writes its own success files, so when the data manager is
+    # rerun after a failure, the stages that succeeded before do not redo their work.
+    # If a stage fails, no new stages are started, the running ones are allowed to finish,
+    # and the first error is raised again by run().
+    def __init__(self):
+        self.values = dict()
+        self.stages = list()
+    def add_value(self, name, value):
+        # Adds a value that is available before any stage runs.
+        self.values[name] = value
+    def add_stage(self, name, function, inputs=(), outputs=()):
+        # function is called with the inputs as keyword arguments.
+        # It must return a dictionary holding a value for each name in outputs.
+        self.stages.append(dict(name=name, function=function, inputs=list(inputs), outputs=list(outputs)))
+    def run(self):
+        # Runs all of the stages and returns the dictionary of values.
+        producers = dict()
+        for stage in self.stages:
+            for output in stage['outputs']:
+                if (output in producers) or (output in self.values):
+                    raise ValueError("The value {:s} is produced by more than one stage.".format(output))
+                producers[output] = stage['name']
+        for stage in self.stages:
+            for input_name in stage['inputs']:
+                if (input_name not in producers) and (input_name not in self.values):
+                    raise ValueError("No stage produces the value {:s} needed by the stage {:s}.".format( \
+                                     input_name, stage['name']))
+        waiting = list(self.stages)
+        num_running = 0
+        first_error = None
+        stage_results = Queue.Queue()
+
+        def run_stage(stage, arguments):
+            # The telemetry log attributes the downloads and processes started by this thread to the stage.
+            _Telemetry.stage_started(stage['name'])
+            try:
+                results = stage['function'](**arguments)
+                if results is None:
+                    results = dict()
+                missing_outputs = [output for output in stage['outputs'] if output not in results]
+                if missing_outputs:
+                    raise ValueError("The stage {:s} did not produce: {:s}".format( \
+                                     stage['name'], ", ".join(missing_outputs)))
+                _Telemetry.stage_finished(stage['name'])
+                stage_results.put((stage, results, None))
+            except BaseException as error:
+                _Telemetry.stage_finished(stage['name'], error)
+                stage_results.put((stage, None, sys.exc_info()))
+
+        while waiting or (num_running > 0):
+            if first_error is None:
+                for stage in list(waiting):
+                    # The outputs of a stage are only added to values once it has finished.
+                    if all([input_name in self.values for input_name in stage['inputs']]):
+                        waiting.remove(stage)
+                        arguments = dict([(input_name, self.values[input_name]) for input_name in stage['inputs']])
+                        print "\nStarting stage: {:s}".format(stage['name'])
+                        sys.stdout.flush()
+                        stage_thread = threading.Thread(target=run_stage, args=(stage, arguments))
+                        stage_thread.daemon = True
+                        stage_thread.start()
+                        num_running += 1
+            if num_running == 0:
+                if first_error is None and waiting:
+                    raise ValueError("The stages {:s} depend on each other in a cycle.".format( \
+                                     ", ".join([stage['name'] for stage in waiting])))
+                break
+            # A timeout is used so that the main thread can still be interrupted while it waits.
+            while True:
+                try:
+                    stage, results, error = stage_results.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            num_running -= 1
+            if error is not None:
+                print "\nThe stage {:s} failed.".format(stage['name'])
+                sys.stdout.flush()
+                if first_error is None:
+                    first_error = error
+            else:
+                for output in stage['outputs']:
+                    self.values[output] = results[output]
+                print "\nFinished stage: {:s}".format(stage['name'])
+                sys.stdout.flush()
+        if first_error is not None:
+            raise first_error[0], first_error[1], first_error[2]
+        return self.values
+# End of class stage_scheduler
+
 def main():
     # Regarding the command line, there are three basic ways to use this tool:
     # 1) Download and Build the CTAT Genome Resource Library from an archive;
@@ -1330,6 +3326,37 @@ def main():
              'Normally they are assumed to reside in the build directory, ' + \
              'but if that directory has not been created yet when this program ' + \
              'is called, you can specify the full path to the directory where they reside.')
+    parser.add_argument('--download_connections', 
+        type=int, default=_DefaultNumDownloadConnections, \
+        help='The number of simultaneous connections used to download archives. ' + \
+             'Each connection downloads a different byte range of the file. ' + \
+             'If the server does not accept byte range requests, or this is 1, ' + \
+             'the archive is downloaded over a single connection.')
+    parser.add_argument('--build_cache_location', 
+        default='', \
+        help='Full path of a directory, shared by all installs on this node or site, ' + \
+             'where built libraries and gmap indexes are kept, keyed by the md5sums of the source files ' + \
+             'and of the programs that build them. A library or gmap index found there is hard linked ' + \
+             '(or copied) into place instead of being built again.')
+    parser.add_argument('--build_cache_max_gb', 
+        type=float, default=_DefaultBuildCacheMaxGigabytes, \
+        help='The most space the build cache may use, in gigabytes. ' + \
+             'The least recently used entries are removed from the cache to stay within this.')
+    parser.add_argument('--verify_library', \
+        help='Checks every file of the library against the checksums recorded when it was installed ' + \
+             'and fails, listing the missing and corrupted files, if any do not match. ' + \
+             'If no checksums were recorded yet, the library cannot be verified. A warning says so, ' + \
+             'and the checksums of the files as they are now are recorded, to verify the library against later.',
+        action='store_true')
+    parser.add_argument('--checksum_processes', 
+        type=int, default=multiprocessing.cpu_count(), \
+        help='The number of processes that read and hash the files of the library at once, ' + \
+             'when recording or verifying its checksums.')
+    parser.add_argument('--telemetry_file', 
+        default='', \
+        help='Full path of the file where the telemetry events of each stage are written as JSON lines. ' + \
+             'By default it is written next to the output file, with ' + \
+             '.{:s} appended to the output file\'s name.'.format(_TelemetryFileSuffix))
     # Method 1) arguments - Download and Build. 
     # - One can optionally utilize --build_location argument with this group of arguments.
     download_and_build_args = parser.add_argument_group('Download and Build arguments')
@@ -1354,6 +3381,31 @@ def main():
     download_and_build_args.add_argument('-k', '--keep_archive', \
         help='The archive will not be deleted after it is extracted.',
         action='store_true')
+    download_and_build_args.add_argument('--stream_extraction', \
+        help='The archive is extracted as it is downloaded and is never written to disk, ' + \
+            'so only the space for the extracted library is needed. ' + \
+            'An interrupted extraction is resumed by streaming the archive again and skipping ' + \
+            'the files that were already extracted. Cannot be used with --keep_archive.',
+        action='store_true')
+    download_and_build_args.add_argument('--archive_cache_location', 
+        default='', \
+        help='Full path of a directory, shared by all installs on this node or site, ' + \
+            'where downloaded archives are kept. An archive found there with the md5sum ' + \
+            'published on the web is hard linked (or copied) into the download location ' + \
+            'instead of being downloaded again.')
+    download_and_build_args.add_argument('--archive_cache_max_gb', 
+        type=float, default=_DefaultArchiveCacheMaxGigabytes, \
+        help='The most space the archive cache may use, in gigabytes. ' + \
+            'The least recently used archives are removed from the cache to stay within this.')
+    download_and_build_args.add_argument('--decompression_backend', 
+        choices=_DecompressionBackends, default=_DECOMPRESSION_AUTO, \
+        help='The program used to decompress the archive. ' + \
+            'pigz (for .tar.gz) and zstd (for .tar.zst) decompress in separate processes, using more than one core. ' + \
+            'auto uses whichever of those fits the archive and is in the PATH, ' + \
+            'otherwise the archive is decompressed by python\'s tarfile on a single core.')
+    download_and_build_args.add_argument('--decompression_threads', 
+        type=int, default=1, \
+        help='The number of threads the decompression program may use.')
     # Method 2) arguments - Specify source and build locations.
     # - One can optionally utilize --build_location argument with this group of arguments.
     specify_source_and_build_args = parser.add_argument_group('Specify Source and Build locations arguments')
@@ -1369,6 +3421,12 @@ def main():
         help='Forces build of the CTAT Genome Resource Library, even if previously built. ' + \
             'The --source_location must be a source-data archive or directory, or this is a no-op.', 
         action='store_true')
+    specify_source_and_build_args.add_argument('--link_existing_library', \
+        help='If the source data at --source_location was already built into a library on the same filesystem ' + \
+            'as the --build_location, the library at the --build_location is made from reflinks, ' + \
+            'or hard links, to the files of that library instead of being built again. ' + \
+            'The files that prep_genome_lib.pl writes to are copied.',
+        action='store_true')
     # Method 3) arguments - Specify the location of a built library.
     built_lib_location_arg = parser.add_argument_group('Specify location of built library arguments')
     built_lib_location_arg.add_argument('-b', '--build_location', 
@@ -1386,16 +3444,31 @@ def main():
     # target_directory = params['output_data'][0]['extra_files_path']
     # os.mkdir(target_directory)
     
-    lib_was_built = False
     extracted_directory = None
-    source_data_directory = None
-    genome_build_directory = None
     download_url_is_set = (args.download_url is not None) and (args.download_url != "")
     download_location_is_set = (args.download_location is not None) and (args.download_location != "")
     source_location_is_set = (args.source_location is not None) and (args.source_location != "")
     build_location_is_set = (args.build_location is not None) and (args.build_location != "")
     mutation_url_is_set = (args.download_mutation_resources_url is not None) \
                                and (args.download_mutation_resources_url != "")
+    if not (download_url_is_set or source_location_is_set or build_location_is_set):
+        raise ValueError("At least one of --download_url, --source_location, or --build_location must be specified.")
+
+    if (args.telemetry_file is not None) and (args.telemetry_file != ""):
+        telemetry_filepath = args.telemetry_file
+    else:
+        telemetry_filepath = "{:s}.{:s}".format(os.path.realpath(args.output_filename), _TelemetryFileSuffix)
+    _Telemetry.open(telemetry_filepath)
+    print "Telemetry for each stage is written to:\n\t{:s}".format(telemetry_filepath)
+    sys.stdout.flush()
+
+    # The work is declared as stages in a dependency graph (see stage_scheduler),
+    # so that stages that do not depend on each other run at the same time.
+    # Each stage keeps its own success files, so a rerun skips the stages that succeeded before.
+    scheduler = stage_scheduler()
+    build_cache_max_bytes = int(args.build_cache_max_gb * 1073741824)
+    # library_type is None when the library was not downloaded, but is at source_location or build_location.
+    library_type = None
   
     if download_url_is_set:
         print "The value of download_url argument is:\n\t{:s}".format(str(args.download_url))
@@ -1404,61 +3477,87 @@ def main():
             raise ValueError("Argument --source_location cannot be used in combination with --download_url.")
         if not download_location_is_set:
             raise ValueError("Argument --download_url requires that --download_location be specified.")
-        downloaded_filename_full_path = \
-            download_genome_archive(source_url=args.download_url, \
-                             destination=args.download_location, \
-                             force_new_download=args.new_archive_download)
-        print "\nThe downloaded file is:\n\t{:s}.\n".format(str(downloaded_filename_full_path))    
-        sys.stdout.flush()
-        
-        if ctat_library_type(downloaded_filename_full_path) == _LIBTYPE_SOURCE_DATA:
-            print "It is source data."
-            sys.stdout.flush()
-            # If it is source_data, extract to download_location (the directory where the download was placed).
-            extracted_directory = extract_genome_file(archive_filepath=downloaded_filename_full_path, \
-                                                      destination=args.download_location, \
-                                                      force_new_extraction=args.new_archive_download, \
-                                                      keep_archive=args.keep_archive)
-            source_data_directory = extracted_directory
-            if build_location_is_set:
-                genome_build_directory = build_directory_from_build_location(source_data_directory, args.build_location)
-            else:
-                # We will build within a subdirectory of the source_data_directory .
-                # The name of the build directory will be the default _CTAT_Build_dirname.
-                # This _CTAT_Build_dirname directory will not exist until the library is built.
-                genome_build_directory = os.path.join(source_data_directory, _CTAT_Build_dirname)
-            
-        elif ctat_library_type(downloaded_filename_full_path) == _LIBTYPE_PLUG_N_PLAY:
-            print "It is plug-n-play data."
-            sys.stdout.flush()
-            if build_location_is_set:
-                # Extract to the build location. The library is already built.
-                extracted_directory = extract_genome_file(archive_filepath=downloaded_filename_full_path, \
-                                                          destination=args.build_location, \
-                                                          force_new_extraction=args.new_archive_download, \
-                                                          keep_archive=args.keep_archive)
-            else:
-                # Extract to the download location.
-                extracted_directory = extract_genome_file(archive_filepath=downloaded_filename_full_path, \
+        library_type = ctat_library_type(args.download_url)
+        if library_type not in (_LIBTYPE_SOURCE_DATA, _LIBTYPE_PLUG_N_PLAY):
+            raise ValueError("Unexpected CTAT Library type. Neither plug-n-play nor source_data:\n\t" + \
+                "{:s}".format(args.download_url))
+        if args.stream_extraction:
+            if args.keep_archive:
+                raise ValueError("Argument --stream_extraction cannot be used in combination with --keep_archive.")
+            # Nothing is downloaded yet. The archive is extracted as it is downloaded.
+            archive_url = args.download_url
+            if urlparse.urlparse(archive_url).scheme == "":
+                archive_url = urlparse.urljoin(_CTAT_ResourceLib_URL, archive_url)
+            scheduler.add_value("archive", archive_url)
+        else:
+            def download_stage():
+                downloaded_filename_full_path = \
+                    download_genome_archive(source_url=args.download_url, \
+                                     destination=args.download_location, \
+                                     force_new_download=args.new_archive_download, \
+                                     num_connections=args.download_connections, \
+                                     archive_cache_location=args.archive_cache_location, \
+                                     max_cache_bytes=int(args.archive_cache_max_gb * 1073741824))
+                print "\nThe downloaded file is:\n\t{:s}.\n".format(str(downloaded_filename_full_path))    
+                sys.stdout.flush()
+                return dict(archive=downloaded_filename_full_path)
+            scheduler.add_stage("download_archive", download_stage, outputs=["archive"])
+
+        def extraction_stage(archive):
+            if library_type == _LIBTYPE_SOURCE_DATA:
+                print "It is source data."
+                sys.stdout.flush()
+                # If it is source_data, extract to download_location (the directory where the download was placed).
+                extracted_directory = extract_genome_file(archive_filepath=archive, \
                                                           destination=args.download_location, \
                                                           force_new_extraction=args.new_archive_download, \
-                                                          keep_archive=args.keep_archive)
-            # There is no source_data_directory, so its value stays as None.
-            
-            # Look for the build directory. It should be inside the extracted_directory
-            if len(os.listdir(extracted_directory)) == 1:
-                # Then that one file is a subdirectory that should be the build_directory.
-                # That is how the plug-n-play directories are structured.
-                subdir_filename = os.listdir(extracted_directory)[0]
-                genome_build_directory = os.path.join(extracted_directory, subdir_filename)
+                                                          keep_archive=args.keep_archive, \
+                                                          stream_from_url=args.stream_extraction, \
+                                                          decompression_backend=args.decompression_backend, \
+                                                          decompression_threads=args.decompression_threads)
+                source_data_directory = extracted_directory
+                if build_location_is_set:
+                    genome_build_directory = build_directory_from_build_location(source_data_directory, args.build_location)
+                else:
+                    # We will build within a subdirectory of the source_data_directory .
+                    # The name of the build directory will be the default _CTAT_Build_dirname.
+                    # This _CTAT_Build_dirname directory will not exist until the library is built.
+                    genome_build_directory = os.path.join(source_data_directory, _CTAT_Build_dirname)
             else:
-                # We need to search for the build directory, since there is more than one file.
-                genome_build_directory = search_for_genome_build_dir(extracted_directory)
-        else:
-            raise ValueError("Unexpected CTAT Library type. Neither plug-n-play nor source_data:\n\t" + \
-                "{:s}".format(downloaded_filename_full_path))
+                print "It is plug-n-play data."
+                sys.stdout.flush()
+                if build_location_is_set:
+                    # Extract to the build location. The library is already built.
+                    extraction_destination = args.build_location
+                else:
+                    # Extract to the download location.
+                    extraction_destination = args.download_location
+                extracted_directory = extract_genome_file(archive_filepath=archive, \
+                                                          destination=extraction_destination, \
+                                                          force_new_extraction=args.new_archive_download, \
+                                                          keep_archive=args.keep_archive, \
+                                                          stream_from_url=args.stream_extraction, \
+                                                          decompression_backend=args.decompression_backend, \
+                                                          decompression_threads=args.decompression_threads)
+                # There is no source_data_directory, so its value stays as None.
+                source_data_directory = None
+                # Look for the build directory. It should be inside the extracted_directory
+                if len(os.listdir(extracted_directory)) == 1:
+                    # Then that one file is a subdirectory that should be the build_directory.
+                    # That is how the plug-n-play directories are structured.
+                    subdir_filename = os.listdir(extracted_directory)[0]
+                    genome_build_directory = os.path.join(extracted_directory, subdir_filename)
+                else:
+                    # We need to search for the build directory, since there is more than one file.
+                    genome_build_directory = search_for_genome_build_dir(extracted_directory)
+            return dict(extracted_directory=extracted_directory, \
+                        source_data_directory=source_data_directory, \
+                        genome_build_directory=genome_build_directory)
+        scheduler.add_stage("extract_archive", extraction_stage, inputs=["archive"], \
+                            outputs=["extracted_directory", "source_data_directory", "genome_build_directory"])
     elif source_location_is_set:
             # Then the user wants to build the directory from the source data.
+            library_type = _LIBTYPE_SOURCE_DATA
             source_data_directory = os.path.realpath(args.source_location)
             print "\nThe program is being told that the source data is in:\n\t{:s}.\n".format(str(source_data_directory))
             sys.stdout.flush()
@@ -1469,49 +3568,131 @@ def main():
                 # The name of the build directory will be the default _CTAT_Build_dirname.
                 # This _CTAT_Build_dirname directory will not exist until the library is built.
                 genome_build_directory = os.path.join(source_data_directory, _CTAT_Build_dirname)                
-    elif build_location_is_set:
-        genome_build_directory = args.build_location
-
-    if (genome_build_directory is None) or (genome_build_directory == ""):
-        raise ValueError("At least one of --download_url, --source_location, or --build_location must be specified.")
-        
-    print "\nThe location where the CTAT Genome Resource Library exists " + \
-        "or will be built is {:s}.\n".format(str(genome_build_directory))
-    sys.stdout.flush()
-
-    # To take out builds for testing, comment out the lines that do the building.
-    # The command that builds the ctat genome library also has an option for building the gmap indexes.
-    # That is why the gmap_build values are sent to build_the_library(), but if we are not building the
-    # library, the user might still be asking for a gmap_build. That is done after rechecking for the
-    # genome_build_directory.
-    if source_data_directory is not None:
-        build_the_library(source_data_directory, \
-                          genome_build_directory, \
-                          args.new_library_build, \
-                          args.gmap_build, \
-                          args.force_gmap_build)
-        lib_was_built = True
+            scheduler.add_value("source_data_directory", source_data_directory)
+            scheduler.add_value("genome_build_directory", genome_build_directory)
+    else:
+        scheduler.add_value("genome_build_directory", args.build_location)
+
+    # To take out builds for testing, comment out the stages that do the building.
+    # The command that builds the ctat genome library also has an option for building the gmap indexes,
+    # but that would only start the gmap_build after the rest of the build.
+    # Instead, the gmap_build is its own stage, indexing the ref_genome.fa of the source data
+    # while prep_genome_lib.pl builds the rest of the library.
+    if library_type == _LIBTYPE_SOURCE_DATA:
+        def build_stage(source_data_directory, genome_build_directory):
+            print "\nThe CTAT Genome Resource Library will be built in {:s}.\n".format(str(genome_build_directory))
+            sys.stdout.flush()
+            build_the_library(source_data_directory, \
+                              genome_build_directory, \
+                              args.new_library_build, \
+                              False, \
+                              False, \
+                              args.build_cache_location, \
+                              build_cache_max_bytes, \
+                              args.link_existing_library)
+            return dict(built_directory=genome_build_directory)
+        scheduler.add_stage("build_library", build_stage, \
+                            inputs=["source_data_directory", "genome_build_directory"], outputs=["built_directory"])
 
     # The following looks to see if the library actually exists after the build,
     # and raises an error if it cannot find the library files.
-    # The reassignment of genome_build_directory can be superfluous, 
+    # The resulting library_directory can be the same as the genome_build_directory,
     # since many times the genome_build_directory will already point to the correct directory.
     # There are cases, however, where a user specifies a location that contains the 
     # genome_build_directory rather than is the genome_build_directory.
-    genome_build_directory = search_for_genome_build_dir(genome_build_directory)
-
-    if (args.gmap_build and not lib_was_built):
-        # If we did not build the genome resource library
-        # the user might still be asking for a gmap_build.
-        gmap_the_library(genome_build_directory, args.force_gmap_build)
+    def locate_library(directory):
+        library_directory = search_for_genome_build_dir(directory)
+        print "\nThe location where the CTAT Genome Resource Library exists " + \
+            "is {:s}.\n".format(str(library_directory))
         sys.stdout.flush()
+        return dict(library_directory=library_directory)
+    if library_type == _LIBTYPE_SOURCE_DATA:
+        scheduler.add_stage("locate_library", lambda built_directory: locate_library(built_directory), \
+                            inputs=["built_directory"], outputs=["library_directory"])
+    else:
+        scheduler.add_stage("locate_library", lambda genome_build_directory: locate_library(genome_build_directory), \
+                            inputs=["genome_build_directory"], outputs=["library_directory"])
+
+    if args.gmap_build:
+        if library_type == _LIBTYPE_SOURCE_DATA:
+            def gmap_stage(source_data_directory, genome_build_directory, built_directory=None):
+                gmap_the_library(os.path.realpath(genome_build_directory), args.force_gmap_build, \
+                                 os.path.join(source_data_directory, _CTAT_RefGenome_Filename), \
+                                 args.build_cache_location, build_cache_max_bytes)
+            # A library linked from an existing library brings its gmap index with it,
+            # so then the gmap_build waits for the library to be linked and is only done if it is still needed.
+            scheduler.add_stage("gmap_library", gmap_stage, \
+                                inputs=["source_data_directory", "genome_build_directory"] + \
+                                       (["built_directory"] if args.link_existing_library else []))
+        else:
+            def gmap_stage(library_directory):
+                gmap_the_library(library_directory, args.force_gmap_build, \
+                                 build_cache_location=args.build_cache_location, \
+                                 max_cache_bytes=build_cache_max_bytes)
+            scheduler.add_stage("gmap_library", gmap_stage, inputs=["library_directory"])
 
     if mutation_url_is_set:
-        download_and_integrate_mutation_resources(source_url=args.download_mutation_resources_url, \
-                                  genome_build_directory=genome_build_directory, \
-                                  cosmic_resources_location=args.cosmic_resources_location, \
+        # When there is a download or source location, the mutation resources archive is downloaded there,
+        # at the same time as the library is downloaded, extracted and built.
+        # Otherwise it is downloaded into the library once the library has been located.
+        if download_location_is_set:
+            mutation_download_location = args.download_location
+        elif source_location_is_set:
+            mutation_download_location = args.source_location
+        else:
+            mutation_download_location = None
+        def mutation_download_stage(library_directory=None):
+            return dict(mutation_archive=download_mutation_resources(source_url=args.download_mutation_resources_url, \
+                                  destination=mutation_download_location or library_directory, \
                                   force_new_download=args.new_mutation_download, \
+                                  num_connections=args.download_connections))
+        scheduler.add_stage("download_mutation_resources", mutation_download_stage, \
+                            inputs=[] if mutation_download_location else ["library_directory"], \
+                            outputs=["mutation_archive"])
+        def mutation_integration_stage(library_directory, mutation_archive):
+            print "\n***********************************"
+            print "* Integrating Mutation Resources. *"
+            print "***********************************\n"
+            sys.stdout.flush()
+            integrate_mutation_resources(source_url=args.download_mutation_resources_url, \
+                                  mutation_archive_filepath=mutation_archive, \
+                                  genome_build_directory=library_directory, \
+                                  cosmic_resources_location=args.cosmic_resources_location, \
                                   force_new_integration=args.new_mutation_integration)
+        scheduler.add_stage("integrate_mutation_resources", mutation_integration_stage, \
+                            inputs=["library_directory", "mutation_archive"])
+
+    stage_values = scheduler.run()
+    genome_build_directory = stage_values["library_directory"]
+    extracted_directory = stage_values.get("extracted_directory")
+
+    # Once everything has been added to the library, the checksum of each of its files is recorded, 
+    # or, if asked, the library is first checked against the checksums recorded before.
+    # Only files that are new or changed since the checksums were recorded are read to record them.
+    _Telemetry.stage_started("library_checksums")
+    try:
+        if args.verify_library and (read_library_checksums(genome_build_directory) is None):
+            # The checksums about to be recorded are of the files as they are now, whatever state they are in,
+            # so the admin is told that this run has not checked them.
+            print "WARNING: The library was NOT verified, because no checksums were recorded for it:\n\t{:s}".format( \
+                  genome_build_directory)
+            print "The checksums of its files as they are now are being recorded, " + \
+                  "so later runs can verify the library against them."
+            sys.stdout.flush()
+            _Telemetry.event("library_not_verified", library=genome_build_directory, \
+                             reason="no checksums were recorded")
+        elif args.verify_library:
+            missing_paths, corrupted_paths, unrecorded_paths = \
+                verify_library(genome_build_directory, args.checksum_processes)
+            if missing_paths or corrupted_paths:
+                raise IOError("The library failed verification. " + \
+                              "{:d} files are missing and {:d} are corrupted in:\n\t{:s}".format( \
+                              len(missing_paths), len(corrupted_paths), genome_build_directory))
+        write_library_checksums(genome_build_directory, args.checksum_processes)
+    except BaseException as error:
+        _Telemetry.stage_finished("library_checksums", error)
+        raise
+    _Telemetry.stage_finished("library_checksums")
 
     # Need to get the genome name.
     genome_name = find_genome_name_in_path(args.download_url)
@@ -1551,6 +3732,9 @@ def main():
     data_manager_dict['data_tables'] = {}
     data_manager_dict['data_tables']['ctat_genome_resource_libs'] = []
     data_table_entry = dict(value=unique_id, name=display_name, path=genome_build_directory)
+    # The telemetry summary is not a column of the table, so it is not written to the .loc file,
+    # but it is kept with the data manager's output.
+    data_table_entry['telemetry'] = _Telemetry.summary()
     data_manager_dict['data_tables']['ctat_genome_resource_libs'].append(data_table_entry)
     
     # Create the data table for the cravat_tissues, if the file is given:
@@ -1574,6 +3758,7 @@ def main():
     # which then puts it into the correct .loc file (I think).
     # One can comment out the following line when testing without galaxy package.
     open(args.output_filename, 'wb').write(to_json_string(data_manager_dict))
+    _Telemetry.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+
+'''
+ctat_index_stager.py
+This program keeps copies of the Centrifuge indexes registered in ctat_centrifuge_indexes.loc on a node-local disk
+(an SSD, usually), so that a classification job reads its index from there instead of from the shared storage
+the loc file points at. It is run in front of the tool's command, like this:
+
+    python ctat_index_stager.py --index /shared/path/to/index/root_name -- metagenomics --index @INDEX@ ...
+
+and runs the command with @INDEX@ replaced by the path of a valid local copy (a replica) of the index.
+If there is no replica yet, one is made first, and the replicas that were used least recently are removed
+when the cache would otherwise grow past its size limit. A replica is valid only while the files of the index
+on the shared storage have the sizes and modification times they had when it was made, so a replaced index
+is copied again. If a replica cannot be used (the cache is full of replicas that are in use, another job is
+still making it, the local disk is too small), the command is given the shared path instead, as it was before.
+The files of a replica that was already there are read into the page cache before the command starts.
+Jobs hold a shared lock on the replica they use until their command ends, so it is never removed under them.
+
+The cache directory and its size limit are set with --cache_dir and --cache_max_bytes,
+or with the CTAT_INDEX_CACHE_DIR and CTAT_INDEX_CACHE_MAX_BYTES environment variables.
+--stage_loc_file makes and warms replicas of every index in a loc file, e.g. from a node's start up script.
+'''
+import argparse
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_CacheDirectory = os.environ.get('CTAT_INDEX_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ctat_index_cache'))
+_CacheMaxBytes = int(os.environ.get('CTAT_INDEX_CACHE_MAX_BYTES', '214748364800')) # 200 GB
+# Space that is left free on the local disk, besides the size limit of the cache.
+_FreeSpaceReserve = 1073741824 # 1 GB
+_CacheLockFile = 'index_cache.lock'
+_ReplicaLockSuffix = 'lock'
+_StagingPrefix = '.staging.'
+# A staging directory holds this file while its copy goes on, with the number of bytes the copy will write,
+# so other jobs making room in the cache count the space the copy is still to take.
+_StagingSizeFile = '.ctat_staging_bytes'
+# Each replica directory holds the index files, and these two files, whose names cannot be those of index files.
+# The manifest records the shared path of the index and the size and modification time each of its files had
+# when the replica was made. The modification time of the last used file is the time the replica was last used.
+_ReplicaManifestFile = '.ctat_replica_manifest'
+_ReplicaLastUsedFile = '.ctat_replica_last_used'
+_IndexPlaceholder = '@INDEX@'
+_CopyBlockSize = 16777216 # 16 MB
+_MaxWarmingThreads = 4
+
+def log_message(message):
+    # Messages go to stderr, so stdout holds just the path when --print_path is used.
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+def index_files_of(index_path):
+    # Returns a tuple of the directory holding the index at index_path, the name that is joined to the replica's
+    # directory to give the path the program is given, and a sorted list of (filename, size, mtime) of its files.
+    # index_path is either the directory joined with the root name of the index files, as the data manager
+    # registers it, or, as in older loc files, the directory itself, in which case all of its files are used.
+    # Raises an OSError if the index cannot be read.
+    index_path = os.path.realpath(index_path)
+    if os.path.isdir(index_path):
+        index_directory, root_name = index_path, ""
+        filenames = os.listdir(index_directory)
+    else:
+        index_directory, root_name = os.path.split(index_path)
+        filenames = [filename for filename in os.listdir(index_directory) if filename.startswith(root_name + ".")]
+    index_files = list()
+    for filename in sorted(filenames):
+        file_stat = os.stat(os.path.join(index_directory, filename))
+        if (not filename.startswith(".")) and os.path.isfile(os.path.join(index_directory, filename)):
+            index_files.append((filename, file_stat.st_size, int(file_stat.st_mtime)))
+    if len(index_files) == 0:
+        raise OSError(errno.ENOENT, "There are no index files for", index_path)
+    return (index_directory, root_name, index_files)
+
+def replica_name_of(index_path):
+    # Returns the name of the replica directory of the index at index_path.
+    # It is made from the shared path, so two indexes with the same root name do not share a replica.
+    index_path = os.path.realpath(index_path)
+    return "{:s}.{:s}".format(os.path.basename(index_path), hashlib.sha1(index_path).hexdigest()[:16])
+
+def read_replica_manifest(replica_directory):
+    # Returns a tuple of the shared path and the list of (filename, size, mtime) recorded for the replica,
+    # or (None, None) if it has no manifest, which is the case while it is being made.
+    manifest_filepath = os.path.join(replica_directory, _ReplicaManifestFile)
+    try:
+        with open(manifest_filepath, "r") as manifest_file:
+            lines = manifest_file.read().splitlines()
+    except IOError:
+        return (None, None)
+    index_files = list()
+    for line in lines[1:]:
+        filename, size, mtime = line.split("\t")
+        index_files.append((filename, int(size), int(mtime)))
+    return (lines[0], index_files)
+
+def write_replica_manifest(replica_directory, index_path, index_files):
+    with open(os.path.join(replica_directory, _ReplicaManifestFile), "w") as manifest_file:
+        manifest_file.write(os.path.realpath(index_path) + "\n")
+        for filename, size, mtime in index_files:
+            manifest_file.write("{:s}\t{:d}\t{:d}\n".format(filename, size, mtime))
+
+def replica_size_in_bytes(replica_directory):
+    # Returns the size of the replica, from its manifest, or from its files if it has none.
+    shared_path, index_files = read_replica_manifest(replica_directory)
+    if index_files is not None:
+        return sum([size for filename, size, mtime in index_files])
+    num_bytes = 0
+    for dirpath, dirnames, filenames in os.walk(replica_directory):
+        for filename in filenames:
+            num_bytes += os.path.getsize(os.path.join(dirpath, filename))
+    return num_bytes
+
+def staging_size_in_bytes(staging_directory):
+    # Returns a tuple of the number of bytes the copy into the staging directory will take in all,
+    # and the number it has written so far. A staging directory that is gone, because its copy has just
+    # been renamed into place or thrown away, takes no space.
+    written_bytes = 0
+    try:
+        for filename in os.listdir(staging_directory):
+            written_bytes += os.path.getsize(os.path.join(staging_directory, filename))
+    except OSError:
+        return (0, 0)
+    try:
+        with open(os.path.join(staging_directory, _StagingSizeFile), "r") as size_file:
+            reserved_bytes = int(size_file.read())
+    except (IOError, ValueError):
+        reserved_bytes = written_bytes
+    return (max(reserved_bytes, written_bytes), written_bytes)
+
+def replica_is_valid(replica_directory, index_path, index_files):
+    # Returns True if the replica holds a whole copy of the index at index_path as it is now.
+    # If index_files is None, because the shared storage could not be read, the replica is checked only against
+    # its own manifest, so jobs on the node keep working while the shared storage is away.
+    shared_path, replica_files = read_replica_manifest(replica_directory)
+    if (replica_files is None) or (shared_path != os.path.realpath(index_path)):
+        return False
+    if (index_files is not None) and (index_files != replica_files):
+        return False
+    for filename, size, mtime in replica_files:
+        try:
+            if os.path.getsize(os.path.join(replica_directory, filename)) != size:
+                return False
+        except OSError:
+            return False
+    return True
+
+def mark_replica_used(replica_directory):
+    last_used_filepath = os.path.join(replica_directory, _ReplicaLastUsedFile)
+    open(last_used_filepath, "a").close()
+    os.utime(last_used_filepath, None)
+
+def replica_last_used(replica_directory):
+    try:
+        return os.path.getmtime(os.path.join(replica_directory, _ReplicaLastUsedFile))
+    except OSError:
+        return 0
+
+class file_lock(object):
+    # An flock on the file at filepath, which is created if need be. The lock goes with the open file,
+    # so the operating system lets it go if the program dies.
+    def __init__(self, filepath):
+        self.lock_file = open(filepath, "a")
+    def acquire(self, operation, blocking=True):
+        # Returns True if the lock was taken. operation is fcntl.LOCK_SH or fcntl.LOCK_EX.
+        # Taking one kind of lock while holding the other converts it.
+        try:
+            fcntl.flock(self.lock_file.fileno(), operation | (0 if blocking else fcntl.LOCK_NB))
+        except IOError as lock_error:
+            if lock_error.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                return False
+            raise
+        return True
+    def release(self):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+    def close(self):
+        self.lock_file.close()
+# End of class file_lock
+
+class index_cache(object):
+    # The directory of replicas on the local disk, holding no more than max_bytes of them.
+    def __init__(self, cache_directory=_CacheDirectory, max_bytes=_CacheMaxBytes):
+        self.cache_directory = os.path.realpath(cache_directory)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.cache_directory):
+            try:
+                os.makedirs(self.cache_directory)
+            except OSError as exc:
+                if not ((exc.errno == errno.EEXIST) and os.path.isdir(self.cache_directory)):
+                    raise
+
+    def replica_lock_for(self, replica_name):
+        return file_lock(os.path.join(self.cache_directory, "{:s}.{:s}".format(replica_name, _ReplicaLockSuffix)))
+
+    def replica_names(self):
+        return [filename for filename in os.listdir(self.cache_directory) \
+                if os.path.isdir(os.path.join(self.cache_directory, filename)) \
+                and not filename.startswith(_StagingPrefix)]
+
+    def staging_directories(self):
+        return [os.path.join(self.cache_directory, filename) for filename in os.listdir(self.cache_directory) \
+                if filename.startswith(_StagingPrefix)]
+
+    def free_bytes(self):
+        file_system_stat = os.statvfs(self.cache_directory)
+        return file_system_stat.f_bavail * file_system_stat.f_frsize
+
+    def make_room_for(self, num_bytes, keep_replica_name):
+        # Removes the replicas that were used least recently, except keep_replica_name and those that are in use,
+        # until num_bytes more fit in the cache and on the disk. Returns True if they do.
+        # The copies that other jobs are making count as the whole of their replicas against the size limit,
+        # and what they have still to write counts against the free space.
+        # The caller holds the lock of the cache.
+        replicas = list()
+        for replica_name in self.replica_names():
+            if replica_name != keep_replica_name:
+                replica_directory = os.path.join(self.cache_directory, replica_name)
+                replicas.append((replica_last_used(replica_directory), replica_name, \
+                                 replica_size_in_bytes(replica_directory)))
+        staging_sizes = [staging_size_in_bytes(staging_directory) for staging_directory in self.staging_directories()]
+        cached_bytes = sum([size for last_used, replica_name, size in replicas]) \
+                       + sum([reserved_bytes for reserved_bytes, written_bytes in staging_sizes])
+        num_bytes_to_write = num_bytes + sum([reserved_bytes - written_bytes \
+                                              for reserved_bytes, written_bytes in staging_sizes])
+        for last_used, replica_name, size in sorted(replicas):
+            if (cached_bytes + num_bytes <= self.max_bytes) \
+                and (num_bytes_to_write + _FreeSpaceReserve <= self.free_bytes()):
+                break
+            replica_lock = self.replica_lock_for(replica_name)
+            try:
+                if not replica_lock.acquire(fcntl.LOCK_EX, blocking=False):
+                    # A job is using it.
+                    continue
+                log_message("Removing the least recently used index replica {:s} ({:d} bytes).".format( \
+                            replica_name, size))
+                shutil.rmtree(os.path.join(self.cache_directory, replica_name), ignore_errors=True)
+                cached_bytes -= size
+            finally:
+                replica_lock.close()
+        return (cached_bytes + num_bytes <= self.max_bytes) \
+            and (num_bytes_to_write + _FreeSpaceReserve <= self.free_bytes())
+
+    def reserve_staging(self, num_bytes):
+        # Makes a staging directory in the cache for a copy of num_bytes, and records the size in it,
+        # so the room the copy needs is not given to another job while it goes on (see make_room_for()).
+        # The caller holds the lock of the cache.
+        staging_directory = tempfile.mkdtemp(prefix=_StagingPrefix, dir=self.cache_directory)
+        with open(os.path.join(staging_directory, _StagingSizeFile), "w") as size_file:
+            size_file.write("{:d}\n".format(num_bytes))
+        return staging_directory
+
+    def copy_index(self, index_directory, index_files, staging_directory, replica_directory, index_path):
+        # Copies the index files to the staging directory made by reserve_staging(), then renames it to
+        # replica_directory. The rename is done holding the lock of the cache, so a job making room in the cache
+        # sees the copy either as a staging directory or as a replica.
+        # The copy is thrown away if a file of the index changed while it was copied.
+        try:
+            start_time = time.time()
+            for filename, size, mtime in index_files:
+                with open(os.path.join(index_directory, filename), "rb") as source_file:
+                    with open(os.path.join(staging_directory, filename), "wb") as replica_file:
+                        shutil.copyfileobj(source_file, replica_file, _CopyBlockSize)
+            if index_files_of(index_path)[2] != index_files:
+                raise IOError("The index at {:s} changed while it was copied.".format(index_path))
+            write_replica_manifest(staging_directory, index_path, index_files)
+            cache_lock = file_lock(os.path.join(self.cache_directory, _CacheLockFile))
+            try:
+                cache_lock.acquire(fcntl.LOCK_EX)
+                os.remove(os.path.join(staging_directory, _StagingSizeFile))
+                if os.path.exists(replica_directory):
+                    shutil.rmtree(replica_directory)
+                os.rename(staging_directory, replica_directory)
+            finally:
+                cache_lock.close()
+        except BaseException:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+            raise
+        wall_seconds = time.time() - start_time
+        num_bytes = sum([size for filename, size, mtime in index_files])
+        log_message("Copied {:d} bytes of the index to {:s} in {:.1f} seconds.".format( \
+                    num_bytes, replica_directory, wall_seconds))
+
+    def remove_abandoned_staging(self):
+        # Removes staging directories left by a program that died while copying. A staging directory whose
+        # copy is still going is newer than the time a copy of the largest index could take, so only
+        # those untouched for a day are removed.
+        for filename in os.listdir(self.cache_directory):
+            staging_directory = os.path.join(self.cache_directory, filename)
+            if filename.startswith(_StagingPrefix) and (time.time() - os.path.getmtime(staging_directory) > 86400):
+                shutil.rmtree(staging_directory, ignore_errors=True)
+
+    def acquire_replica(self, index_path):
+        # Returns a tuple of the path to give the program for the index at index_path, the file_lock
+        # that must be held while it is in use (None for the shared path), and whether the replica was already there.
+        # A valid replica is used if there is one. Otherwise one is made, if there is room for it
+        # and no other job is making it. If not, the shared index_path is returned.
+        replica_name = replica_name_of(index_path)
+        replica_directory = os.path.join(self.cache_directory, replica_name)
+        try:
+            index_directory, root_name, index_files = index_files_of(index_path)
+        except OSError as os_error:
+            log_message("Cannot read the index at {:s}: {:s}".format(index_path, str(os_error)))
+            index_directory, root_name, index_files = None, os.path.basename(os.path.realpath(index_path)), None
+            if os.path.isdir(os.path.realpath(index_path)):
+                root_name = ""
+        replica_path = os.path.join(replica_directory, root_name) if root_name else replica_directory
+        replica_lock = self.replica_lock_for(replica_name)
+        if not replica_lock.acquire(fcntl.LOCK_SH, blocking=False):
+            # Another job is making or removing the replica. Rather than wait on it, this one reads the shared index.
+            log_message("The replica of {:s} is being made by another job. Using the shared index.".format(index_path))
+            replica_lock.close()
+            return (index_path, None, False)
+        if replica_is_valid(replica_directory, index_path, index_files):
+            mark_replica_used(replica_directory)
+            return (replica_path, replica_lock, True)
+        if index_files is None:
+            replica_lock.close()
+            raise IOError("The index at {:s} cannot be read and has no local replica.".format(index_path))
+        if not replica_lock.acquire(fcntl.LOCK_EX, blocking=False):
+            # Other jobs are using the old replica, which stays until they are done.
+            log_message("An older replica of {:s} is in use. Using the shared index.".format(index_path))
+            replica_lock.close()
+            return (index_path, None, False)
+        # The shared lock may have been let go while it was converted, and the replica made meanwhile.
+        if replica_is_valid(replica_directory, index_path, index_files):
+            replica_lock.acquire(fcntl.LOCK_SH)
+            mark_replica_used(replica_directory)
+            return (replica_path, replica_lock, True)
+        try:
+            num_bytes = sum([size for filename, size, mtime in index_files])
+            cache_lock = file_lock(os.path.join(self.cache_directory, _CacheLockFile))
+            try:
+                cache_lock.acquire(fcntl.LOCK_EX)
+                self.remove_abandoned_staging()
+                if os.path.exists(replica_directory):
+                    shutil.rmtree(replica_directory)
+                have_room = self.make_room_for(num_bytes, replica_name)
+                # The room is reserved before the lock is let go, so two jobs cannot both be given it.
+                staging_directory = self.reserve_staging(num_bytes) if have_room else None
+            finally:
+                cache_lock.close()
+            if not have_room:
+                log_message("There is no room for the {:d} bytes of {:s} in {:s}. Using the shared index.".format( \
+                            num_bytes, index_path, self.cache_directory))
+                replica_lock.close()
+                return (index_path, None, False)
+            self.copy_index(index_directory, index_files, staging_directory, replica_directory, index_path)
+            mark_replica_used(replica_directory)
+            replica_lock.acquire(fcntl.LOCK_SH)
+        except (IOError, OSError) as copy_error:
+            log_message("Could not copy the index to {:s}: {:s}\nUsing the shared index.".format( \
+                        replica_directory, str(copy_error)))
+            replica_lock.close()
+            return (index_path, None, False)
+        except BaseException:
+            replica_lock.close()
+            raise
+        return (replica_path, replica_lock, False)
+# End of class index_cache
+
+def warm_page_cache(replica_path):
+    # Reads the files of the replica at replica_path, so they are in the page cache when the program loads them.
+    # Files already in the page cache are read at memory speed, so this costs little when it is not needed.
+    if os.path.isdir(replica_path):
+        replica_directory, root_name = replica_path, ""
+    else:
+        replica_directory, root_name = os.path.split(replica_path)
+    filepaths = [os.path.join(replica_directory, filename) for filename in sorted(os.listdir(replica_directory)) \
+                 if filename.startswith(root_name) and not filename.startswith(".")]
+    def read_files():
+        while True:
+            try:
+                filepath = filepaths.pop()
+            except IndexError:
+                return
+            with open(filepath, "rb") as replica_file:
+                while replica_file.read(_CopyBlockSize):
+                    pass
+    start_time = time.time()
+    threads = [threading.Thread(target=read_files) for thread_number in range(min(_MaxWarmingThreads, len(filepaths)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log_message("Read {:s} into the page cache in {:.1f} seconds.".format(replica_path, time.time() - start_time))
+
+def index_paths_in_loc_file(loc_filepath):
+    # Returns the paths of the indexes in a loc file, the third of its tab separated columns.
+    index_paths = list()
+    with open(loc_filepath, "r") as loc_file:
+        for line in loc_file:
+            columns = line.rstrip("\r\n").split("\t")
+            if (not line.startswith("#")) and (len(columns) >= 3) and columns[2].strip():
+                index_paths.append(columns[2].strip())
+    return index_paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a command with a node-local replica of a Centrifuge index.")
+    parser.add_argument('-i', '--index', \
+        help='The path of the index on the shared storage, as it is in ctat_centrifuge_indexes.loc.')
+    parser.add_argument('--print_path', action="store_true", \
+        help='Print the path of the replica (or of the shared index, if there is none), instead of running a command. ' + \
+             'Unlike a command run by this program, a job using the printed path does not keep the replica from being removed.')
+    parser.add_argument('--stage_loc_file', default=None, \
+        help='Make and warm replicas of all of the indexes in this loc file, e.g. when a node starts.')
+    parser.add_argument('--cache_dir', default=_CacheDirectory, \
+        help='The directory on the local disk where the replicas are kept.')
+    parser.add_argument('--cache_max_bytes', type=int, default=_CacheMaxBytes, \
+        help='The most bytes of replicas that are kept. The least recently used ones are removed to make room.')
+    parser.add_argument('--no_warm', action="store_true", \
+        help='Do not read the replica into the page cache before running the command.')
+    parser.add_argument('command', nargs=argparse.REMAINDER, \
+        help='The command to run, after --. {:s} in it is replaced by the path of the index.'.format(_IndexPlaceholder))
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+
+    cache = index_cache(args.cache_dir, args.cache_max_bytes)
+    if args.stage_loc_file is not None:
+        for index_path in index_paths_in_loc_file(args.stage_loc_file):
+            try:
+                replica_path, replica_lock, was_cached = cache.acquire_replica(index_path)
+            except IOError as index_error:
+                # An index that is away does not keep the others from being staged.
+                log_message("Not staging {:s}: {:s}".format(index_path, str(index_error)))
+                continue
+            if (replica_lock is not None) and not args.no_warm:
+                warm_page_cache(replica_path)
+            if replica_lock is not None:
+                replica_lock.close()
+    if args.index is None:
+        return 0
+
+    replica_path, replica_lock, was_cached = cache.acquire_replica(args.index)
+    log_message("Using the index at {:s}".format(replica_path))
+    if was_cached and not args.no_warm:
+        # A replica that was just copied is in the page cache already.
+        warm_page_cache(replica_path)
+    if args.print_path:
+        print replica_path
+        return 0
+    if len(command) == 0:
+        parser.error("There is no command to run.")
+    # The lock on the replica is held until the command ends, and is inherited by it.
+    exit_status = subprocess.call([argument.replace(_IndexPlaceholder, replica_path) for argument in command])
+    if replica_lock is not None:
+        replica_lock.close()
+    return exit_status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,7 +7,15 @@
 
 import argparse
 import os
+import sys
 import subprocess
+import tarfile
+import inspect
+import hashlib
+import shutil
+import ftplib
+import urllib
+import urlparse
 
 # The following is used to generate a unique_id value
 from datetime import *
@@ -26,6 +34,16 @@ from galaxy.util.json import to_json_string
 import urllib2
 from HTMLParser import HTMLParser
 
+# The annotations are downloaded by ctat_transfer, which is shared with the other CTAT Data Managers
+# and is kept next to this file.
+# Galaxy also runs this file to build the dynamic option list of the form (see the <code> tag in the .xml file),
+# without this directory in the python path and without setting __file__,
+# so the directory is found from the name of the file this code was compiled from.
+_DataManagerDirectory = os.path.dirname(os.path.realpath(inspect.currentframe().f_code.co_filename))
+if _DataManagerDirectory not in sys.path:
+    sys.path.insert(0, _DataManagerDirectory)
+import ctat_transfer
+
 #_CTAT_lncrnaIndexPage_URL = 'https://data.broadinstitute.org/Trinity/CTAT/lncrna/annotations.tar.gz'
 _CTAT_lncrnaDownload_URL = 'https://data.broadinstitute.org/Trinity/CTAT/lncrna/annotations.tar.gz'
 _CTAT_lncrnaTableName = 'ctat_lncrna_annotations'
@@ -34,8 +52,22 @@ _CTAT_lncrna_DisplayNamePrefix = 'CTAT_lncrna_annotations_'
 _lncrnaFileExtension = 'lc'
 _NumBytesNeededForAnnotations = 2147483648 # Number of bytes
 #_DownloadFileSize = 5790678746 # 5.4 Gigabytes.
-_Download_TestFile = 'write_testfile.txt'
 _DownloadSuccessFile = 'download_succeeded.txt'
+_DownloadBlockSize = 1048576 # 1 MB
+# The installed manifest lists the md5sum, size and path of each installed annotations file,
+# so an update can tell which of them changed.
+_InstalledManifestFile = 'annotations_manifest.txt'
+# The ETag, Last-Modified and size of the bundle the annotations were installed or last updated from.
+_BundleValidatorsFile = 'bundle_validators.txt'
+# A manifest of the bundle may be published with this appended to the bundle's url.
+_RemoteManifestSuffix = '.manifest'
+# New and changed files are staged here, inside the annotations directory, then renamed into place.
+_UpdateStagingDirname = '.update_staging'
+_UpdateJournalFile = 'update_journal.txt'
+# The telemetry file is written next to the data manager's output file, with this appended to its name.
+_TelemetryFileSuffix = 'telemetry.jsonl'
+# The telemetry log of this run, which the download reports its bytes to.
+_Telemetry = ctat_transfer.telemetry
 
 '''
 class FileListParser(HTMLParser):
@@ -76,9 +108,401 @@ def get_ctat_lncrna_annotations_locations():
     print str(options)
     return options 
 
-def download_annotations(src_location, destination, force_download):
+def stripped_member_path(member_name):
+    # Returns the path of the archive member member_name without the single top directory of the archive,
+    # the way "tar --strip 1" would, or None for the top directory itself
+    # and for a path that would land outside of the destination.
+    stripped_name = os.path.normpath(member_name).split(os.sep, 1)[1:]
+    if (not stripped_name) or os.path.isabs(stripped_name[0]) \
+        or (stripped_name[0].split(os.sep)[0] == os.pardir):
+        return None
+    return stripped_name[0]
+
+def is_bookkeeping_path(relative_path):
+    # Returns True if relative_path, under the annotations directory, is one of the files written by this
+    # data manager rather than one of the annotations, so it is left out of the manifests.
+    top_name = relative_path.split(os.sep)[0]
+    return (top_name in (_DownloadSuccessFile, _InstalledManifestFile, _BundleValidatorsFile, \
+                         _UpdateJournalFile, _UpdateStagingDirname)) \
+           or top_name.endswith(ctat_transfer._Write_TestFile) \
+           or top_name.endswith(_TelemetryFileSuffix)
+
+def parse_manifest(lines, manifest_name):
+    # Returns a dictionary of the files listed in lines of a manifest, keyed by path,
+    # with a tuple of the md5sum and size (None if it is not given) of each.
+    # The installed manifest has lines of "md5sum<tab>size<tab>path".
+    # Lines of "md5sum  path", as written by md5sum, are read too, so a published manifest can be either.
+    manifest = dict()
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if (not line.strip()) or line.startswith("#"):
+            continue
+        fields = line.split("\t")
+        if (len(fields) == 3) and fields[1].isdigit():
+            md5sum, file_size, file_path = fields[0], int(fields[1]), fields[2]
+        else:
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise ValueError("Cannot read the line of the manifest {:s}:\n\t{:s}".format(manifest_name, line))
+            md5sum, file_size, file_path = fields[0], None, fields[1].lstrip("*")
+        file_path = os.path.normpath(file_path)
+        if os.path.isabs(file_path) or (file_path.split(os.sep)[0] == os.pardir):
+            raise ValueError("The manifest {:s} has a path outside of the annotations:\n\t{:s}".format( \
+                             manifest_name, file_path))
+        manifest[file_path] = (md5sum.lower(), file_size)
+    return manifest
+
+def read_manifest(manifest_filepath):
+    # Returns the manifest in the file at manifest_filepath, as parse_manifest() does.
+    with open(manifest_filepath, "r") as manifest_file:
+        return parse_manifest(manifest_file, manifest_filepath)
+
+def write_manifest(manifest_filepath, manifest):
+    # Writes the dictionary manifest, as returned by read_manifest(), to manifest_filepath.
+    # It is written to a temporary file that is then renamed, so the manifest is never seen half written.
+    temporary_filepath = "{:s}.tmp".format(manifest_filepath)
+    with open(temporary_filepath, "w") as manifest_file:
+        for file_path in sorted(manifest):
+            md5sum, file_size = manifest[file_path]
+            manifest_file.write("{:s}\t{:d}\t{:s}\n".format(md5sum, file_size, file_path))
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.rename(temporary_filepath, manifest_filepath)
+
+def md5sum_of_file(filepath):
+    # Returns a tuple of the md5sum and size of the file at filepath.
+    md5 = hashlib.md5()
+    file_size = 0
+    with open(filepath, "rb") as input_file:
+        for data in iter(lambda: input_file.read(_DownloadBlockSize), ""):
+            md5.update(data)
+            file_size += len(data)
+    return (md5.hexdigest(), file_size)
+
+def manifest_of_directory(directory):
+    # Returns the manifest of the annotations files under directory, from their contents.
+    # It is used for annotations that were installed before the installed manifest was written.
+    manifest = dict()
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            relative_path = os.path.relpath(filepath, directory)
+            if (not is_bookkeeping_path(relative_path)) and os.path.isfile(filepath) \
+                and not os.path.islink(filepath):
+                manifest[relative_path] = md5sum_of_file(filepath)
+        dirnames[:] = [dirname for dirname in dirnames \
+                       if not is_bookkeeping_path(os.path.relpath(os.path.join(dirpath, dirname), directory))]
+    return manifest
+
+def installed_manifest_of(cannonical_destination):
+    # Returns the manifest of the annotations installed in cannonical_destination.
+    # If they were installed without a manifest, it is made from their contents and written,
+    # so later updates do not need to read them all again.
+    manifest_filepath = os.path.join(cannonical_destination, _InstalledManifestFile)
+    if os.path.exists(manifest_filepath):
+        return read_manifest(manifest_filepath)
+    print "Making the manifest of the annotations installed in:\n\t{:s}".format(cannonical_destination)
+    sys.stdout.flush()
+    manifest = manifest_of_directory(cannonical_destination)
+    write_manifest(manifest_filepath, manifest)
+    return manifest
+
+def bundle_validators_of(src_location):
+    # Returns the ETag, Last-Modified and size of the bundle at src_location, as the server gives them,
+    # as a dictionary of strings. An ftp server gives just the size.
+    if urlparse.urlparse(src_location).scheme not in ("http", "https"):
+        file_size = ctat_transfer.size_of(src_location)
+        return dict(size=str(file_size)) if file_size is not None else dict()
+    response = ctat_transfer.head_url(src_location)
+    validators = dict()
+    for name in ("etag", "last-modified"):
+        if response.headers.get(name):
+            validators[name] = response.headers[name]
+    if response.file_size is not None:
+        validators["size"] = str(response.file_size)
+    return validators
+
+def read_bundle_validators(cannonical_destination):
+    # Returns the validators of the bundle the annotations in cannonical_destination were installed
+    # or last updated from, as written by write_bundle_validators(), or an empty dictionary.
+    validators_filepath = os.path.join(cannonical_destination, _BundleValidatorsFile)
+    validators = dict()
+    if os.path.exists(validators_filepath):
+        with open(validators_filepath, "r") as validators_file:
+            for line in validators_file:
+                fields = line.rstrip("\r\n").split("\t", 1)
+                if len(fields) == 2:
+                    validators[fields[0]] = fields[1]
+    return validators
+
+def write_bundle_validators(cannonical_destination, src_location, validators):
+    # Records the validators of the bundle at src_location that the annotations in cannonical_destination
+    # now match, one "name<tab>value" per line.
+    validators_filepath = os.path.join(cannonical_destination, _BundleValidatorsFile)
+    with open("{:s}.tmp".format(validators_filepath), "w") as validators_file:
+        validators_file.write("url\t{:s}\n".format(src_location))
+        for name in sorted(validators):
+            validators_file.write("{:s}\t{:s}\n".format(name, validators[name]))
+    os.rename("{:s}.tmp".format(validators_filepath), validators_filepath)
+
+def bundle_is_unchanged(src_location, installed_validators, validators):
+    # Returns True if the bundle at src_location, with validators, is the one the annotations were installed from.
+    # The ETag is trusted when the server gives one, and otherwise the Last-Modified time and the size must both match.
+    if installed_validators.get("url") != src_location:
+        return False
+    if validators.get("etag"):
+        return validators["etag"] == installed_validators.get("etag")
+    return bool(validators.get("last-modified")) and bool(validators.get("size")) \
+           and (validators["last-modified"] == installed_validators.get("last-modified")) \
+           and (validators["size"] == installed_validators.get("size"))
+
+def write_staged_file(source_file, staged_filepath, mode=None):
+    # Writes everything read from source_file to staged_filepath, and returns a tuple of its md5sum and size.
+    # The file is synced to disk, so it is whole by the time it is swapped into the annotations.
+    if not os.path.isdir(os.path.dirname(staged_filepath)):
+        os.makedirs(os.path.dirname(staged_filepath))
+    md5 = hashlib.md5()
+    file_size = 0
+    with open(staged_filepath, "wb") as staged_file:
+        for data in iter(lambda: source_file.read(_DownloadBlockSize), ""):
+            staged_file.write(data)
+            md5.update(data)
+            file_size += len(data)
+        staged_file.flush()
+        os.fsync(staged_file.fileno())
+    if mode is not None:
+        os.chmod(staged_filepath, mode)
+    return (md5.hexdigest(), file_size)
+
+def stream_extract_annotations(src_location, staging_directory, installed_manifest):
+    # Extracts the archive at src_location into staging_directory as it is downloaded,
+    # so the archive is never written to disk. The archive holds a single top directory, which is
+    # left out of the extracted paths, the way "tar --strip 1" would.
+    # The md5sum of each file is taken as it is written, and a file that is the same as the one
+    # in installed_manifest is removed from the staging directory again, so only the files that changed
+    # are swapped into the annotations. With an empty installed_manifest, every file is kept.
+    # staging_directory is inside the annotations directory, where the unchanged target of a hard link is linked from.
+    # The download is read by a ctat_transfer.resumable_download_stream, so a dropped connection is resumed
+    # where it left off, and it holds a transfer slot, so it counts against the transfers allowed on the host.
+    # Returns a tuple of the manifest of the bundle, the paths of the files that are staged,
+    # and a dictionary of values for the telemetry summary of the stage.
+    print "Extracting the annotations as they are downloaded from:\n\t{:s}".format(src_location)
+    sys.stdout.flush()
+    bundle_manifest = dict()
+    changed_paths = list()
+    num_members = 0
+    with ctat_transfer.transfer_slot(src_location) as slot:
+        meter = ctat_transfer.progress_meter("download", src_location, ctat_transfer.size_of(src_location))
+        source = ctat_transfer.resumable_download_stream(src_location, slot=slot, meter=meter)
+        try:
+            with tarfile.open(fileobj=source, mode="r|gz", bufsize=_DownloadBlockSize) as archive_file:
+                for member in archive_file:
+                    member_path = stripped_member_path(member.name)
+                    if (member_path is None) or is_bookkeeping_path(member_path):
+                        continue
+                    num_members += 1
+                    if member.isdir():
+                        continue
+                    if not member.isfile():
+                        # Links and the like are few and small. They are extracted as they are and always swapped in.
+                        member.name = member_path
+                        if member.islnk():
+                            member.linkname = stripped_member_path(member.linkname) or member.linkname
+                            # A hard link is a file with the contents of its target, so it is in the manifest too,
+                            # and is not removed as a file that left the bundle.
+                            if member.linkname in bundle_manifest:
+                                bundle_manifest[member_path] = bundle_manifest[member.linkname]
+                            # The target of a hard link is in the staging directory only if it changed.
+                            # Otherwise the link is staged from the installed target, unless it is installed already.
+                            if member.linkname not in changed_paths:
+                                if (member_path in bundle_manifest) \
+                                    and (bundle_manifest[member_path] == installed_manifest.get(member_path)):
+                                    continue
+                                staged_filepath = os.path.join(staging_directory, member_path)
+                                if not os.path.isdir(os.path.dirname(staged_filepath)):
+                                    os.makedirs(os.path.dirname(staged_filepath))
+                                os.link(os.path.join(os.path.dirname(staging_directory), member.linkname), \
+                                        staged_filepath)
+                                changed_paths.append(member_path)
+                                continue
+                        archive_file.extract(member, path=staging_directory)
+                        changed_paths.append(member_path)
+                        continue
+                    staged_filepath = os.path.join(staging_directory, member_path)
+                    bundle_manifest[member_path] = write_staged_file(archive_file.extractfile(member), \
+                                                                     staged_filepath, member.mode)
+                    if bundle_manifest[member_path] == installed_manifest.get(member_path):
+                        os.remove(staged_filepath)
+                    else:
+                        changed_paths.append(member_path)
+            # Read anything after the end of the tar archive, so the whole download is checked.
+            while source.read(_DownloadBlockSize):
+                pass
+        finally:
+            source.close()
+        meter.finish()
+    if (source.total_bytes is not None) and (source.offset != source.total_bytes):
+        raise IOError("Download error:\n\tRead {:d} of the {:d} bytes of {:s}".format( \
+                      source.offset, source.total_bytes, src_location))
+    print "Read {:d} bytes from {:s}, resuming the download {:d} times.".format( \
+          source.offset, src_location, source.num_reconnects)
+    sys.stdout.flush()
+    return (bundle_manifest, changed_paths, \
+            dict(downloaded_bytes=source.offset, num_reconnects=source.num_reconnects, num_members=num_members))
+
+def fetch_remote_manifest(src_location):
+    # Returns the manifest published next to the bundle at src_location, or None if there is none.
+    manifest_url = src_location + _RemoteManifestSuffix
+    try:
+        manifest_text = ctat_transfer.read_url(manifest_url)
+    except urllib2.HTTPError as http_error:
+        if http_error.code in (403, 404, 410):
+            return None
+        raise
+    except ftplib.error_perm:
+        return None
+    return parse_manifest(manifest_text.splitlines(), manifest_url)
+
+def fetch_changed_members(src_location, remote_manifest, installed_manifest, staging_directory):
+    # Downloads into staging_directory each file of remote_manifest that is not in installed_manifest
+    # or that has a different md5sum or size there. The files are found under the directory of src_location
+    # named for the bundle's top directory, e.g. .../lncrna/annotations/hg38.bed for .../lncrna/annotations.tar.gz.
+    # Each file is checked against the md5sum and size in remote_manifest; a mismatch is raised as an IOError.
+    # Returns a tuple of the paths of the files that are staged and a dictionary of values for the telemetry summary.
+    root_annotations_dirname = src_location.split("/")[-1].split(".")[0]
+    members_url = "{:s}/{:s}/".format(src_location.rsplit("/", 1)[0], root_annotations_dirname)
+    changed_paths = list()
+    downloaded_bytes = 0
+    num_reconnects = 0
+    for member_path in sorted(remote_manifest):
+        md5sum, file_size = remote_manifest[member_path]
+        installed_md5sum, installed_size = installed_manifest.get(member_path, (None, None))
+        if (md5sum == installed_md5sum) and ((file_size is None) or (file_size == installed_size)):
+            # The installed manifest keeps the size, which a manifest written by md5sum does not give.
+            remote_manifest[member_path] = (md5sum, installed_size)
+            continue
+        member_url = urlparse.urljoin(members_url, urllib.quote(member_path.replace(os.sep, "/")))
+        print "Downloading the changed annotations file:\n\t{:s}".format(member_url)
+        sys.stdout.flush()
+        staged_filepath = os.path.join(staging_directory, member_path)
+        with ctat_transfer.transfer_slot(member_url) as slot:
+            meter = ctat_transfer.progress_meter("download", member_url, file_size)
+            source = ctat_transfer.resumable_download_stream(member_url, slot=slot, meter=meter)
+            try:
+                staged_md5sum, staged_size = write_staged_file(source, staged_filepath)
+            finally:
+                source.close()
+            meter.finish()
+        downloaded_bytes += staged_size
+        num_reconnects += source.num_reconnects
+        if (staged_md5sum != md5sum) or ((file_size is not None) and (staged_size != file_size)):
+            raise IOError("Download error:\n\tThe md5sum and size of {:s} are {:s} and {:d}, not {:s} and {:s}.".format( \
+                          member_url, staged_md5sum, staged_size, md5sum, str(file_size)))
+        if file_size is None:
+            remote_manifest[member_path] = (md5sum, staged_size)
+        changed_paths.append(member_path)
+    return (changed_paths, dict(downloaded_bytes=downloaded_bytes, num_reconnects=num_reconnects, \
+                                num_members=len(remote_manifest)))
+
+def swap_in_staged_files(cannonical_destination, changed_paths, removed_paths, new_manifest):
+    # Moves the staged files at changed_paths over the installed ones, removes the installed files at removed_paths,
+    # and writes new_manifest as the installed manifest.
+    # Each file is renamed into place, so it is replaced at once and is never seen half written.
+    # The new manifest is staged too, and an update journal listing every step is written before the first one,
+    # so an update that is interrupted part way is finished by finish_interrupted_update() on the next run.
+    staging_directory = os.path.join(cannonical_destination, _UpdateStagingDirname)
+    write_manifest(os.path.join(staging_directory, _InstalledManifestFile), new_manifest)
+    journal_filepath = os.path.join(cannonical_destination, _UpdateJournalFile)
+    with open("{:s}.tmp".format(journal_filepath), "w") as journal_file:
+        for member_path in changed_paths:
+            journal_file.write("replace\t{:s}\n".format(member_path))
+        for member_path in removed_paths:
+            journal_file.write("remove\t{:s}\n".format(member_path))
+        journal_file.write("replace\t{:s}\n".format(_InstalledManifestFile))
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.rename("{:s}.tmp".format(journal_filepath), journal_filepath)
+    finish_interrupted_update(cannonical_destination)
+
+def finish_interrupted_update(cannonical_destination):
+    # Carries out the steps in the update journal of cannonical_destination, if there is one,
+    # then removes the journal and the staging directory. A step that was already done is skipped.
+    journal_filepath = os.path.join(cannonical_destination, _UpdateJournalFile)
+    staging_directory = os.path.join(cannonical_destination, _UpdateStagingDirname)
+    if os.path.exists(journal_filepath):
+        print "Swapping the updated files into:\n\t{:s}".format(cannonical_destination)
+        sys.stdout.flush()
+        with open(journal_filepath, "r") as journal_file:
+            steps = [line.rstrip("\r\n").split("\t", 1) for line in journal_file if line.strip()]
+        for action, member_path in steps:
+            installed_filepath = os.path.join(cannonical_destination, member_path)
+            if action == "replace":
+                staged_filepath = os.path.join(staging_directory, member_path)
+                if os.path.lexists(staged_filepath):
+                    if not os.path.isdir(os.path.dirname(installed_filepath)):
+                        os.makedirs(os.path.dirname(installed_filepath))
+                    os.rename(staged_filepath, installed_filepath)
+            elif (action == "remove") and os.path.lexists(installed_filepath):
+                os.remove(installed_filepath)
+        os.remove(journal_filepath)
+    if os.path.exists(staging_directory):
+        # Left from an update that failed before it wrote its journal, or emptied by the swap.
+        shutil.rmtree(staging_directory)
+
+def install_annotations(src_location, cannonical_destination, update):
+    # Installs the annotations at src_location into cannonical_destination, or, if update is True,
+    # brings the annotations already installed there up to date with it.
+    # Every file that is new or changed is staged in a directory inside cannonical_destination,
+    # on the same file system, then swapped in by swap_in_staged_files(). Files that are no longer in the bundle are removed.
+    # An update does nothing if the server says the bundle is the one the annotations came from.
+    # Otherwise, if a manifest is published next to the bundle, only the files that differ from it are downloaded.
+    # If not, the bundle is streamed, and only the files that differ from the installed ones are written.
+    # Returns a dictionary of values for the telemetry summary of the stage.
+    finish_interrupted_update(cannonical_destination)
+    installed_manifest = installed_manifest_of(cannonical_destination) if update else dict()
+    validators = bundle_validators_of(src_location)
+    if update and bundle_is_unchanged(src_location, read_bundle_validators(cannonical_destination), validators):
+        print "The annotations are up to date with:\n\t{:s}".format(src_location)
+        sys.stdout.flush()
+        return dict(update_method="unchanged", num_changed_files=0, num_removed_files=0, downloaded_bytes=0)
+    staging_directory = os.path.join(cannonical_destination, _UpdateStagingDirname)
+    os.makedirs(staging_directory)
+    remote_manifest = fetch_remote_manifest(src_location) if update else None
+    stage_fields = None
+    if remote_manifest is not None:
+        needed_bytes = sum([file_size or 0 for member_path, (md5sum, file_size) in remote_manifest.items() \
+                            if (md5sum, file_size) != installed_manifest.get(member_path)])
+        ctat_transfer.ensure_we_can_write_numbytes_to(staging_directory, needed_bytes)
+        try:
+            changed_paths, stage_fields = fetch_changed_members(src_location, remote_manifest, \
+                                                                installed_manifest, staging_directory)
+            new_manifest = remote_manifest
+            stage_fields["update_method"] = "manifest"
+        except ctat_transfer.TransferErrors as transfer_error:
+            print "Could not download the changed files one at a time:\n\t{:s}\n" \
+                  "The whole bundle will be read instead.".format(str(transfer_error))
+            sys.stdout.flush()
+            shutil.rmtree(staging_directory)
+            os.makedirs(staging_directory)
+            stage_fields = None
+    if stage_fields is None:
+        ctat_transfer.ensure_we_can_write_numbytes_to(staging_directory, _NumBytesNeededForAnnotations)
+        new_manifest, changed_paths, stage_fields = stream_extract_annotations(src_location, staging_directory, \
+                                                                              installed_manifest)
+        stage_fields["update_method"] = "bundle" if update else "install"
+    removed_paths = [member_path for member_path in installed_manifest if member_path not in new_manifest]
+    swap_in_staged_files(cannonical_destination, changed_paths, removed_paths, new_manifest)
+    write_bundle_validators(cannonical_destination, src_location, validators)
+    print "{:d} annotations files were changed and {:d} were removed.".format(len(changed_paths), len(removed_paths))
+    sys.stdout.flush()
+    stage_fields.update(num_changed_files=len(changed_paths), num_removed_files=len(removed_paths))
+    return stage_fields
+
+def download_annotations(src_location, destination, force_download, update_annotations=False):
     # We do not know if the annotations has been downloaded already.
     # This function returns whether or not the annotations actually gets downloaded.
+    # If update_annotations is True, annotations that were downloaded already are brought up to date
+    # with src_location, by downloading only the files that changed (see install_annotations()).
     annotations_was_downloaded = False
     # Get the root filename of the Genome Directory. 
     # The part after the last '/' and before the first '.'
@@ -88,53 +512,24 @@ def download_annotations(src_location, destination, force_download):
     cannonical_destination = os.path.realpath(destination) 
     if cannonical_destination.split("/")[-1] != root_annotations_dirname:
         cannonical_destination += "/" + root_annotations_dirname
-    if os.path.exists(cannonical_destination):
-        if not os.path.isdir(cannonical_destination):
-            raise ValueError("The destination is not a directory: " + \
-                             "{:s}".format(cannonical_destination))
-        # else all is good. It is a directory.
-    else:
-        # We need to create it.
-        try:
-            os.makedirs(cannonical_destination)
-        except os.error:
-            print "ERROR: Trying to create the following directory path:"
-            print "\t{:s}".format(cannonical_destination)
-            raise
-
-    # Make sure the directory now exists and we can write to it.
-    if not os.path.exists(cannonical_destination):
-        # It should have been created, but if it doesn't exist at this point
-        # in the code, something is wrong. Raise an error.
-        raise OSError("The destination directory could not be created: " + \
-                      "{:s}".format(cannonical_destination))
-    test_writing_file = "{:s}/{:s}".format(cannonical_destination, _Download_TestFile)
-    try:
-        filehandle = open(test_writing_file, "w")
-        filehandle.write("Testing writing to this file.")
-        filehandle.close()
-        os.remove(test_writing_file)
-    except IOError:
-        print "The destination directory could not be written into: " + \
-                      "{:s}".format(cannonical_destination)
-        raise
+    # The directory is created if needed, and must be writable.
+    cannonical_destination = ctat_transfer.ensure_we_can_write_numbytes_to(cannonical_destination, 0)
     
     # Get the list of files in the directory,
     # We use it to check for a previous download or extraction among other things.
     orig_files_in_destdir = set(os.listdir(cannonical_destination))
     # See whether the file has been downloaded already.
     download_success_file_path = "{:s}/{:s}".format(cannonical_destination, _DownloadSuccessFile)
-    if (_DownloadSuccessFile not in orig_files_in_destdir) or force_download:
-        # Check whether there is enough space on the device for the annotations.
-        statvfs = os.statvfs(cannonical_destination)
-        num_avail_bytes = statvfs.f_frsize * statvfs.f_bavail    # Number of free bytes that ordinary users
-                                                                 # are allowed to use (excl. reserved space)
-        if (num_avail_bytes < _NumBytesNeededForAnnotations):
-            raise OSError("There is insufficient space ({:s} bytes)".format(str(num_avail_bytes)) + \
-                          " on the device of the destination directory: " + \
-                          "{:s}".format(cannonical_destination))
-    
-        
+    if (_DownloadSuccessFile in orig_files_in_destdir) and update_annotations and not force_download:
+        try: # to update the annotations.
+            _Telemetry.run_stage("update_annotations", \
+                                 lambda: install_annotations(src_location, cannonical_destination, update=True))
+        except ctat_transfer.TransferErrors + (tarfile.TarError,):
+            print "ERROR: Trying to update the annotations from:\n\t{:s}".format(src_location)
+            raise
+        else:
+            annotations_was_downloaded = True
+    elif (_DownloadSuccessFile not in orig_files_in_destdir) or force_download:
         if (_DownloadSuccessFile in orig_files_in_destdir):
             # Since we are redoing the download, 
             # the success file needs to be removed
@@ -142,15 +537,13 @@ def download_annotations(src_location, destination, force_download):
             os.remove(download_success_file_path)
         # We want to transfer and untar the file without storing the tar file, because that
         # adds all that much more space to the needed amount of free space on the disk.
-        # Use subprocess to pipe the output of curl into tar.
-        # Make curl silent so progress is not printed to stderr.
-        command = "curl --silent {:s} | tar -xzf - -C {:s} --strip 1".format(src_location, cannonical_destination) 
-        try: # to send the command that downloads and extracts the file.
-            command_output = subprocess.check_output(command, shell=True)
-            # FIX - not sure check_output is what we want to use. If we want to have an error raised on
-            # any problem, maybe we should not be checking output.
-        except subprocess.CalledProcessError:
-            print "ERROR: Trying to run the following command:\n\t{:s}".format(command)
+        # The archive used to be piped from curl into tar, but then a dropped connection started the
+        # download over, and an error from curl was hidden by the exit status of tar.
+        try: # to download and extract the file.
+            _Telemetry.run_stage("download_and_extract_annotations", \
+                                 lambda: install_annotations(src_location, cannonical_destination, update=False))
+        except ctat_transfer.TransferErrors + (tarfile.TarError,):
+            print "ERROR: Trying to download and extract:\n\t{:s}".format(src_location)
             raise
         else:
             annotations_was_downloaded = True
@@ -160,7 +553,9 @@ def download_annotations(src_location, destination, force_download):
     if os.path.exists(cannonical_destination) and os.path.isdir(cannonical_destination):
         subprocess.check_call("ls -la {:s} 2>&1".format(cannonical_destination), shell=True)
     
-    files_in_destdir = set(os.listdir(cannonical_destination))
+    # The files written by this data manager, like the manifest, are not counted as annotations files.
+    files_in_destdir = set([filename for filename in os.listdir(cannonical_destination) \
+                            if not is_bookkeeping_path(filename)])
     found_filenames = set()
     for filename in files_in_destdir:
         # There should be three files, but some OS's might have created
@@ -205,8 +600,23 @@ def main():
     parser.add_argument('-f', '--force_download', 
         help='Forces download of lncrna annotations, even if previously downloaded. ' + \
              'Requires download_location to be set in order to work.', action="store_true")
+    parser.add_argument('-u', '--update_annotations', \
+        help='If the annotations were downloaded already, download only the files that have changed since, ' + \
+             'and swap them in, instead of downloading them all again.', action="store_true")
+    parser.add_argument('--telemetry_file', default="", \
+        help='Full path of the file where the telemetry events are written as JSON lines. ' + \
+             'By default it is written next to the output file, with ' + \
+             '.{:s} appended to the output file\'s name.'.format(_TelemetryFileSuffix))
     args = parser.parse_args()
 
+    if (args.telemetry_file is not None) and (args.telemetry_file != ""):
+        telemetry_filepath = args.telemetry_file
+    else:
+        telemetry_filepath = "{:s}.{:s}".format(os.path.realpath(args.output_filename), _TelemetryFileSuffix)
+    # The progress of the download, and any resumption of it, are recorded too.
+    _Telemetry.open(telemetry_filepath)
+    print "Telemetry is written to:\n\t{:s}".format(telemetry_filepath)
+
     # print "Arguments are parsed."
     print "\ndownload_location is {:s}".format(str(_CTAT_lncrnaDownload_URL))
     print "display_name is {:s}".format(str(args.display_name))
@@ -219,7 +629,8 @@ def main():
         annotations_directory, root_annotations_dirname, annotations_was_downloaded = \
             download_annotations(src_location=_CTAT_lncrnaDownload_URL, \
                            destination=args.destination_path, \
-                           force_download=args.force_download)
+                           force_download=args.force_download, \
+                           update_annotations=args.update_annotations)
     else:
         cannonical_destination = os.path.realpath(args.destination_path)
         # If args.destination_path is a directory containing 
@@ -300,16 +711,23 @@ def main():
     data_manager_dict = {}
     data_manager_dict['data_tables'] = {}
     data_manager_dict['data_tables'][_CTAT_lncrnaTableName] = []
-    data_table_entry_mm9 = dict(value=display_name_mm9, name=display_name_mm9, path=annotations_file_path_mm9)
+    # The telemetry summary is not a column of the table, so it is not written to the .loc file,
+    # but it is kept with the data manager's output.
+    telemetry = _Telemetry.summary()
+    data_table_entry_mm9 = dict(value=display_name_mm9, name=display_name_mm9, path=annotations_file_path_mm9, \
+                                telemetry=telemetry)
     data_manager_dict['data_tables'][_CTAT_lncrnaTableName].append(data_table_entry_mm9)
 
-    data_table_entry_mm10 = dict(value=display_name_mm10, name=display_name_mm10, path=annotations_file_path_mm10)
+    data_table_entry_mm10 = dict(value=display_name_mm10, name=display_name_mm10, path=annotations_file_path_mm10, \
+                                 telemetry=telemetry)
     data_manager_dict['data_tables'][_CTAT_lncrnaTableName].append(data_table_entry_mm10)
 
-    data_table_entry_hg19 = dict(value=display_name_hg19, name=display_name_hg19, path=annotations_file_path_hg19)
+    data_table_entry_hg19 = dict(value=display_name_hg19, name=display_name_hg19, path=annotations_file_path_hg19, \
+                                 telemetry=telemetry)
     data_manager_dict['data_tables'][_CTAT_lncrnaTableName].append(data_table_entry_hg19)
 
-    data_table_entry_hg38 = dict(value=display_name_hg38, name=display_name_hg38, path=annotations_file_path_hg38)
+    data_table_entry_hg38 = dict(value=display_name_hg38, name=display_name_hg38, path=annotations_file_path_hg38, \
+                                 telemetry=telemetry)
     data_manager_dict['data_tables'][_CTAT_lncrnaTableName].append(data_table_entry_hg38)
 
     # Temporarily the output file's dictionary is written for debugging:
@@ -318,6 +736,7 @@ def main():
     # which then puts it into the correct .loc file (I think).
     # Remove the following line when testing without galaxy package.
     open(args.output_filename, 'wb').write(to_json_string(data_manager_dict))
+    _Telemetry.close()
 
 if __name__ == "__main__":
     main()
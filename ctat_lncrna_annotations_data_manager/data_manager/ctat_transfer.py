@@ -0,0 +1,791 @@
+#!/usr/bin/env python
+# This is part of the Data Manager code to be used within a Galaxy.
+
+# The CTAT Data Managers (for the Genome Resource Libraries, the Centrifuge Indexes and the lncrna annotations)
+# all list, size, download and extract files from the web. This module does those transfers for all of them,
+# so they share:
+#     persistent (keep-alive) http and https connections, pooled by host, so the size of a file, its .md5 file,
+#         the pages listing the files and the download itself do not each pay for a new connection and TLS handshake.
+#     a budget of transfers and bandwidth for all of the data managers running on a host (see transfer_slot),
+#         so concurrent installs share the network rather than starving each other.
+#     downloads that resume where they left off when a connection drops (see resumable_download_stream).
+#     one way to report the progress of a transfer (see progress_meter and add_event_listener).
+#     one telemetry log of what each stage of a data manager did (see telemetry_log), which the transfers
+#         report their bytes and throughput to.
+#     the checks that a destination can be written to and has room (see ensure_we_can_write_numbytes_to).
+#     the cache of the web pages listing the files that can be downloaded (see get_listing_html).
+# Each Data Manager is its own Toolshed repository, so each has a copy of this file next to it.
+# The copies are kept identical.
+#
+# The budget is set with environment variables, so it is the same for every data manager run on the host:
+#     CTAT_MAX_TRANSFERS - the most transfers (connections downloading a file) at once. The default is 8.
+#     CTAT_MAX_TRANSFER_BYTES_PER_SECOND - the bandwidth the transfers share. The default, 0, is no limit.
+#     CTAT_TRANSFER_STATE_DIR - the directory holding the lock files of the transfer slots.
+#         Data managers share the budget when they use the same directory.
+
+import sys
+# The many calls to sys.stdout.flush() are done in order to get the output to be synchronized.
+# Otherwise output from subprocesses can get streamed to stdout in a disjunct manner from
+# the output of the process running this code.
+import os
+import errno
+import fcntl
+import socket
+import threading
+import time
+import resource
+import tempfile
+import hashlib
+import json
+import contextlib
+import urllib
+import urllib2
+import urlparse
+import httplib
+import ftplib
+
+_MaxTransfers = max(int(os.environ.get('CTAT_MAX_TRANSFERS', '8')), 1)
+_MaxBytesPerSecond = max(int(os.environ.get('CTAT_MAX_TRANSFER_BYTES_PER_SECOND', '0')), 0)
+_TransferStateDirectory = os.environ.get('CTAT_TRANSFER_STATE_DIR', \
+                                         os.path.join(tempfile.gettempdir(), 'ctat_transfer_state'))
+_TransferSlotFile = 'transfer_slot.{:d}.lock'
+_SlotPollInterval = 2 # seconds between attempts to get a transfer slot when all of them are in use.
+_BudgetRefreshInterval = 5 # seconds between counts of the transfers sharing the bandwidth.
+_ConnectionTimeout = 60 # seconds without data before a connection is considered lost.
+_MaxIdleConnectionsPerHost = 8
+_MaxRedirects = 5
+_DownloadBlockSize = 1048576 # 1 MB
+_NumReconnectAttempts = 5 # failed reconnections in a row before a download is given up.
+_ReconnectDelay = 5 # seconds before the first reconnection. It doubles with each failure in a row.
+_ProgressInterval = 10 # seconds between progress events for a transfer.
+_Write_TestFile = 'write_testfile.txt'
+# The errors that a dropped or stalled connection can raise while a file is downloaded, for the data managers to catch.
+TransferErrors = ftplib.all_errors + (httplib.HTTPException,)
+# The listing cache directory can be set with the CTAT_LISTING_CACHE_DIR environment variable.
+_ListingCacheDirectory = os.environ.get('CTAT_LISTING_CACHE_DIR', \
+                                        os.path.join(tempfile.gettempdir(), 'ctat_listing_cache'))
+_ListingCacheTimeToLive = 3600 # 1 hour. Older cached pages are revalidated in the background.
+_ListingFetchTimeout = 10 # seconds
+_ListingRefreshLock = threading.Lock()
+_ListingRefreshesInProgress = set()
+# The functions given to add_event_listener().
+_EventListeners = list()
+
+def add_event_listener(listener):
+    # listener is called as listener(event_name, fields) with each event of the transfers,
+    # besides the event being recorded in the telemetry log. The events are:
+    #     transfer_started, transfer_progress, transfer_finished - from a progress_meter.
+    #     download_resumed - a resumable_download_stream connected again after an error.
+    #     transfer_slot_wait_started, transfer_slot_wait_finished - a transfer waited for a transfer slot.
+    _EventListeners.append(listener)
+
+def report_event(event_name, **fields):
+    telemetry.event(event_name, **fields)
+    for listener in _EventListeners:
+        listener(event_name, fields)
+
+class telemetry_log(object):
+    # The telemetry log records what each stage of a data manager did as JSON lines in a file,
+    # so one can tell whether an install is slowed by the network, by decompression or by the build.
+    # Each line is a dictionary with the time, the seconds since the run started, the name of the event
+    # and the stage it belongs to. The events are:
+    #     run_started, run_finished - written by open() and close().
+    #     stage_started, stage_finished - with the wall time and status of the stage.
+    #     transfer_started, transfer_progress, transfer_finished - bytes moved by a download, extraction
+    #         or hashing, with the throughput and the estimated time left (see progress_meter).
+    #     the other events of the transfers (see add_event_listener), and those of the data manager,
+    #         e.g. the CPU seconds and resident memory of a child process.
+    # The stage of an event is the stage run by the thread that started the transfer or process.
+    # A summary of each stage is kept as the events are recorded, and is attached to the data table entry.
+    # The bytes of a stage are those counted by its progress_meters, by kind, so nothing is walked to measure them.
+    # Until open() is called, events are only summarized and not written.
+    # There is one telemetry log per data manager run, the telemetry of this module.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread_stages = dict()
+        self.stage_summaries = dict()
+        self.start_time = time.time()
+        self.filepath = None
+        self.log_file = None
+    def open(self, filepath):
+        self.filepath = filepath
+        self.log_file = open(filepath, "w")
+        self.event("run_started", pid=os.getpid())
+    def close(self):
+        self.event("run_finished", wall_seconds=round(time.time() - self.start_time, 3))
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+    def current_stage(self):
+        return self.thread_stages.get(threading.current_thread().ident)
+    def event(self, event_name, stage=None, **fields):
+        now = time.time()
+        record = dict(fields, time=round(now, 3), elapsed=round(now - self.start_time, 3), event=event_name, \
+                      stage=stage or self.current_stage())
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.write(json.dumps(record, sort_keys=True) + "\n")
+                self.log_file.flush()
+    def stage_summary(self, stage):
+        # Returns the summary dictionary of stage, creating it if needed. Must be called holding the lock.
+        if stage not in self.stage_summaries:
+            self.stage_summaries[stage] = dict(status="running", wall_seconds=0.0, bytes=dict(), \
+                                               cpu_seconds=0.0, peak_rss_bytes=0)
+        return self.stage_summaries[stage]
+    def stage_started(self, stage):
+        with self.lock:
+            self.thread_stages[threading.current_thread().ident] = stage
+            self.stage_summary(stage)["started"] = time.time()
+        self.event("stage_started", stage)
+    def stage_finished(self, stage, error=None):
+        with self.lock:
+            self.thread_stages.pop(threading.current_thread().ident, None)
+            summary = self.stage_summary(stage)
+            summary["wall_seconds"] = round(time.time() - summary.pop("started", self.start_time), 3)
+            summary["status"] = "failed" if error is not None else "succeeded"
+        fields = dict(wall_seconds=summary["wall_seconds"], status=summary["status"])
+        if error is not None:
+            fields["error"] = str(error)
+        self.event("stage_finished", stage, **fields)
+    def run_stage(self, stage, stage_function):
+        # Calls stage_function as stage, and returns what it returns.
+        # This is for the data managers that run one stage at a time, since the CPU time and peak memory
+        # recorded for the stage are those of this whole program and of the child processes it has waited for.
+        # stage_function may return a dictionary of more values to add to the summary of the stage.
+        self.stage_started(stage)
+        start_cpu_seconds = cpu_seconds_used()
+        try:
+            stage_fields = stage_function()
+        except BaseException as error:
+            self.add_process(stage, cpu_seconds_used() - start_cpu_seconds, peak_rss_bytes_used())
+            self.stage_finished(stage, error)
+            raise
+        self.add_process(stage, cpu_seconds_used() - start_cpu_seconds, peak_rss_bytes_used())
+        if stage_fields:
+            with self.lock:
+                self.stage_summary(stage).update(stage_fields)
+        self.stage_finished(stage)
+        return stage_fields
+    def add_transfer(self, stage, kind, num_bytes, seconds):
+        with self.lock:
+            transfer = self.stage_summary(stage)["bytes"].setdefault(kind, dict(bytes=0, seconds=0.0))
+            transfer["bytes"] += num_bytes
+            transfer["seconds"] = round(transfer["seconds"] + seconds, 3)
+    def add_process(self, stage, cpu_seconds, peak_rss_bytes):
+        with self.lock:
+            summary = self.stage_summary(stage)
+            summary["cpu_seconds"] = round(summary["cpu_seconds"] + cpu_seconds, 3)
+            summary["peak_rss_bytes"] = max(summary["peak_rss_bytes"], peak_rss_bytes)
+    def summary(self):
+        # Returns a dictionary holding the summary of each stage and the wall time of the whole run.
+        with self.lock:
+            stages = dict()
+            for stage, summary in self.stage_summaries.items():
+                stages[stage] = dict(summary)
+                stages[stage].pop("started", None)
+                stages[stage]["bytes"] = dict([(kind, dict(transfer)) for kind, transfer in summary["bytes"].items()])
+                for transfer in stages[stage]["bytes"].values():
+                    if transfer["seconds"] > 0:
+                        transfer["bytes_per_second"] = int(transfer["bytes"] / transfer["seconds"])
+        return dict(stages=stages, wall_seconds=round(time.time() - self.start_time, 3), \
+                    telemetry_file=self.filepath)
+# End of class telemetry_log
+
+telemetry = telemetry_log()
+
+def cpu_seconds_used():
+    # Returns the CPU time used so far by this program and by the child processes it has waited for.
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+def peak_rss_bytes_used():
+    # Returns the peak resident memory of this program, or of its largest child that it has waited for.
+    # ru_maxrss is in kilobytes on linux.
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+class progress_meter(object):
+    # Counts the bytes of one transfer, such as a download, an extraction or the hashing of files,
+    # which may be added from several threads, and reports a transfer_started event, transfer_progress
+    # events at most every _ProgressInterval seconds, and a transfer_finished event.
+    # kind is e.g. "download" or "extraction", and total_bytes is the number of bytes expected, if known.
+    # Bytes that were already in place when a transfer is resumed (already_done) are not counted,
+    # so the throughput is that of this run.
+    # The events are recorded in the telemetry log as events of the stage that created the meter,
+    # the bytes are added to the summary of that stage when it finishes, and the events are given to the event listeners.
+    def __init__(self, kind, name, total_bytes=None, already_done=0):
+        self.stage = telemetry.current_stage()
+        self.kind = kind
+        self.name = name
+        self.total_bytes = total_bytes
+        self.already_done = already_done
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        self.report("transfer_started", dict(kind=kind, name=name, total_bytes=total_bytes, already_done=already_done))
+    def report(self, event_name, fields):
+        telemetry.event(event_name, self.stage, **fields)
+        if event_name == "transfer_finished":
+            telemetry.add_transfer(self.stage, self.kind, self.num_bytes, fields["seconds"])
+        for listener in _EventListeners:
+            listener(event_name, fields)
+    def progress_fields(self, now):
+        seconds = now - self.start_time
+        fields = dict(kind=self.kind, name=self.name, bytes=self.num_bytes, total_bytes=self.total_bytes, \
+                      seconds=round(seconds, 3), bytes_per_second=int(self.num_bytes / seconds) if seconds > 0 else None)
+        if self.total_bytes and self.num_bytes > 0:
+            bytes_left = max(self.total_bytes - self.already_done - self.num_bytes, 0)
+            fields["eta_seconds"] = round(bytes_left * seconds / self.num_bytes, 1)
+        return fields
+    def add(self, num_bytes):
+        with self.lock:
+            self.num_bytes += num_bytes
+            now = time.time()
+            if now - self.last_report < _ProgressInterval:
+                return
+            self.last_report = now
+            fields = self.progress_fields(now)
+        self.report("transfer_progress", fields)
+    def finish(self):
+        with self.lock:
+            fields = self.progress_fields(time.time())
+        self.report("transfer_finished", fields)
+        return fields
+# End of class progress_meter
+
+class transfer_slot(object):
+    # One of the _MaxTransfers transfers that the data managers on this host may make at once.
+    # The slots are lock files in _TransferStateDirectory held with flock(), so they are shared by every
+    # data manager process using that directory, and the kernel frees the slot of a process that dies.
+    # A transfer waits for a free slot before it starts. While it runs, throttle() keeps its rate
+    # to an equal share of _MaxBytesPerSecond among the slots in use, so a new install gets its share
+    # of the bandwidth rather than waiting behind a large download.
+    # description is used in the messages, e.g. the url being downloaded.
+    def __init__(self, description):
+        self.description = description
+        self.lock_file = None
+        self.slot_number = None
+        self.bytes_per_second = None
+        self.budget_refresh_time = 0
+        self.window_start_time = 0
+        self.window_bytes = 0
+    def slot_filepath(self, slot_number):
+        return os.path.join(_TransferStateDirectory, _TransferSlotFile.format(slot_number))
+    def try_lock(self, slot_number):
+        # Returns the open lock file of slot_number if its lock could be taken, otherwise None.
+        lock_file = open(self.slot_filepath(slot_number), "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            lock_file.close()
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return lock_file
+    def __enter__(self):
+        if not os.path.isdir(_TransferStateDirectory):
+            try:
+                os.makedirs(_TransferStateDirectory)
+            except os.error:
+                # Another data manager may have just created it.
+                if not os.path.isdir(_TransferStateDirectory):
+                    raise
+        wait_start_time = None
+        while self.lock_file is None:
+            for slot_number in range(_MaxTransfers):
+                self.lock_file = self.try_lock(slot_number)
+                if self.lock_file is not None:
+                    self.slot_number = slot_number
+                    break
+            else:
+                if wait_start_time is None:
+                    wait_start_time = time.time()
+                    print "All {:d} transfer slots are in use. Waiting for one for {:s}".format( \
+                          _MaxTransfers, self.description)
+                    sys.stdout.flush()
+                    report_event("transfer_slot_wait_started", name=self.description)
+                time.sleep(_SlotPollInterval)
+        if wait_start_time is not None:
+            report_event("transfer_slot_wait_finished", name=self.description, \
+                         waited_seconds=round(time.time() - wait_start_time, 3))
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+        return False
+    def slots_in_use(self):
+        # Counts the slots held by any process, this one included.
+        num_slots_in_use = 1
+        for slot_number in range(_MaxTransfers):
+            if slot_number == self.slot_number:
+                continue
+            lock_file = self.try_lock(slot_number)
+            if lock_file is None:
+                num_slots_in_use += 1
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                lock_file.close()
+        return num_slots_in_use
+    def throttle(self, num_bytes):
+        # Called with the number of bytes just transferred. Sleeps as long as needed to keep
+        # the transfer within its share of the bandwidth, which is worked out again every _BudgetRefreshInterval seconds.
+        if _MaxBytesPerSecond <= 0:
+            return
+        now = time.time()
+        if now - self.budget_refresh_time >= _BudgetRefreshInterval:
+            self.bytes_per_second = float(_MaxBytesPerSecond) / self.slots_in_use()
+            self.budget_refresh_time = now
+            self.window_start_time = now
+            self.window_bytes = 0
+        self.window_bytes += num_bytes
+        seconds_ahead = self.window_bytes / self.bytes_per_second - (now - self.window_start_time)
+        if seconds_ahead > 0:
+            time.sleep(seconds_ahead)
+# End of class transfer_slot
+
+class connection_pool(object):
+    # Keeps the http and https connections that are not in use, by scheme, host and port, so they can be used again.
+    # A connection is only put back once the whole of its last response has been read.
+    # The proxy given by the http_proxy or https_proxy environment variable is used, like urllib2 does.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle_connections = dict()
+    def get(self, scheme, host, port):
+        # Returns a tuple of a connection to host and whether the connection was used before.
+        with self.lock:
+            connections = self.idle_connections.get((scheme, host, port))
+            if connections:
+                return (connections.pop(), True)
+        connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        proxy = urllib.getproxies().get(scheme)
+        if proxy and not urllib.proxy_bypass(host):
+            proxy_parts = urlparse.urlparse(proxy if "://" in proxy else "http://" + proxy)
+            if scheme == "https":
+                # The TLS connection to host is tunnelled through the proxy with a CONNECT request.
+                connection = httplib.HTTPSConnection(proxy_parts.hostname, proxy_parts.port or 80, \
+                                                     timeout=_ConnectionTimeout)
+                connection.set_tunnel(host, port)
+                connection.via_proxy = False
+            else:
+                connection = httplib.HTTPConnection(proxy_parts.hostname, proxy_parts.port or 80, \
+                                                    timeout=_ConnectionTimeout)
+                connection.via_proxy = True
+        else:
+            connection = connection_class(host, port, timeout=_ConnectionTimeout)
+            connection.via_proxy = False
+        return (connection, False)
+    def put(self, scheme, host, port, connection):
+        with self.lock:
+            connections = self.idle_connections.setdefault((scheme, host, port), list())
+            if len(connections) < _MaxIdleConnectionsPerHost:
+                connections.append(connection)
+                return
+        connection.close()
+# End of class connection_pool
+
+_ConnectionPool = connection_pool()
+
+class url_response(object):
+    # The file-like object returned by open_url().
+    # status is the http status. An ftp transfer has 200, or 206 when it starts part way into the file.
+    # headers is a dictionary of the http headers, with lower case names.
+    # file_size is the size of the whole file, if the server says what it is.
+    # If a transfer_slot is given, each read() is throttled by it.
+    # close() puts an http connection back in the pool when the whole body was read, and closes it otherwise.
+    def __init__(self, url, status, headers, body, file_size, release, slot=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.file_size = file_size
+        self.release = release
+        self.slot = slot
+    def read(self, size=-1):
+        data = self.body.read() if size < 0 else self.body.read(size)
+        if (self.slot is not None) and data:
+            self.slot.throttle(len(data))
+        return data
+    def close(self):
+        if self.release is not None:
+            release, self.release = self.release, None
+            release()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+# End of class url_response
+
+def ftp_connection_for(url):
+    # Returns a tuple of an ftp connection, logged in and in binary mode, to the server of url,
+    # the path of the file on the server and the size of the file (None if the server does not support SIZE).
+    url_parts = urlparse.urlparse(url)
+    ftp = ftplib.FTP(timeout=_ConnectionTimeout)
+    try:
+        ftp.connect(url_parts.hostname, url_parts.port or ftplib.FTP_PORT)
+        ftp.login(url_parts.username or "anonymous", url_parts.password or "anonymous@")
+        ftp.voidcmd("TYPE I")
+        ftp_path = urllib.unquote(url_parts.path)
+        try:
+            file_size = ftp.size(ftp_path)
+        except ftplib.error_perm:
+            file_size = None
+    except BaseException:
+        ftp.close()
+        raise
+    return (ftp, ftp_path, file_size)
+
+def open_ftp_url(url, start=0, slot=None):
+    # Opens url on an ftp server. The transfer starts at byte start, with a REST command.
+    ftp, ftp_path, file_size = ftp_connection_for(url)
+    try:
+        data_connection = ftp.transfercmd("RETR {:s}".format(ftp_path), start or None)
+    except BaseException:
+        ftp.close()
+        raise
+    data_file = data_connection.makefile("rb")
+    def release():
+        for open_object in (data_file, data_connection, ftp):
+            try:
+                open_object.close()
+            except TransferErrors:
+                pass
+    return url_response(url, 206 if start else 200, dict(), data_file, file_size, release, slot)
+
+def open_url(url, start=0, end=None, method="GET", headers=None, slot=None, timeout=_ConnectionTimeout):
+    # Opens url (http, https or ftp) on a pooled connection and returns a url_response for it.
+    # Bytes start through end (inclusive, or to the end of the file if end is None) are asked for,
+    # with a Range header for http(s), or a REST command for ftp (which has no end).
+    # The status is 206 when the server sent just those bytes. A server that ignores the range answers 200
+    # with the whole file. Redirects are followed.
+    # Like urllib2, an http status of 300 or more that is not a redirect is raised as a urllib2.HTTPError.
+    # Other errors are raised as a socket.error (an IOError), an httplib.HTTPException or an ftplib.Error.
+    for num_redirects in range(_MaxRedirects + 1):
+        url_parts = urlparse.urlparse(url)
+        if url_parts.scheme == "ftp":
+            return open_ftp_url(url, start, slot)
+        if url_parts.scheme not in ("http", "https"):
+            raise IOError("Cannot open {:s}: only http, https and ftp urls are supported.".format(url))
+        host = url_parts.hostname
+        port = url_parts.port or (httplib.HTTPS_PORT if url_parts.scheme == "https" else httplib.HTTP_PORT)
+        request_headers = dict(headers or dict())
+        if (start > 0) or (end is not None):
+            request_headers["Range"] = "bytes={:d}-{:s}".format(start, "" if end is None else str(end))
+        request_path = url_parts.path or "/"
+        if url_parts.query:
+            request_path += "?" + url_parts.query
+        response = None
+        while response is None:
+            connection, reused = _ConnectionPool.get(url_parts.scheme, host, port)
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, url if connection.via_proxy else request_path, headers=request_headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+                # The server closed the connection while it was idle. Try again on a new one.
+        def release(connection=connection, response=response, scheme=url_parts.scheme, host=host, port=port):
+            # The connection can be used again only if the body was read to its end and the server keeps it open.
+            if response.isclosed() and (not response.will_close) and (not response.length):
+                _ConnectionPool.put(scheme, host, port, connection)
+            else:
+                connection.close()
+        response_headers = dict([(name.lower(), value) for name, value in response.getheaders()])
+        if (response.status in (301, 302, 303, 307, 308)) and ("location" in response_headers):
+            response.read()
+            release()
+            url = urlparse.urljoin(url, response_headers["location"])
+            if response.status == 303:
+                method = "GET"
+            continue
+        if response.status >= 300:
+            response.read()
+            release()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        file_size = None
+        content_range = response_headers.get("content-range", "")
+        content_length = response_headers.get("content-length", "")
+        if (response.status == 206) and content_range.rsplit("/", 1)[-1].isdigit():
+            file_size = int(content_range.rsplit("/", 1)[-1])
+        elif (response.status == 200) and content_length.isdigit():
+            file_size = int(content_length)
+        return url_response(url, response.status, response_headers, response, file_size, release, slot)
+    raise IOError("Too many redirects opening {:s}".format(url))
+
+def head_url(url):
+    # Returns the closed url_response of a HEAD request for the http(s) url, so nothing of the file is sent.
+    # If the server does not take HEAD requests, the response is that of a request for the first byte of the file.
+    try:
+        response = open_url(url, method="HEAD")
+        response.read()
+    except urllib2.HTTPError as http_error:
+        if http_error.code not in (405, 501):
+            raise
+        # The body is not read, since a server that ignores the range sends the whole file.
+        response = open_url(url, start=0, end=0)
+    response.close()
+    return response
+
+def size_of(url):
+    # Returns the size of the file at url, or None if the server does not say.
+    if urlparse.urlparse(url).scheme == "ftp":
+        ftp, ftp_path, file_size = ftp_connection_for(url)
+        ftp.close()
+        return file_size
+    file_size = head_url(url).file_size
+    if file_size is None:
+        # Some servers do not give the length for a HEAD request. Ask for the first byte instead.
+        with contextlib.closing(open_url(url, start=0, end=0)) as response:
+            file_size = response.file_size if response.status == 206 else None
+    return file_size
+
+def accepts_byte_ranges(url):
+    # Returns True if the server for url says that it will send byte ranges of the file.
+    # Only http and https servers are asked. For other schemes (e.g. ftp) False is returned.
+    if urlparse.urlparse(url).scheme not in ("http", "https"):
+        return False
+    response = head_url(url)
+    return (response.status == 206) or (response.headers.get("accept-ranges", "").strip().lower() == "bytes")
+
+def read_url(url, timeout=_ConnectionTimeout):
+    # Returns the whole of the (small) file at url, e.g. an .md5 file or a web page.
+    with contextlib.closing(open_url(url, timeout=timeout)) as response:
+        return response.read()
+
+class resumable_download_stream(object):
+    # A file-like object that reads the file at url (http, https or ftp) from byte start.
+    # If the connection drops or stalls, it connects again and asks for the rest of the file
+    # from where it left off, with a Range header for http(s) or a REST command for ftp,
+    # so a network error does not start a multi-gigabyte download over.
+    # After _NumReconnectAttempts failures in a row, the last error is raised as an IOError.
+    # An error that will not go away by trying again, like a missing file, is raised at once.
+    # The first connection is made by the first read(). The reads are throttled by slot and counted by meter,
+    # if they are given.
+    def __init__(self, url, start=0, slot=None, meter=None):
+        self.url = url
+        self.offset = start
+        self.total_bytes = None
+        self.num_reconnects = 0
+        self.slot = slot
+        self.meter = meter
+        self.response = None
+    def connect(self):
+        self.response = open_url(self.url, start=self.offset, slot=self.slot)
+        if (self.offset > 0) and (self.response.status != 206):
+            # The server sent the whole file rather than the range, so the part already read is skipped.
+            print "The server does not resume downloads, so the first {:d} bytes are read again.".format(self.offset)
+            sys.stdout.flush()
+            num_bytes_to_skip = self.offset
+            while num_bytes_to_skip > 0:
+                skipped_data = self.response.read(min(num_bytes_to_skip, _DownloadBlockSize))
+                if not skipped_data:
+                    raise IOError("The download of {:s} ended early.".format(self.url))
+                num_bytes_to_skip -= len(skipped_data)
+        if self.total_bytes is None:
+            self.total_bytes = self.response.file_size
+    def disconnect(self):
+        if self.response is not None:
+            try:
+                self.response.close()
+            except TransferErrors:
+                pass
+        self.response = None
+    def read(self, size=_DownloadBlockSize):
+        num_failures = 0
+        while True:
+            transfer_error = None
+            try:
+                if self.response is None:
+                    self.connect()
+                data = self.response.read(size)
+            except urllib2.HTTPError as http_error:
+                if (http_error.code < 500) and (http_error.code != 408):
+                    raise
+                data, transfer_error = None, http_error
+            except ftplib.error_perm:
+                raise
+            except TransferErrors as error:
+                data, transfer_error = None, error
+            if data:
+                self.offset += len(data)
+                if self.meter is not None:
+                    self.meter.add(len(data))
+                return data
+            if (transfer_error is None) and ((self.total_bytes is None) or (self.offset >= self.total_bytes)):
+                # The end of the file.
+                return ""
+            if transfer_error is None:
+                transfer_error = "the connection was closed"
+            self.disconnect()
+            num_failures += 1
+            if num_failures > _NumReconnectAttempts:
+                raise IOError("The download of {:s} failed at byte {:d}: {:s}".format( \
+                              self.url, self.offset, str(transfer_error)))
+            self.num_reconnects += 1
+            reconnect_delay = _ReconnectDelay * (2 ** (num_failures - 1))
+            print "The download of {:s} stopped at byte {:d} ({:s}). Resuming in {:d} seconds.".format( \
+                  self.url, self.offset, str(transfer_error), reconnect_delay)
+            sys.stdout.flush()
+            report_event("download_resumed", url=self.url, offset=self.offset, error=str(transfer_error))
+            time.sleep(reconnect_delay)
+    def close(self):
+        self.disconnect()
+# End of class resumable_download_stream
+
+def ensure_we_can_write_numbytes_to(destination, numbytes):
+    # Attempts to create the destination directory if it does not exist.
+    # Tests whether a file can be written to that directory.
+    # Tests whether there is numbytes space on the device of the destination.
+    # Raises errors if it cannot do any of the above.
+    #
+    # Returns the full specification of the destination path.
+    # We want to make sure that destination is an absolute fully specified path.
+    cannonical_destination = os.path.realpath(destination)
+    if os.path.exists(cannonical_destination):
+        if not os.path.isdir(cannonical_destination):
+            raise ValueError("The destination is not a directory: " + \
+                             "{:s}".format(cannonical_destination))
+        # else all is good. It is a directory.
+    else:
+        # We need to create it since it does not exist.
+        try:
+            os.makedirs(cannonical_destination)
+        except os.error:
+            # Another stage running at the same time may have just created it.
+            if not os.path.isdir(cannonical_destination):
+                print "ERROR: Trying to create the following directory path:"
+                print "\t{:s}".format(cannonical_destination)
+                sys.stdout.flush()
+                raise
+    # Make sure the directory now exists and we can write to it.
+    if not os.path.exists(cannonical_destination):
+        # It should have been created, but if it doesn't exist at this point
+        # in the code, something is wrong. Raise an error.
+        raise OSError("The destination directory could not be created: " + \
+                      "{:s}".format(cannonical_destination))
+    # The thread name is part of the filename, so stages testing the same directory at the same time
+    # do not remove each other's test file.
+    test_writing_filename = "{:s}.{:s}.{:s}".format(os.path.basename(cannonical_destination), \
+                                                    threading.current_thread().name, _Write_TestFile)
+    test_writing_filepath = os.path.join(cannonical_destination, test_writing_filename)
+    try:
+        with open(test_writing_filepath, "w") as test_writing_file:
+            test_writing_file.write("Testing writing to this file.")
+        if os.path.exists(test_writing_filepath):
+            os.remove(test_writing_filepath)
+    except IOError:
+        print "The destination directory could not be written into:\n\t" + \
+              "{:s}".format(cannonical_destination)
+        sys.stdout.flush()
+        raise
+    # Check whether there are numbytes available on cannonical_destination's device.
+    statvfs = os.statvfs(cannonical_destination)
+    # fs_size = statvfs.f_frsize * statvfs.f_blocks          # Size of filesystem in bytes
+    # num_free_bytes = statvfs.f_frsize * statvfs.f_bfree    # Actual number of free bytes
+    num_avail_bytes = statvfs.f_frsize * statvfs.f_bavail    # Number of free bytes that ordinary users
+                                                             # are allowed to use (excl. reserved space)
+    if (num_avail_bytes < numbytes):
+        raise OSError("There is insufficient space ({:s} bytes)".format(str(num_avail_bytes)) + \
+                        " on the device of the destination directory:\n\t" + \
+                        "{:s}\n\t{:d} bytes are needed.".format(cannonical_destination, numbytes))
+    return cannonical_destination
+
+def listing_cache_paths(page_url):
+    # Returns the paths of the files holding the cached copy of the page at page_url
+    # and the headers (ETag and Last-Modified) that came with it.
+    cache_basename = hashlib.md5(page_url).hexdigest()
+    return (os.path.join(_ListingCacheDirectory, "{:s}.html".format(cache_basename)), \
+            os.path.join(_ListingCacheDirectory, "{:s}.json".format(cache_basename)))
+
+def refresh_listing_cache(page_url):
+    # Fetches page_url into the listing cache. If there is a cached copy, the request is conditional
+    # (If-None-Match/If-Modified-Since), so an unchanged page is not sent again.
+    # Returns the html of the page, or None if it could not be fetched.
+    html_path, headers_path = listing_cache_paths(page_url)
+    cached_headers = dict()
+    if os.path.exists(html_path) and os.path.exists(headers_path):
+        with open(headers_path, "r") as headers_file:
+            cached_headers = json.load(headers_file)
+    request_headers = dict()
+    if cached_headers.get('etag'):
+        request_headers["If-None-Match"] = cached_headers['etag']
+    if cached_headers.get('last_modified'):
+        request_headers["If-Modified-Since"] = cached_headers['last_modified']
+    try:
+        with contextlib.closing(open_url(page_url, headers=request_headers, timeout=_ListingFetchTimeout)) as response:
+            theHTML = response.read()
+            cached_headers = dict(etag=response.headers.get('etag'), \
+                                  last_modified=response.headers.get('last-modified'))
+    except urllib2.HTTPError as http_error:
+        if http_error.code != 304:
+            print "Could not fetch {:s}: {:s}".format(page_url, str(http_error))
+            return None
+        # The page has not changed. Use the cached copy.
+        with open(html_path, "r") as html_file:
+            theHTML = html_file.read()
+    except TransferErrors + (IOError,) as fetch_error:
+        print "Could not fetch {:s}: {:s}".format(page_url, str(fetch_error))
+        return None
+    if (theHTML is None) or (theHTML == ""):
+        return None
+    if not os.path.isdir(_ListingCacheDirectory):
+        try:
+            os.makedirs(_ListingCacheDirectory)
+        except OSError:
+            # Another process may have created it at the same time.
+            if not os.path.isdir(_ListingCacheDirectory):
+                raise
+    # Write to temporary files and rename them, so a reader never sees a partly written file.
+    temporary_suffix = ".{:d}.tmp".format(os.getpid())
+    with open(html_path + temporary_suffix, "w") as html_file:
+        html_file.write(theHTML)
+    cached_headers['fetched'] = time.time()
+    with open(headers_path + temporary_suffix, "w") as headers_file:
+        json.dump(cached_headers, headers_file)
+    os.rename(html_path + temporary_suffix, html_path)
+    os.rename(headers_path + temporary_suffix, headers_path)
+    return theHTML
+
+def background_refresh_listing_cache(page_url):
+    # Refreshes the cached copy of page_url in a background thread, unless that is already happening.
+    with _ListingRefreshLock:
+        if page_url in _ListingRefreshesInProgress:
+            return
+        _ListingRefreshesInProgress.add(page_url)
+    def refresh():
+        try:
+            refresh_listing_cache(page_url)
+        finally:
+            with _ListingRefreshLock:
+                _ListingRefreshesInProgress.discard(page_url)
+    refresh_thread = threading.Thread(target=refresh)
+    refresh_thread.daemon = True
+    refresh_thread.start()
+
+def get_listing_html(page_url):
+    # Returns the html of the page at page_url, for building the dynamic option lists.
+    # A copy of the page is kept in the listing cache, so the option lists can be built without
+    # waiting on the web site. A copy older than _ListingCacheTimeToLive seconds is still returned,
+    # but is revalidated in the background for the next time. The page is only fetched while
+    # the caller waits if there is no cached copy. If the web site cannot be reached,
+    # the last good copy keeps being used.
+    # Returns None if there is no cached copy and the page cannot be fetched.
+    html_path, headers_path = listing_cache_paths(page_url)
+    try:
+        with open(html_path, "r") as html_file:
+            theHTML = html_file.read()
+        with open(headers_path, "r") as headers_file:
+            fetched_time = json.load(headers_file).get('fetched', 0)
+    except (IOError, ValueError):
+        return refresh_listing_cache(page_url)
+    if (time.time() - fetched_time) > _ListingCacheTimeToLive:
+        background_refresh_listing_cache(page_url)
+    return theHTML
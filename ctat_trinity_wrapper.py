@@ -10,6 +10,20 @@ Max memory - this I need to derive somehow from the dynamic runner using Galaxy
 
 ~ Optional args ~
 Output directory - this allows users to run the same job over in case it walltime'd out or failed for recoverable reasons.
+Pre-processing - with --preprocess, the reads are decompressed, the libraries (comma separated lists of files) concatenated,
+  spaces removed from the FASTQ @ and + header lines (as ctat_clean_headers does) and the pairing of the left and right reads
+  checked, as they are streamed to Trinity through named pipes, so none of that is written to disk.
+Scratch - with --scratch, or by default for a rerunnable job, Trinity is run in node-local scratch if one of the
+  directories listed has room, with the outputs of the completed phases checkpointed back to the rerun directory as it goes,
+  and only Trinity.fasta, its gene to transcript map and the timing file copied back at the end.
+Intermediate files - when Trinity succeeds, everything in trinity_out_dir but Trinity.fasta, its gene to transcript map and
+  the timing file is removed by a pool of threads, throttled to --teardown_rate files a second, unless --keep_intermediates is given.
+  The removal is left running in a process of its own when the wrapper exits, so the job does not wait for it.
+Resource estimate - samples the inputs and recommends the memory and CPUs for the job, as JSON.
+  It is only done when asked for, with --resource_estimate, --estimate_only or --auto_resources.
+  With --estimate_only, the estimate is all that is done, so a Galaxy dynamic job rule can run
+      python ctat_trinity_wrapper.py --estimate_only --seqType fq --left left.fq.gz --right right.fq.gz
+  and read recommended.max_memory_gb and recommended.CPU from the JSON printed on stdout.
 
  --
 Created Tuesday, 7 March 2017.
@@ -23,10 +37,861 @@ import logging as log
 import sys
 import os
 import errno
+import glob
+import fnmatch
+import re
+import time
+import json
+import zlib
+import math
+import hashlib
+import shutil
+import stat
+import tempfile
+import threading
+import signal
+import Queue
 from datetime import datetime
+# scandir lists a directory along with the type of each entry, so the intermediate files can be removed without a stat
+# to tell the files from the directories. It is in os from python 3.5, and the scandir package backports it to 2.7.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 TRINITY_OUT_DIR = "trinity_out_dir"
 
+### The phases of Trinity, in the order they run, with the checkpoint files that Trinity writes in TRINITY_OUT_DIR
+### when each one finishes. Trinity skips a phase whose checkpoint is there when it is run again in the same directory.
+### The names have changed between Trinity releases, so any one of the files listed marks the phase as finished.
+### Butterfly is only finished once Trinity.fasta is written. recursive_trinity.cmds.ok is written with the list of
+### Butterfly commands, before any of them run, and ParaFly adds to recursive_trinity.cmds.completed as each one finishes.
+TRINITY_PHASES = [
+    ("Jellyfish", ["jellyfish.kmers*.fa.success"]),
+    ("Inchworm", ["inchworm*.fa.finished"]),
+    ("Chrysalis", ["chrysalis/iworm_cluster_welds_graph.txt.ok", "chrysalis/GraphFromIwormFasta.out.ok"]),
+    ("Read partitioning", ["partitioned_reads.files.list.ok", "chrysalis/readsToComponents.out.ok"]),
+    ("Butterfly", ["Trinity.fasta"]),
+]
+
+def completed_phases(outdir):
+    # Returns a list of (phase, finish time) for the phases that have finished, from the mtimes of their checkpoints.
+    # It stops at the first phase that has not finished, since the phases after it will be run again.
+    completed = []
+    for phase, checkpoints in TRINITY_PHASES:
+        finish_times = [os.path.getmtime(path) for pattern in checkpoints for path in glob.glob(os.path.join(outdir, pattern))]
+        if not finish_times:
+            break
+        completed.append((phase, min(finish_times)))
+    return completed
+
+def phase_timings(completed, attempt_start, attempt_end):
+    # Returns a list of (phase, seconds, status) for an attempt that ran from attempt_start to attempt_end.
+    # A phase that finished before the attempt started was kept from an earlier one, and took no time.
+    # The phase after the last completed one ran until the attempt ended, and did not finish.
+    timings = []
+    phase_start = attempt_start
+    for phase, finish_time in completed:
+        if finish_time < attempt_start:
+            timings.append((phase, 0.0, "kept"))
+        else:
+            timings.append((phase, finish_time - phase_start, "done"))
+            phase_start = finish_time
+    if len(completed) < len(TRINITY_PHASES):
+        timings.append((TRINITY_PHASES[len(completed)][0], attempt_end - phase_start, "did not finish"))
+    return timings
+
+### Signs in the Trinity log that one of its programs ran out of memory, matched ignoring case, and whether each
+### means the program was killed from outside (by the OOM killer) rather than failing to allocate memory itself.
+### A process killed by SIGKILL (exit status 137) alone is not a sign: the scheduler kills jobs past their time limit
+### and cancelled jobs the same way. Only the kernel's (or the scheduler's) report of an OOM kill says it was memory.
+MEMORY_FAILURE_PATTERNS = [(r"out of memory: kill(ed)? process", True), (r"memory cgroup out of memory", True),
+                           (r"\boom[-_ ]kill", True), (r"\boom_reaper\b", True),
+                           (r"bad_alloc", False), (r"cannot allocate memory", False), (r"out of memory", False),
+                           (r"outofmemoryerror", False), (r"\bmemoryerror\b", False)]
+### The phases that run many programs at once, --CPU of them, and so need less memory with a smaller --CPU.
+PARALLEL_PHASES = ["Chrysalis", "Read partitioning", "Butterfly"]
+
+def cgroup_files(filename_v2, filename_v1):
+    # Returns the paths of a file of this program's memory cgroup, for cgroup v2 and v1.
+    paths = []
+    try:
+        lines = open("/proc/self/cgroup").read().splitlines()
+    except IOError:
+        return paths
+    for line in lines:
+        fields = line.split(":", 2)
+        if len(fields) != 3:
+            continue
+        if fields[1] == "":
+            paths.append("/sys/fs/cgroup%s/%s" % (fields[2].rstrip("/"), filename_v2))
+        elif "memory" in fields[1].split(","):
+            paths.append("/sys/fs/cgroup/memory%s/%s" % (fields[2].rstrip("/"), filename_v1))
+    return paths
+
+def cgroup_oom_kills():
+    # Returns how many processes the kernel has killed for memory in this program's memory cgroup,
+    # or None if the count cannot be read.
+    for path in cgroup_files("memory.events", "memory.oom_control"):
+        try:
+            for line in open(path):
+                fields = line.split()
+                if len(fields) == 2 and fields[0] == "oom_kill":
+                    return int(fields[1])
+        except (IOError, OSError, ValueError):
+            pass
+    return None
+
+def job_memory_limit_gb():
+    # Returns the memory, in GB and not rounded down, that the job may use, or None if it is not known.
+    # Galaxy sets GALAXY_MEMORY_MB when the job's destination has a memory limit. Otherwise the cgroup limit is used.
+    if os.environ.get("GALAXY_MEMORY_MB", "").isdigit():
+        return int(os.environ["GALAXY_MEMORY_MB"]) / 1024.0
+    for path in cgroup_files("memory.max", "memory.limit_in_bytes"):
+        try:
+            limit = open(path).read().strip()
+        except (IOError, OSError):
+            continue
+        # cgroup v2 says "max", and cgroup v1 a number near 2**63, when there is no limit.
+        if limit.isdigit() and int(limit) < 2 ** 60:
+            return int(limit) / float(1024 ** 3)
+    return None
+
+def memory_gb(memstr):
+    # Returns the number of GB in a Trinity --max_memory value, like 31G or 500M.
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([GgMm]?)", memstr)
+    if not match:
+        raise Exception ("Cannot read the memory amount %s" % memstr)
+    if match.group(2).upper() == "M":
+        return float(match.group(1)) / 1024
+    return float(match.group(1))
+
+def classify_failure(ec, log_text, oom_kills_before, oom_kills_after):
+    # Returns a tuple of the kind of failure of an attempt ("memory" or "other"), why it was put in that kind,
+    # and whether a process was killed for memory, rather than failing to allocate it.
+    # It is "memory" if the kernel killed a process for memory in the job's cgroup during the attempt,
+    # or if the log written during the attempt says a program ran out of memory or was killed by the OOM killer.
+    # Being killed by SIGKILL is not enough, since that is also how a job past its time limit is stopped.
+    if oom_kills_before is not None and oom_kills_after is not None and oom_kills_after > oom_kills_before:
+        return ("memory", "the cgroup OOM kill count went from %d to %d" % (oom_kills_before, oom_kills_after), True)
+    for pattern, killed in MEMORY_FAILURE_PATTERNS:
+        match = re.search(pattern, log_text, re.IGNORECASE)
+        if match:
+            return ("memory", "the log says '%s'" % match.group(0), killed)
+    if ec in (-9, 137):
+        return ("other", "Trinity was killed by SIGKILL (exit status %d), with no sign of the OOM killer" % ec, False)
+    return ("other", "exit status %d" % ec, False)
+
+def adjust_for_memory_failure(settings, limits, failed_phase, killed):
+    # Changes settings (max_memory in GB, CPU and min_kmer_cov) for the next attempt after a memory failure
+    # in failed_phase, keeping them within limits. Returns a list describing the changes, which is empty
+    # when there is nothing left to change, and a retry would fail the same way.
+    # Trinity sizes the Jellyfish hash and the sort buffers from --max_memory. If a process was killed,
+    # --max_memory is brought under the job's memory limit first. Then the phases that run --CPU programs
+    # at once get fewer CPUs, and Jellyfish and Inchworm, which hold all of the k-mers, get a --min_kmer_cov
+    # that drops the k-mers seen once. If a program ran out of memory without being killed, Trinity's own
+    # budget was too small, and --max_memory is raised toward the job's limit instead.
+    changes = []
+    def change(name, new_value):
+        unit = "G" if name == "max_memory" else ""
+        changes.append("--%s %s%s -> %s%s" % (name, settings[name], unit, new_value, unit))
+        settings[name] = new_value
+    memory_limit = limits["max_memory"]
+    if not killed and settings["max_memory"] < memory_limit:
+        change("max_memory", min(memory_limit, settings["max_memory"] * 2))
+    elif killed and limits["job_memory"] is not None and settings["max_memory"] > int(limits["job_memory"] * 0.85):
+        change("max_memory", max(1, int(limits["job_memory"] * 0.85)))
+    elif failed_phase in PARALLEL_PHASES and settings["CPU"] > 1:
+        change("CPU", max(1, settings["CPU"] / 2))
+    elif failed_phase not in PARALLEL_PHASES and settings["min_kmer_cov"] < limits["min_kmer_cov"]:
+        change("min_kmer_cov", settings["min_kmer_cov"] + 1)
+    elif settings["CPU"] > 1:
+        change("CPU", max(1, settings["CPU"] / 2))
+    elif settings["max_memory"] > 1:
+        change("max_memory", max(1, int(settings["max_memory"] * 0.75)))
+    return changes
+
+### The inputs are sampled to estimate the resources a Trinity run needs. These are Trinity's rules of thumb:
+### about 1 GB of RAM per million read pairs (of ~100 base reads), plus room for the Butterfly processes run in parallel.
+SAMPLE_READS = 200000              # reads read from the start of each input file
+KMER_SAMPLE_READS = 20000          # of those, the reads whose k-mers are counted
+KMER_SIZE = 25                     # Trinity's k-mer size
+KMER_SUBSAMPLE = 16                # one in this many k-mers (by hash) are kept, to bound the memory of the count
+SAMPLE_CHUNK = 65536
+GB_PER_MILLION_FRAGMENTS = 1.0
+GB_PER_CPU = 1.0
+MIN_MEMORY_GB = 2
+MILLION_FRAGMENTS_PER_CPU = 5.0
+MIN_CPU = 2
+MAX_CPU = 32
+
+def read_chunks(path):
+    # Yields tuples of (data, bytes of the file read so far) for the file at path, decompressing it if it is gzipped.
+    # The bytes read so far are those of the file on disk, so how far into the file a sample got can be told.
+    raw = open(path, "rb")
+    try:
+        gzipped = raw.read(2) == "\x1f\x8b"
+        raw.seek(0)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        while True:
+            chunk = raw.read(SAMPLE_CHUNK)
+            if not chunk:
+                return
+            if decompressor is None:
+                yield (chunk, raw.tell())
+                continue
+            data = decompressor.decompress(chunk)
+            ### A gzip file may be several gzip streams one after another, as when gzipped files are concatenated.
+            while decompressor.unused_data:
+                rest = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                try:
+                    data += decompressor.decompress(rest)
+                except zlib.error:
+                    ### Padding after the last stream.
+                    return
+            yield (data, raw.tell())
+    finally:
+        raw.close()
+
+def read_lines(path):
+    # Yields tuples of (line, bytes of the file read so far) for the lines of the file at path, without their line ends.
+    leftover = ""
+    raw_bytes = 0
+    for data, raw_bytes in read_chunks(path):
+        lines = (leftover + data).split("\n")
+        leftover = lines.pop()
+        for line in lines:
+            yield (line.rstrip("\r"), raw_bytes)
+    if leftover:
+        yield (leftover.rstrip("\r"), raw_bytes)
+
+def sample_sequences(path, max_reads):
+    # Returns a tuple of the sequences of the first max_reads reads of the FASTQ or FASTA file at path,
+    # the bytes of the file they took up, and whether they were all of the reads in the file.
+    sequences = []
+    fasta_sequence = None
+    line_number = 0
+    raw_bytes = 0
+    for line, raw_bytes in read_lines(path):
+        if line_number == 0 and not line:
+            continue
+        if (line_number == 0 and line.startswith(">")) or fasta_sequence is not None:
+            ### FASTA, whose sequences may be over several lines.
+            if line.startswith(">"):
+                if fasta_sequence:
+                    sequences.append("".join(fasta_sequence))
+                    if len(sequences) >= max_reads:
+                        return (sequences, raw_bytes, False)
+                fasta_sequence = []
+            else:
+                fasta_sequence.append(line)
+        elif line_number % 4 == 1:
+            ### FASTQ, four lines per read.
+            sequences.append(line)
+            if len(sequences) >= max_reads:
+                return (sequences, raw_bytes, False)
+        line_number += 1
+    if fasta_sequence:
+        sequences.append("".join(fasta_sequence))
+    return (sequences, raw_bytes, True)
+
+def estimate_resources(single=None, left=None, right=None):
+    # Samples the input files and returns a dictionary with the estimated number of reads and fragments,
+    # their mean length, the k-mer complexity of the sample (the fraction of its k-mers that are distinct),
+    # and the memory and CPUs recommended for Trinity, under "recommended".
+    # Reads are counted in the start of each file, and the count is scaled up by the size of the file on disk,
+    # compressed or not. A file that is smaller than the sample is counted exactly.
+    # Each of single, left and right may be a comma separated list of files, as for Trinity.
+    start = time.time()
+    inputs = []
+    kmers_seen = 0
+    distinct_kmers = set()
+    for role, path in [(role, path) for role, files in (("single", single), ("left", left), ("right", right))
+                       for path in (files or "").split(",") if path]:
+        sequences, sampled_bytes, whole_file = sample_sequences(path, SAMPLE_READS)
+        file_size = os.path.getsize(path)
+        if whole_file or sampled_bytes == 0:
+            estimated_reads = len(sequences)
+        else:
+            estimated_reads = int(len(sequences) * float(file_size) / sampled_bytes)
+        mean_length = float(sum(len(sequence) for sequence in sequences)) / len(sequences) if sequences else 0.0
+        inputs.append({"path": path, "role": role, "size_bytes": file_size, "sampled_reads": len(sequences),
+                       "sampled_bytes": sampled_bytes, "whole_file_sampled": whole_file,
+                       "estimated_reads": estimated_reads, "mean_read_length": round(mean_length, 1)})
+        for sequence in sequences[:KMER_SAMPLE_READS]:
+            sequence = sequence.upper()
+            for position in xrange(len(sequence) - KMER_SIZE + 1):
+                kmer = sequence[position:position + KMER_SIZE]
+                kmers_seen += 1
+                if hash(kmer) % KMER_SUBSAMPLE == 0:
+                    distinct_kmers.add(kmer)
+    total_reads = sum(entry["estimated_reads"] for entry in inputs)
+    ### A pair of reads is one fragment.
+    fragments = sum(entry["estimated_reads"] for entry in inputs if entry["role"] == "left") if (left and right) else total_reads
+    sampled_reads = sum(entry["sampled_reads"] for entry in inputs)
+    mean_length = (sum(entry["mean_read_length"] * entry["sampled_reads"] for entry in inputs) / sampled_reads) if sampled_reads else 0.0
+    ### The expected number of kept k-mers is one in KMER_SUBSAMPLE of those seen.
+    complexity = min(1.0, float(len(distinct_kmers)) * KMER_SUBSAMPLE / kmers_seen) if kmers_seen else 1.0
+
+    ### Memory grows with the fragments, with their length (more k-mers per read),
+    ### and with the complexity of the library (a library of many duplicate reads has fewer distinct k-mers).
+    million_fragments = fragments / 1e6
+    length_factor = min(3.0, max(0.5, mean_length * (2 if left and right else 1) / 200.0))
+    complexity_factor = 0.5 + complexity
+    cpus = int(min(MAX_CPU, max(MIN_CPU, math.ceil(million_fragments / MILLION_FRAGMENTS_PER_CPU))))
+    memory = max(MIN_MEMORY_GB, million_fragments * GB_PER_MILLION_FRAGMENTS * length_factor * complexity_factor, cpus * GB_PER_CPU)
+    memory = int(math.ceil(memory))
+    return {"inputs": inputs, "estimated_reads": total_reads, "estimated_fragments": fragments,
+            "mean_read_length": round(mean_length, 1), "kmer_size": KMER_SIZE, "sampled_kmers": kmers_seen,
+            "kmer_complexity": round(complexity, 4), "sample_seconds": round(time.time() - start, 2),
+            "recommended": {"max_memory": "%dG" % memory, "max_memory_gb": memory, "CPU": cpus}}
+
+### The reads are written to the pipes this many bytes at a time, which is the size of a pipe's buffer on linux,
+### so that a reader that stops early is noticed at once (see read_preprocessor.serve).
+PREPROCESS_WRITE_SIZE = 65536
+def read_name(header):
+    # Returns the name of the read in a FASTQ or FASTA header line, which is the same for both reads of a pair:
+    # the first word, without the @ or >, and without a /1 or /2 at the end.
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else ""
+    if name.endswith("/1") or name.endswith("/2"):
+        name = name[:-2]
+    return name
+
+class read_preprocessor(object):
+    # Streams the reads of one or more libraries to Trinity through a named pipe for each of single, left and right.
+    # The files of each are read in turn, decompressed if they are gzipped, and checked as they go.
+    # FASTQ records must have @ and + header lines and a quality as long as the sequence,
+    # and the spaces are taken out of their header lines.
+    # Trinity reads its inputs more than once (to normalize them, and again on a retry), so each time a pipe is
+    # opened the reads are streamed again from the start. Whenever a whole pass over both the left and the right
+    # reads is done, the count and the order of the read names of the two are compared, and if they do not match,
+    # the error is recorded and Trinity, with every program it started, is killed, rather than left to assemble unpaired reads.
+    # The path given to Trinity for each of single, left and right is a symbolic link to the named pipe of the current pass.
+    def __init__(self, seq_type, single=None, left=None, right=None, directory=None):
+        self.seq_type = seq_type
+        self.inputs = {}
+        for role, files in (("single", single), ("left", left), ("right", right)):
+            if files:
+                self.inputs[role] = [path for path in files.split(",") if path]
+        if "left" in self.inputs and len(self.inputs["left"]) != len(self.inputs.get("right", [])):
+            raise Exception ("There must be as many right read files as left ones.")
+        self.directory = tempfile.mkdtemp(prefix="trinity_reads.", dir=directory or os.getcwd())
+        extension = "fa" if seq_type == "fa" else "fq"
+        self.extension = extension
+        self.fifos = dict((role, os.path.join(self.directory, "%s.%s" % (role, extension))) for role in self.inputs)
+        self.passes = dict((role, []) for role in self.inputs)
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.error = None
+        self.process = None
+        self.threads = []
+
+    def start(self):
+        for role in sorted(self.fifos):
+            thread = threading.Thread(target=self.serve, args=(role, self.next_fifo(role, 1)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def fail(self, message):
+        ### Trinity is started in its own process group, so the programs it is running are killed along with it.
+        with self.lock:
+            if self.error is None:
+                self.error = message
+            process = self.process
+        if process is not None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def next_fifo(self, role, number):
+        # Makes the named pipe for pass number of role, and points the path given to Trinity at it.
+        # The link is replaced by renaming, so a program opening the path gets either the old pipe or the new one.
+        fifo = os.path.join(self.directory, "%s.%d.%s" % (role, number, self.extension))
+        os.mkfifo(fifo)
+        link = "%s.%d" % (self.fifos[role], number)
+        os.symlink(os.path.basename(fifo), link)
+        os.rename(link, self.fifos[role])
+        return fifo
+
+    def records(self, path):
+        # Yields the (header, lines) of each read in the file at path, with the header cleaned,
+        # and the lines as they are to be written.
+        lines = read_lines(path)
+        if self.seq_type == "fa":
+            header, sequence = None, []
+            for line, raw_bytes in lines:
+                if line.startswith(">"):
+                    if header is not None:
+                        yield (header, [header] + sequence)
+                    header, sequence = line, []
+                elif header is None:
+                    if line:
+                        raise Exception ("%s does not start with a FASTA header: %s" % (path, line[:80]))
+                else:
+                    sequence.append(line)
+            if header is not None:
+                yield (header, [header] + sequence)
+            return
+        record_number = 0
+        while True:
+            record = []
+            for line, raw_bytes in lines:
+                if line or record:
+                    record.append(line)
+                if len(record) == 4:
+                    break
+            if not record:
+                return
+            record_number += 1
+            if len(record) < 4 or not record[0].startswith("@") or not record[2].startswith("+") or len(record[1]) != len(record[3]):
+                raise Exception ("Read %d of %s is not a valid FASTQ record: %s" % (record_number, path, " | ".join(record)[:200]))
+            yield (record[0], [record[0].replace(" ", ""), record[1], record[2].replace(" ", ""), record[3]])
+
+    def write(self, fd, data):
+        while data:
+            data = data[os.write(fd, data):]
+
+    def serve(self, role, fifo):
+        # Streams the reads for role each time the pipe is opened. The pipe is written without a buffer,
+        # so when a reader closes it before the end (it died, or only looked at the first reads), the next write
+        # fails with EPIPE and nothing is left over.
+        # As soon as a reader has opened the pipe of a pass, the path is pointed at a new pipe for the next pass, and the old one
+        # is never opened for writing again. So the next reader always gets the reads from the start, however soon it opens
+        # the path, and the readers of a pass see the end of the stream as soon as it is closed.
+        # Readers that open the path at the same moment can still share one stream, so each input must be read
+        # by one program at a time. Trinity's programs do that.
+        number = 1
+        while True:
+            ### Opening the pipe waits until Trinity opens it to read.
+            fd = os.open(fifo, os.O_WRONLY)
+            if self.stopping:
+                os.close(fd)
+                return
+            number += 1
+            next_fifo = self.next_fifo(role, number)
+            names = hashlib.md5()
+            count = 0
+            buffered = []
+            buffered_size = 0
+            try:
+                for path in self.inputs[role]:
+                    for header, lines in self.records(path):
+                        names.update(read_name(header) + "\n")
+                        count += 1
+                        for line in lines:
+                            buffered.append(line)
+                            buffered_size += len(line) + 1
+                        if buffered_size >= PREPROCESS_WRITE_SIZE:
+                            self.write(fd, "\n".join(buffered) + "\n")
+                            buffered, buffered_size = [], 0
+                if buffered:
+                    self.write(fd, "\n".join(buffered) + "\n")
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    self.fail("Could not write the %s reads: %s" % (role, e))
+            except Exception as e:
+                ### Bad or unreadable reads. Trinity is killed, and the pipe is closed, so it does not wait for more.
+                self.fail(str(e))
+            else:
+                self.pass_finished(role, count, names.hexdigest())
+            os.close(fd)
+            os.remove(fifo)
+            fifo = next_fifo
+
+    def pass_finished(self, role, count, digest):
+        with self.lock:
+            self.passes[role].append((count, digest))
+            if role not in ("left", "right"):
+                return
+            left, right = self.passes["left"], self.passes["right"]
+            completed = min(len(left), len(right))
+            if completed == 0 or max(len(left), len(right)) != completed:
+                return
+            left_count, left_digest = left[-1]
+            right_count, right_digest = right[-1]
+        if left_count != right_count:
+            self.fail("The left and right reads are not paired: there are %d left reads and %d right reads." % (left_count, right_count))
+        elif left_digest != right_digest:
+            self.fail("The left and right reads are not paired: their read names are not the same, in the same order.")
+
+    def summary(self):
+        # Returns a description of the reads streamed in the last whole pass over each input.
+        with self.lock:
+            return ", ".join("%d %s reads" % (self.passes[role][-1][0], role) for role in sorted(self.passes) if self.passes[role])
+
+    def stop(self):
+        ### Threads waiting for a reader are let go by opening their pipes (through the links) without waiting for a writer.
+        self.stopping = True
+        for role in self.fifos:
+            try:
+                fd = os.open(self.fifos[role], os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            for thread in self.threads:
+                thread.join(0.1)
+            os.close(fd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+# End of class read_preprocessor
+
+### Trinity's output directory takes up to roughly this many times the size of its (uncompressed) inputs.
+SCRATCH_SPACE_FACTOR = 8
+### Gzipped inputs are taken to be this many times larger uncompressed.
+GZIP_SIZE_FACTOR = 4
+### How often, in seconds, to look for newly completed phases to checkpoint from scratch.
+SCRATCH_CHECKPOINT_INTERVAL = 60
+### The files in TRINITY_OUT_DIR that are never checkpointed from scratch. The partitioned reads are millions of small files,
+### which are quicker to make again than to write to shared storage, so the checkpoints of that phase are left out too,
+### and a rerun makes them again.
+SCRATCH_ONLY = ["read_partitions", "partitioned_reads.files.list*", "chrysalis/readsToComponents.out*", "recursive_trinity.cmds*"]
+### The results in TRINITY_OUT_DIR, which are copied back from scratch when Trinity has finished,
+### and kept when the intermediate files are removed.
+TRINITY_RESULTS = ["Trinity.fasta", "Trinity.fasta.gene_trans_map", "Trinity.timing"]
+
+def scratch_space_needed(single=None, left=None, right=None):
+    # Returns the bytes of scratch that Trinity is expected to need for the inputs (each a comma separated list of files).
+    total = 0
+    for files in (single, left, right):
+        for path in (files or "").split(","):
+            if not path:
+                continue
+            handle = open(path, "rb")
+            gzipped = handle.read(2) == "\x1f\x8b"
+            handle.close()
+            total += os.path.getsize(path) * (GZIP_SIZE_FACTOR if gzipped else 1)
+    return total * SCRATCH_SPACE_FACTOR
+
+def find_scratch(candidates, home, needed):
+    # Returns a tuple of the first of the candidate directories that is on another filesystem than home and has
+    # the bytes needed free (or None), and notes on why the others were not used.
+    # A tmpfs (such as /dev/shm) counts against the job's memory, so it should only be listed if the job has memory to spare.
+    notes = []
+    for candidate in candidates:
+        try:
+            if os.stat(candidate).st_dev == os.stat(home).st_dev:
+                notes.append("%s is on the same filesystem as %s" % (candidate, home))
+                continue
+            stat = os.statvfs(candidate)
+        except OSError as e:
+            notes.append("%s can not be used: %s" % (candidate, e))
+            continue
+        free = stat.f_bavail * stat.f_frsize
+        if free < needed:
+            notes.append("%s has %.1f GB free, and %.1f GB is needed" % (candidate, free / 1e9, needed / 1e9))
+            continue
+        return (candidate, notes)
+    return (None, notes)
+
+def matches(path, patterns):
+    # Returns True if the relative path, or one of the directories it is in, matches one of the glob patterns.
+    parts = path.split(os.sep)
+    return any(fnmatch.fnmatch(os.sep.join(parts[:n]), pattern) for pattern in patterns for n in range(1, len(parts) + 1))
+
+def copy_file(src, dest):
+    # Copies src to dest, with its times, through a temporary name, so that dest is never left partly written.
+    destdir = os.path.dirname(dest)
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+    temporary = "%s.copying.%d" % (dest, os.getpid())
+    shutil.copy2(src, temporary)
+    os.rename(temporary, dest)
+
+class scratch_stager(object):
+    # Runs Trinity in a directory in node-local scratch, for a job whose TRINITY_OUT_DIR (home) is on shared storage.
+    # What is in home, from an earlier run of a rerunnable job, is copied to scratch first, so Trinity resumes from it.
+    # With checkpoints, a thread copies the outputs of the phases back to home as they complete, except SCRATCH_ONLY,
+    # so a rerun on another node resumes from there. A phase's checkpoint files are only copied once all of its outputs
+    # have been, so home never shows a phase completed that is not. When Trinity has finished, only TRINITY_RESULTS
+    # are copied back. Notes for the log are kept in messages.
+    def __init__(self, scratch, home, checkpoints):
+        self.home = home
+        self.directory = tempfile.mkdtemp(prefix="trinity_scratch.", dir=scratch)
+        self.outdir = os.path.join(self.directory, TRINITY_OUT_DIR)
+        self.checkpoints = checkpoints
+        self.checkpointed = []
+        self.copied = {}
+        self.lock = threading.Lock()
+        self.messages = []
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def note(self, message):
+        with self.lock:
+            self.messages.append(message)
+
+    def take_messages(self):
+        with self.lock:
+            messages, self.messages = self.messages, []
+        return messages
+
+    def start(self):
+        ### The files copied from home are recorded as copied, so they are not checkpointed back.
+        start = time.time()
+        files = size = 0
+        os.makedirs(self.outdir)
+        if os.path.isdir(self.home):
+            for dirpath, dirnames, filenames in os.walk(self.home):
+                for filename in filenames:
+                    if ".copying." in filename:
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    relative = os.path.relpath(path, self.home)
+                    copy_file(path, os.path.join(self.outdir, relative))
+                    stat = os.stat(os.path.join(self.outdir, relative))
+                    self.copied[relative] = (stat.st_size, stat.st_mtime)
+                    files += 1
+                    size += stat.st_size
+        self.note("Running Trinity in %s; copied %d files (%.1f MB) from %s in %.1f s" % (
+            self.outdir, files, size / 1e6, self.home, time.time() - start))
+        if self.checkpoints:
+            self.thread = threading.Thread(target=self.watch)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def watch(self):
+        while not self.stopping.wait(SCRATCH_CHECKPOINT_INTERVAL):
+            if [phase for phase, finish_time in completed_phases(self.outdir)] != self.checkpointed:
+                self.checkpoint()
+
+    def checkpoint(self):
+        # Copies the files that are new or changed in scratch to home, except SCRATCH_ONLY, and the checkpoint files
+        # of the phases that had not completed when it began.
+        start = time.time()
+        completed = [phase for phase, finish_time in completed_phases(self.outdir)]
+        files = size = 0
+        try:
+            for dirpath, dirnames, filenames in os.walk(self.outdir):
+                relative_dir = os.path.relpath(dirpath, self.outdir)
+                dirnames[:] = [name for name in dirnames if not matches(os.path.normpath(os.path.join(relative_dir, name)), SCRATCH_ONLY)]
+                for filename in filenames:
+                    relative = os.path.normpath(os.path.join(relative_dir, filename))
+                    if matches(relative, SCRATCH_ONLY) or ".copying." in filename:
+                        continue
+                    if any(phase not in completed and matches(relative, checkpoints) for phase, checkpoints in TRINITY_PHASES):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                        if self.copied.get(relative) == (stat.st_size, stat.st_mtime):
+                            continue
+                        copy_file(path, os.path.join(self.home, relative))
+                    except (OSError, IOError) as e:
+                        ### Trinity removes some files as it goes.
+                        if e.errno == errno.ENOENT:
+                            continue
+                        raise
+                    self.copied[relative] = (stat.st_size, stat.st_mtime)
+                    files += 1
+                    size += stat.st_size
+        except (OSError, IOError, shutil.Error) as e:
+            self.note("Could not checkpoint to %s: %s" % (self.home, e))
+            return
+        self.checkpointed = completed
+        kept = [phase for phase, checkpoints in TRINITY_PHASES if phase in completed and not all(matches(checkpoint, SCRATCH_ONLY) for checkpoint in checkpoints)]
+        self.note("Checkpointed the completed phases (%s) to %s: %d files (%.1f MB) in %.1f s" % (
+            ", ".join(kept) or "none", self.home, files, size / 1e6, time.time() - start))
+
+    def finish(self, succeeded):
+        # Stops the checkpoints, and copies the results back to home if Trinity succeeded, or checkpoints what it did if not.
+        # The directory in scratch is left to be removed.
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if succeeded:
+            start = time.time()
+            copied = []
+            for name in TRINITY_RESULTS:
+                path = os.path.join(self.outdir, name)
+                if os.path.exists(path):
+                    copy_file(path, os.path.join(self.home, name))
+                    copied.append(name)
+            self.note("Copied %s back to %s in %.1f s" % (", ".join(copied) or "nothing", self.home, time.time() - start))
+        elif self.checkpoints:
+            self.checkpoint()
+
+    def discard(self):
+        # Stops the checkpoints and removes the directory in scratch, if it is still there.
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
+# End of class scratch_stager
+
+### The threads that remove the intermediate files.
+TEARDOWN_THREADS = 8
+### The most files and directories removed per second by all of the threads, so the metadata server of shared storage
+### is not swamped. 0 is no limit.
+TEARDOWN_RATE = 2000
+### Files are removed relative to their directory (unlinkat) where python can, which saves looking up the path each time.
+UNLINK_AT = hasattr(os, "supports_dir_fd") and os.unlink in os.supports_dir_fd
+
+class tree_remover(object):
+    # Removes files and directory trees with a pool of threads, in the background (see detach). Each thread lists a directory,
+    # removes its files, and queues its subdirectories for the threads, and a directory is removed when the last of
+    # its subdirectories is. The removals are throttled to rate per second. What was removed is counted for the log.
+    def __init__(self, threads=TEARDOWN_THREADS, rate=TEARDOWN_RATE):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work) for n in range(threads)]
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_removal = 0.0
+        self.files = 0
+        self.directories = 0
+        self.bytes = 0
+        self.errors = []
+        self.started = None
+
+    def remove(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            self.queue.put({"path": path, "parent": None, "pending": 0, "listed": False})
+        elif os.path.lexists(path):
+            self.unlink(path, os.lstat(path))
+
+    def pending(self):
+        # Returns True if there are directories queued to be removed.
+        return not self.queue.empty()
+
+    def start(self):
+        self.started = time.time()
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def throttle(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            self.next_removal = max(self.next_removal + self.interval, now)
+            delay = self.next_removal - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def unlink(self, path, stat, dir_fd=None):
+        self.throttle()
+        if dir_fd is None:
+            os.unlink(path)
+        else:
+            os.unlink(os.path.basename(path), dir_fd=dir_fd)
+        with self.lock:
+            self.files += 1
+            self.bytes += stat.st_blocks * 512
+
+    def entries(self, path):
+        # Returns the (path, is a directory, lstat) of the entries of the directory at path.
+        if scandir is not None:
+            found = []
+            for entry in scandir(path):
+                is_dir = entry.is_dir(follow_symlinks=False)
+                found.append((entry.path, is_dir, None if is_dir else entry.stat(follow_symlinks=False)))
+            return found
+        found = []
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            entry_stat = os.lstat(entry)
+            is_dir = stat.S_ISDIR(entry_stat.st_mode)
+            found.append((entry, is_dir, None if is_dir else entry_stat))
+        return found
+
+    def work(self):
+        while True:
+            directory = self.queue.get()
+            if directory is None:
+                self.queue.task_done()
+                return
+            try:
+                self.clear(directory)
+            except (OSError, IOError) as e:
+                with self.lock:
+                    self.errors.append(str(e))
+            finally:
+                self.queue.task_done()
+
+    def clear(self, directory):
+        subdirectories = []
+        dir_fd = os.open(directory["path"], os.O_RDONLY | os.O_DIRECTORY) if UNLINK_AT else None
+        try:
+            for path, is_dir, stat in self.entries(directory["path"]):
+                if is_dir:
+                    subdirectories.append({"path": path, "parent": directory, "pending": 0, "listed": False})
+                else:
+                    self.unlink(path, stat, dir_fd)
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        with self.lock:
+            directory["pending"] += len(subdirectories)
+            directory["listed"] = True
+        for subdirectory in subdirectories:
+            self.queue.put(subdirectory)
+        self.cleared(directory)
+
+    def cleared(self, directory):
+        # Removes the directory if it is empty now, and then its parent if it was the last subdirectory left in it.
+        while directory is not None:
+            with self.lock:
+                if directory["pending"] or not directory["listed"]:
+                    return
+            self.throttle()
+            os.rmdir(directory["path"])
+            with self.lock:
+                self.directories += 1
+                parent = directory["parent"]
+                if parent is not None:
+                    parent["pending"] -= 1
+            directory = parent
+
+    def wait(self):
+        # Waits for everything to be removed, and returns a description of what was, for the log.
+        self.queue.join()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        description = "Removed %d files (%.1f MB) and %d directories in %.1f s" % (
+            self.files, self.bytes / 1e6, self.directories, time.time() - self.started)
+        if self.errors:
+            description += "; %d could not be removed, the first because: %s" % (len(self.errors), self.errors[0])
+        return description
+
+    def detach(self, log_path):
+        # Does the removals in a child process in a session of its own, which is left running when the job exits,
+        # so the job does not wait for a throttled delete. The child appends what it removed to the log at log_path.
+        # A batch system that kills what is left of a job when it ends leaves the rest for Galaxy to clean up, as before.
+        # Returns the pid of the child. Everything written to a file that is shared with it must be flushed first.
+        pid = os.fork()
+        if pid:
+            return pid
+        try:
+            os.setsid()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            self.start()
+            removed = self.wait()
+            log = open(log_path, "a")
+            log.write("%s\n" % removed)
+            log.close()
+        finally:
+            os._exit(0)
+# End of class tree_remover
+
+def settings_arguments(settings):
+    # Returns the Trinity arguments for settings.
+    arguments = ["--max_memory", "%dG" % settings["max_memory"]]
+    if settings["CPU"]:
+        arguments += ["--CPU", str(settings["CPU"])]
+    if settings["min_kmer_cov"] > 1:
+        arguments += ["--min_kmer_cov", str(settings["min_kmer_cov"])]
+    return arguments
+
 def main(*args):
     parser = argparse.ArgumentParser(description="")
     parser.add_argument("-o","--output", help="Name of output directory")
@@ -43,6 +908,21 @@ def main(*args):
     parser.add_argument("-u","--user", help="Username to run job under")
     parser.add_argument("-f","--fullpath", help="if supplying a rerunnable job, this is the full path (except the user and dir names) to run the job in.")
     parser.add_argument("-c","--CPU", help="CPUs, either a hard coded numer or from Galaxy slots")
+    parser.add_argument("-a","--attempts", type=int, default=2, help="How many times to run Trinity before giving up")
+    parser.add_argument("--memory_limit", help="The most --max_memory may be raised to after a memory failure, e.g. 64G. "
+                        "By default, the job's memory limit (GALAXY_MEMORY_MB, or the cgroup's), or else the starting --max_memory")
+    parser.add_argument("--max_min_kmer_cov", type=int, default=2, help="The most --min_kmer_cov may be raised to after a memory failure")
+    parser.add_argument("--preprocess", help="Decompress, concatenate, clean the headers of and check the pairing of the reads, "
+                        "streaming them to Trinity through named pipes", action='store_true')
+    parser.add_argument("--scratch", help="Comma separated directories on node-local storage to run Trinity in; the first with room is used. "
+                        "Rerunnable jobs use $CTAT_TRINITY_SCRATCH_DIR, or the temporary directory, by default")
+    parser.add_argument("--no_scratch", help="Run Trinity in the job's (or the rerunnable job's) directory", action='store_true')
+    parser.add_argument("--keep_intermediates", help="Keep the intermediate files in %s after Trinity succeeds" % TRINITY_OUT_DIR, action='store_true')
+    parser.add_argument("--teardown_rate", type=int, default=TEARDOWN_RATE, help="The most intermediate files and directories to remove per second; 0 is no limit")
+    parser.add_argument("-e","--resource_estimate", help="File to write the estimate of the memory and CPUs needed for the inputs to, as JSON")
+    parser.add_argument("--estimate_only", help="Only estimate the resources needed for the inputs, writing the JSON to --resource_estimate, or stdout", action='store_true')
+    parser.add_argument("--auto_resources", help="Use the estimated --max_memory, up to the job's memory limit (or --max_memory if that is not known), "
+                        "and the estimated --CPU, up to --CPU", action='store_true')
 #    parser.add_argument("-","--", help="")
     args = parser.parse_args()
 
@@ -50,6 +930,33 @@ def main(*args):
         log.basicConfig(format='%(message)s',level=log.DEBUG)
     cmd = ["Trinity"]
 
+    ### Estimate the resources the inputs need ######################
+    ### This is done before changing to the rerun directory, since the paths may be relative to the job's directory.
+    estimate = None
+    if args.estimate_only or args.resource_estimate or args.auto_resources:
+        try:
+            estimate = estimate_resources(args.single, args.left, args.right)
+        except (IOError, OSError, zlib.error) as e:
+            ### Trinity can still be run without the estimate.
+            if args.estimate_only:
+                raise
+            print "Could not estimate the resources for the inputs: ", e
+    if estimate is not None:
+        if args.resource_estimate:
+            handle = open(args.resource_estimate, 'w')
+            json.dump(estimate, handle, indent=2, sort_keys=True)
+            handle.close()
+        if args.estimate_only:
+            if not args.resource_estimate:
+                print json.dumps(estimate, indent=2, sort_keys=True)
+            return 0
+    scratch_needed = None
+    if not args.no_scratch and (args.scratch or (args.dir and args.user and args.fullpath)):
+        try:
+            scratch_needed = scratch_space_needed(args.single, args.left, args.right)
+        except (IOError, OSError) as e:
+            print "Could not find the size of the inputs, so Trinity is not run in scratch: ", e
+
     ### Add rerun ability ###########################################
     # This variable tells us later whether to copy the files back to the job working directory
     copyback = False
@@ -81,12 +988,8 @@ def main(*args):
                 raise
         os.chdir(rerunPath)
 
-    ### Add information for reads ###################################
-    if args.left and args.right:
-        cmd += ["--left",args.left,"--right", args.right]
-    elif args.single:
-        cmd += ["--single",args.single]
-    else:
+    ### Check the reads ###############################################
+    if not ((args.left and args.right) or args.single):
         raise Exception ("Need input files in order to run Trinity!")
 
     ### Add seqtype ##################################################
@@ -100,62 +1003,225 @@ def main(*args):
         if args.CPU:
             memry = int(args.CPU) * int(args.mem_per_cpu)
             memstr = "%dG" % (memry)
-            cmd += ["--max_memory",memstr]
         else:
             memry = 2 * int(args.mem_per_cpu)
             memstr = "%dG" % (memry)
-            cmd += ["--max_memory",memstr]
     elif args.max_memory and not args.mem_per_cpu:
-        cmd += ["--max_memory",args.max_memory]
+        memstr = args.max_memory
     else:
         raise Exception ("Please pick Memory per cpu, or max mem, but not both.")
-    if args.CPU:
-        cmd += ["--CPU", args.CPU]
+    ### The settings may be changed between attempts, after a memory failure, within these limits.
+    ### --CPU (the Galaxy slots) is never raised, and --max_memory is not raised past what the job may use.
+    settings = {"max_memory": max(1, int(memory_gb(memstr))), "CPU": int(args.CPU) if args.CPU else 0, "min_kmer_cov": 1}
+    job_memory = job_memory_limit_gb()
+    if args.memory_limit:
+        memory_limit = int(memory_gb(args.memory_limit))
+    elif job_memory is not None:
+        memory_limit = max(1, int(job_memory))
+    else:
+        memory_limit = settings["max_memory"]
+    limits = {"max_memory": max(memory_limit, settings["max_memory"]), "job_memory": job_memory,
+              "min_kmer_cov": args.max_min_kmer_cov}
+    if args.auto_resources and estimate is not None:
+        settings["max_memory"] = max(1, min(estimate["recommended"]["max_memory_gb"],
+                                            int(job_memory) if job_memory is not None else settings["max_memory"]))
+        if settings["CPU"]:
+            settings["CPU"] = min(settings["CPU"], estimate["recommended"]["CPU"])
     
-    ### Enough args, let's run it ####################################
-    print "About to write to %s" % args.log
-    out = open(args.log, 'w')
-    totalattempts = attempts = 2
-    ec = 1
-    finish = 1
-    out.write("Command is:\n%s\n" % (" ".join(cmd)))
-
-    ### There is definitely some value in running the job more than once, especially if it dies for stupid reasons.. ###
-    while ec != 0 and attempts > 0 and finish != 0:
-
-        dt = datetime.now()
-        dtstr = dt.strftime("%d/%m/%y %H:%M")
-        out.write("Beginning attempt %d of Trinity job at %s\n" % (totalattempts - attempts +1, dtstr) )
-        attempts -= 1
-        ec = subprocess32.call(cmd, shell=False, stdin=None, stdout=out, stderr=out, timeout=None)       
-        out.write("Trinity exited with status %d\n" % ec)
-
-        greplog = open("greplog", 'w')
-        cmds = ["grep", 'All commands completed successfully', args.log]
-        finish = subprocess32.call(cmds,shell=False,  stdin=None, stdout=greplog, stderr=greplog, timeout=None)
-        greplog.close()
-        out.write("Finished and found the success command with grep code %d\n" % finish)
-
-    if ec == 0 and args.timing is not None:
-        if copyback is not False:
-            cwd = os.getcwd()
-            dest = copyback + "/" + TRINITY_OUT_DIR + "/Trinity.fasta"
-            src = cwd + "/" + TRINITY_OUT_DIR + "/Trinity.fasta"
-            print "copying trinity outputs from %s to %s" % (src, dest)
-            os.symlink(src, dest)
-
-        #copy the timing file into the log
-        try: 
-            handle = open (args.timing, 'r')
-            for line in handle:
-                out.write(line)
-            handle.close()
-        except (OSError, IOError) as e:
-            print "Oops, no timing file found? ",e
+    ### Run Trinity in node-local scratch #############################
+    ### The millions of small files Trinity makes are hard on shared storage. The outputs of the completed phases
+    ### of a rerunnable job are checkpointed back to its directory, so that it can be rerun on another node.
+    ### Nothing is made in scratch until the arguments have all been checked, and from then on the directories made
+    ### there are removed however the run ends.
+    stager = None
+    preprocessor = None
+    scratch_notes = []
+    if scratch_needed is not None:
+        candidates = args.scratch or os.environ.get("CTAT_TRINITY_SCRATCH_DIR") or tempfile.gettempdir()
+        scratch, scratch_notes = find_scratch([path for path in candidates.split(",") if path], os.getcwd(), scratch_needed)
+        if scratch is not None:
+            stager = scratch_stager(scratch, os.path.join(os.getcwd(), TRINITY_OUT_DIR), copyback is not False)
+            cmd += ["--output", stager.outdir]
+        else:
+            scratch_notes.append("Trinity is run in %s" % os.getcwd())
+
+    try:
+        ### Add information for reads ###################################
+        if args.preprocess:
+            preprocessor = read_preprocessor(args.seqType, None if (args.left and args.right) else args.single,
+                                             args.left if args.right else None, args.right if args.left else None,
+                                             stager.directory if stager else None)
+        if args.left and args.right:
+            if preprocessor:
+                cmd += ["--left", preprocessor.fifos["left"], "--right", preprocessor.fifos["right"]]
+            else:
+                cmd += ["--left",args.left,"--right", args.right]
+        elif preprocessor:
+            cmd += ["--single", preprocessor.fifos["single"]]
+        else:
+            cmd += ["--single",args.single]
+
+        ### Enough args, let's run it ####################################
+        print "About to write to %s" % args.log
+        out = open(args.log, 'w')
+        totalattempts = attempts = args.attempts
+        ec = 1
+        finish = 1
+        if estimate is not None:
+            out.write("Estimated %d reads (%d fragments) of %.1f bases, with k-mer complexity %.3f, from a sample of the inputs. "
+                      "Recommended: --max_memory %s --CPU %d\n" % (estimate["estimated_reads"], estimate["estimated_fragments"],
+                      estimate["mean_read_length"], estimate["kmer_complexity"], estimate["recommended"]["max_memory"],
+                      estimate["recommended"]["CPU"]))
+        out.write("Command is:\n%s\n" % (" ".join(cmd + settings_arguments(settings))))
+        if stager:
+            stager.start()
+        for note in scratch_notes + (stager.take_messages() if stager else []):
+            out.write("%s\n" % note)
+        if preprocessor:
+            out.write("The reads are pre-processed and streamed to Trinity through named pipes in %s\n" % preprocessor.directory)
+            preprocessor.start()
+        trinity_outdir = stager.outdir if stager else os.path.join(os.getcwd(), TRINITY_OUT_DIR)
+        phase_seconds = dict((phase, 0.0) for phase, checkpoints in TRINITY_PHASES)
+
+        ### Trinity is started in its own process group, so it can be killed along with all of the programs it started.
+        ### That also keeps a signal sent to stop the job from reaching them, so it is passed on to the group.
+        trinity = None
+        def stop_trinity(signum, frame):
+            if trinity is not None:
+                try:
+                    os.killpg(trinity.pid, signum)
+                except OSError:
+                    pass
+            sys.exit(128 + signum)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, stop_trinity)
+
+        ### There is definitely some value in running the job more than once, especially if it dies for stupid reasons.. ###
+        while ec != 0 and attempts > 0 and finish != 0:
+
+            dt = datetime.now()
+            dtstr = dt.strftime("%d/%m/%y %H:%M")
+            attempt = totalattempts - attempts + 1
+            out.write("Beginning attempt %d of Trinity job at %s\n" % (attempt, dtstr) )
+            ### Trinity picks up after the last phase whose checkpoint it finds, so the outputs of those phases are kept.
+            completed = completed_phases(trinity_outdir)
+            if completed:
+                out.write("Keeping the outputs of the completed phases (%s) in %s; Trinity resumes at %s\n" % (
+                    ", ".join(phase for phase, finish_time in completed), trinity_outdir,
+                    TRINITY_PHASES[len(completed)][0] if len(completed) < len(TRINITY_PHASES) else "the end"))
+            out.flush()
+            attempts -= 1
+            log_offset = os.path.getsize(args.log)
+            oom_kills_before = cgroup_oom_kills()
+            attempt_start = time.time()
+            trinity = subprocess32.Popen(cmd + settings_arguments(settings), shell=False, stdin=None, stdout=out, stderr=out,
+                                         preexec_fn=os.setsid)
+            if preprocessor:
+                preprocessor.process = trinity
+            ec = trinity.wait()
+            attempt_end = time.time()
+            out.write("Trinity exited with status %d\n" % ec)
+            if preprocessor:
+                if preprocessor.summary():
+                    out.write("Streamed %s\n" % preprocessor.summary())
+                if preprocessor.error:
+                    ### Bad reads will be just as bad on a retry.
+                    out.write("Pre-processing the reads failed: %s\n" % preprocessor.error)
+                    ec = ec or 1
+                    attempts = 0
+            if stager:
+                for message in stager.take_messages():
+                    out.write("%s\n" % message)
+            completed = completed_phases(trinity_outdir)
+            out.write("Phase timing for attempt %d:\n" % attempt)
+            for phase, seconds, status in phase_timings(completed, attempt_start, attempt_end):
+                phase_seconds[phase] += seconds
+                out.write("    %-18s %10.1f s  %s\n" % (phase, seconds, status))
+            if completed:
+                out.write("Last completed phase: %s\n" % completed[-1][0])
+            else:
+                out.write("Last completed phase: none\n")
+            out.flush()
+
+            greplog = open("greplog", 'w')
+            cmds = ["grep", 'All commands completed successfully', args.log]
+            finish = subprocess32.call(cmds,shell=False,  stdin=None, stdout=greplog, stderr=greplog, timeout=None)
+            greplog.close()
+            out.write("Finished and found the success command with grep code %d\n" % finish)
+
+            ### Retrying with the same settings after running out of memory would just run out again.
+            if ec != 0 and finish != 0 and attempts > 0:
+                log_file = open(args.log)
+                log_file.seek(log_offset)
+                kind, reason, killed = classify_failure(ec, log_file.read(), oom_kills_before, cgroup_oom_kills())
+                log_file.close()
+                out.write("The attempt failed for %s: %s\n" % ("lack of memory" if kind == "memory" else "a reason other than memory", reason))
+                if kind == "memory":
+                    failed_phase = TRINITY_PHASES[len(completed)][0] if len(completed) < len(TRINITY_PHASES) else None
+                    changes = adjust_for_memory_failure(settings, limits, failed_phase, killed)
+                    if changes:
+                        out.write("Changed for the next attempt: %s\n" % ", ".join(changes))
+                        out.write("Command is:\n%s\n" % (" ".join(cmd + settings_arguments(settings))))
+                    else:
+                        out.write("Nothing is left to change within the limits (--max_memory %dG, --CPU %d, --min_kmer_cov %d); not retrying.\n" % (
+                            limits["max_memory"], settings["CPU"], limits["min_kmer_cov"]))
+                        attempts = 0
+                out.flush()
+
+        out.write("Total wall time of each phase over all attempts:\n")
+        for phase, checkpoints in TRINITY_PHASES:
+            out.write("    %-18s %10.1f s\n" % (phase, phase_seconds[phase]))
+
+        if preprocessor:
+            preprocessor.stop()
+        ### Only the results are copied back from scratch, or the last checkpoint taken if Trinity failed.
+        if stager:
+            stager.finish(ec == 0)
+            for message in stager.take_messages():
+                out.write("%s\n" % message)
+            out.flush()
+
+        ### Once the results are safe, the intermediate files (millions of them, in read_partitions) are removed in the background.
+        remover = tree_remover(rate=args.teardown_rate)
+        if stager:
+            remover.remove(stager.directory)
+            ### The directory in scratch is the remover's to remove now.
+            stager = None
+        home_outdir = os.path.join(os.getcwd(), TRINITY_OUT_DIR)
+        if ec == 0 and not args.keep_intermediates and os.path.isdir(home_outdir):
+            for name in os.listdir(home_outdir):
+                if name not in TRINITY_RESULTS:
+                    remover.remove(os.path.join(home_outdir, name))
+
+        if ec == 0 and args.timing is not None:
+            if copyback is not False:
+                cwd = os.getcwd()
+                dest = copyback + "/" + TRINITY_OUT_DIR + "/Trinity.fasta"
+                src = cwd + "/" + TRINITY_OUT_DIR + "/Trinity.fasta"
+                print "copying trinity outputs from %s to %s" % (src, dest)
+                os.symlink(src, dest)
 
+            #copy the timing file into the log
+            try: 
+                handle = open (args.timing, 'r')
+                for line in handle:
+                    out.write(line)
+                handle.close()
+            except (OSError, IOError) as e:
+                print "Oops, no timing file found? ",e
 
-    out.close()
-    exit (ec)
+        if remover.pending():
+            out.write("Removing the intermediate files in the background; what was removed is added to this log when it is done.\n")
+            out.flush()
+            remover.detach(args.log)
+        out.close()
+        exit (ec)
+    finally:
+        ### On an error, or a signal to stop the job, the pipes and the directory in scratch are not left behind.
+        if preprocessor:
+            preprocessor.stop()
+        if stager:
+            stager.discard()
  
 if __name__ == "__main__":
     main(*sys.argv)